@@ -0,0 +1,111 @@
+"""Run a compliance sweep through /chat/batch and write a CSV or JSONL report.
+
+Asks the same question for many markets (a template with {country}) or a
+list of questions, and writes each answer to the report as soon as it
+arrives. Sign in through the web UI first and pass the value of its
+`session` cookie with --session (or POLICY_BOT_SESSION).
+
+    python batch_sweep.py --url https://policy-bot.example.com \\
+        --template "health warning size requirements in {country}" \\
+        --countries Poland,Germany,France --output sweep.csv
+    python batch_sweep.py --queries-file questions.txt --output sweep.jsonl
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import requests
+
+CSV_COLUMNS = ["index", "country", "query", "ok", "status", "cached", "degraded", "answer", "sources", "error",
+               "elapsed_ms"]
+
+
+def read_lines(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def csv_row(line: dict) -> dict:
+    result = line.get("result") or {}
+    sources = []
+    for s in result.get("sources") or []:
+        pages = f" (p. {s['page_range']})" if s.get("page_range") else ""
+        sources.append(f"{s.get('title') or ''} {s.get('uri') or ''}{pages}".strip())
+    return {
+        "index": line["index"],
+        "country": line.get("country", ""),
+        "query": line["query"],
+        "ok": line["ok"],
+        "status": line["status"],
+        "cached": result.get("cached", ""),
+        "degraded": result.get("degraded", ""),
+        "answer": result.get("answer", ""),
+        "sources": " | ".join(sources),
+        "error": line.get("error", ""),
+        "elapsed_ms": line.get("elapsed_ms", ""),
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8080", help="policy bot base URL")
+    parser.add_argument("--session", default=os.environ.get("POLICY_BOT_SESSION"),
+                        help="value of the `session` cookie of a signed-in browser")
+    parser.add_argument("--template", help='question with a {country} placeholder')
+    parser.add_argument("--countries", help="comma-separated countries for --template")
+    parser.add_argument("--countries-file", help="one country per line, for --template")
+    parser.add_argument("--queries-file", help="one question per line")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--output", required=True, help="report path; .csv or .jsonl")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the whole batch")
+    args = parser.parse_args()
+
+    if not args.session:
+        parser.error("--session (or POLICY_BOT_SESSION) is required")
+    payload = {"top_k": args.top_k, "v": 2, "fields": ["answer", "sources", "meta"]}
+    if args.template:
+        countries = read_lines(args.countries_file) if args.countries_file else \
+            [c.strip() for c in (args.countries or "").split(",") if c.strip()]
+        payload.update(template=args.template, countries=countries)
+    elif args.queries_file:
+        payload["queries"] = read_lines(args.queries_file)
+    else:
+        parser.error("give --template with --countries/--countries-file, or --queries-file")
+
+    as_csv = args.output.endswith(".csv")
+    resp = requests.post(f"{args.url.rstrip('/')}/chat/batch", json=payload, cookies={"session": args.session},
+                         stream=True, timeout=(10, args.timeout))
+    if resp.status_code != 200:
+        sys.exit(f"Batch rejected ({resp.status_code}): {resp.text[:500]}")
+
+    summary = None
+    with open(args.output, "w", encoding="utf-8", newline="") as out:
+        writer = csv.DictWriter(out, CSV_COLUMNS) if as_csv else None
+        if writer:
+            writer.writeheader()
+        for raw in resp.iter_lines():
+            if not raw:
+                continue
+            line = json.loads(raw)
+            if line.get("done"):
+                summary = line
+                continue
+            if writer:
+                writer.writerow(csv_row(line))
+            else:
+                out.write(json.dumps(line, ensure_ascii=False) + "\n")
+            out.flush()
+            label = line.get("country") or line["query"][:60]
+            print(f"[{line['index']:>3}] {label}: {'ok' if line['ok'] else line.get('error')}", file=sys.stderr)
+
+    if summary is None:
+        sys.exit("The batch ended early (connection closed before the summary line)")
+    print(f"{summary['ok']}/{summary['total']} answered, {summary['failed']} failed, "
+          f"{summary['elapsed_ms'] / 1000:.1f}s -> {args.output}", file=sys.stderr)
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,252 @@
+"""Offline end-to-end benchmark of /chat against the fake Vertex backend.
+
+Runs the real app under gunicorn with fake_vertex installed (realistic
+contexts, grounding metadata and latency distributions, no network), sends a
+fixed number of /chat requests from concurrent logged-in clients and writes
+p50/p95/p99 latency, throughput and the worker's peak RSS to a JSON file
+(server output goes next to it, in <output>.server.log).
+Pass --compare with an earlier result to print the deltas; the exit status is
+1 when p95 latency or peak RSS regressed by more than --tolerance.
+
+    python bench_chat.py --requests 400 --concurrency 16 --output bench/base.json
+    python bench_chat.py --requests 400 --concurrency 16 --output bench/new.json --compare bench/base.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from loadtest import free_port, percentile, session_cookie, start_server
+
+
+def _children(pid: int):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def peak_rss_kb(pid: int) -> int:
+    """Largest VmHWM (peak resident set) of pid and its worker processes, in KiB."""
+    peak = 0
+    for p in [pid] + _children(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+        except OSError:
+            continue
+    return peak
+
+
+def run_requests(base_url: str, total: int, concurrency: int, repeat_ratio: float, top_k: int, seed: int = 0):
+    """Send `total` /chat requests from `concurrency` clients; returns (statuses, latencies, bytes, elapsed)."""
+    statuses = Counter()
+    latencies = []
+    body_bytes = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client(n: int):
+        http = requests.Session()
+        http.cookies.set("session", session_cookie(f"bench-{n}"))
+        rng = random.Random(seed + n)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            # A repeat_ratio share of questions re-asks an earlier one so the caches see some reuse
+            if i and rng.random() < repeat_ratio:
+                question = f"bench question {rng.randrange(i)}"
+            else:
+                question = f"bench question {i}"
+            # Fresh conversation each time, so history doesn't grow across the run
+            http.post(f"{base_url}/clear", timeout=30)
+            start = time.perf_counter()
+            try:
+                resp = http.post(f"{base_url}/chat", json={"message": question, "top_k": top_k}, timeout=120)
+                status, size = resp.status_code, len(resp.content)
+            except requests.RequestException:
+                status, size = "error", 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(elapsed)
+                    body_bytes.append(size)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return statuses, latencies, body_bytes, time.perf_counter() - started
+
+
+def summarize(statuses, latencies, body_bytes, elapsed, rss_kb):
+    ok = statuses.get(200, 0)
+    return {
+        "requests": sum(statuses.values()),
+        "ok": ok,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(ok / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {
+            f"p{p}": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)
+        },
+        "mean_response_bytes": int(sum(body_bytes) / len(body_bytes)) if body_bytes else 0,
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> bool:
+    """Print current vs. baseline; True when nothing regressed beyond tolerance."""
+    rows = [
+        ("throughput_rps", current["result"]["throughput_rps"], baseline["result"]["throughput_rps"]),
+        ("peak_rss_mb", current["result"]["peak_rss_mb"], baseline["result"]["peak_rss_mb"]),
+    ] + [
+        (f"latency {p}", current["result"]["latency_ms"][p], baseline["result"]["latency_ms"][p])
+        for p in ("p50", "p95", "p99")
+    ]
+    ok = True
+    print(f"\n{'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, cur, base in rows:
+        change = (cur - base) / base if base else 0.0
+        print(f"{name:<16} {base:>10} {cur:>10} {change:>+8.1%}")
+        if name in ("latency p95", "peak_rss_mb") and change > tolerance:
+            ok = False
+    if current["config"] != baseline["config"]:
+        print("note: benchmark configuration differs from the baseline")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400, help="total /chat requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--threads", type=int, default=40, help="gunicorn gthread threads")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--grounding-mode", choices=["tool", "inline"], default="tool")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0,
+                        help="fraction of questions that repeat an earlier one (0 disables caches entirely)")
+    parser.add_argument("--retrieval-ms", type=float, default=300, help="median fake retrieval latency")
+    parser.add_argument("--generation-ms", type=float, default=1500, help="median fake generation latency")
+    parser.add_argument("--latency-dist", choices=["lognormal", "fixed"], default="lognormal")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal shape")
+    parser.add_argument("--context-chars", type=int, default=1500, help="characters per retrieved chunk")
+    parser.add_argument("--answer-sentences", type=int, default=8)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake Vertex calls failing")
+    parser.add_argument("--error-code", type=int, choices=[429, 503], default=503)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of fake Vertex calls that are slow")
+    parser.add_argument("--slow-factor", type=float, default=10.0, help="how much slower those calls are")
+    parser.add_argument("--hedge", action="store_true", help="enable hedged retrieval on the server")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_chat.json", help="where to write the JSON result")
+    parser.add_argument("--compare", metavar="BASELINE", help="earlier JSON result to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed p95/RSS regression (fraction)")
+    args = parser.parse_args()
+
+    bench_config = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "threads": args.threads,
+        "top_k": args.top_k,
+        "grounding_mode": args.grounding_mode,
+        "repeat_ratio": args.repeat_ratio,
+        "retrieval_ms": args.retrieval_ms,
+        "generation_ms": args.generation_ms,
+        "latency_dist": args.latency_dist,
+        "sigma": args.sigma,
+        "context_chars": args.context_chars,
+        "answer_sentences": args.answer_sentences,
+        "error_rate": args.error_rate,
+        "error_code": args.error_code,
+        "slow_rate": args.slow_rate,
+        "slow_factor": args.slow_factor,
+        "hedge": args.hedge,
+        "seed": args.seed,
+    }
+    env = {
+        "FAKE_VERTEX_RETRIEVAL_MS": str(args.retrieval_ms),
+        "FAKE_VERTEX_GENERATION_MS": str(args.generation_ms),
+        "FAKE_VERTEX_LATENCY_DIST": args.latency_dist,
+        "FAKE_VERTEX_SIGMA": str(args.sigma),
+        "FAKE_VERTEX_CONTEXT_CHARS": str(args.context_chars),
+        "FAKE_VERTEX_ANSWER_SENTENCES": str(args.answer_sentences),
+        "FAKE_VERTEX_ERROR_RATE": str(args.error_rate),
+        "FAKE_VERTEX_ERROR_CODE": str(args.error_code),
+        "FAKE_VERTEX_SLOW_RATE": str(args.slow_rate),
+        "FAKE_VERTEX_SLOW_FACTOR": str(args.slow_factor),
+        "FAKE_VERTEX_SEED": str(args.seed),
+        "RETRIEVAL_HEDGE_ENABLED": "1" if args.hedge else "0",
+        "RAG_GROUNDING_MODE": args.grounding_mode,
+        "MAX_IN_FLIGHT_CHATS": str(args.concurrency),
+        "MAX_QUEUED_CHATS": str(args.concurrency),
+        "MAX_IN_FLIGHT_PER_USER": "0",
+        "CHAT_EXECUTOR_WORKERS": str(2 * args.concurrency),
+    }
+    if not args.repeat_ratio:
+        env.update({"ANSWER_CACHE_BACKEND": "off", "RETRIEVAL_CACHE_MAX_ENTRIES": "0"})
+
+    server_log_path = os.path.splitext(args.output)[0] + ".server.log"
+    out_dir = os.path.dirname(args.output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    port = free_port()
+    server_log = open(server_log_path, "w", encoding="utf-8")
+    server = start_server(port, "gthread", args.threads, env, log=server_log)
+    try:
+        statuses, latencies, body_bytes, elapsed = run_requests(
+            f"http://127.0.0.1:{port}", args.requests, args.concurrency, args.repeat_ratio, args.top_k, args.seed
+        )
+        rss_kb = peak_rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        server_log.close()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": bench_config,
+        "result": summarize(statuses, latencies, body_bytes, elapsed, rss_kb),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    r = report["result"]
+    print(f"{r['ok']}/{r['requests']} ok in {r['elapsed_s']}s  {r['throughput_rps']} req/s  "
+          f"p50 {r['latency_ms']['p50']}ms  p95 {r['latency_ms']['p95']}ms  p99 {r['latency_ms']['p99']}ms  "
+          f"peak RSS {r['peak_rss_mb']} MB")
+    print(f"wrote {args.output} (server log: {server_log_path})")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Microbenchmark for the citation engine.
+
+Times build_citation_catalog + annotate_with_citations on a long answer with
+many supports, next to the previous implementations kept in
+test_citations.py (which also checks that both give the same output).
+
+    python bench_citations.py --supports 10000 --chunks 2000
+"""
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("RAG_GROUNDING_MODE", "tool")
+import fake_vertex  # noqa: E402
+
+fake_vertex.install()
+import main  # noqa: E402
+from test_citations import (  # noqa: E402
+    UNICODE_WORDS, chunk_records, legacy_annotate_with_citations, legacy_build_citation_catalog, random_chunks,
+    random_retrieved, random_supports, random_text, support_records, to_byte_offsets,
+)
+
+
+def bench(n_supports, n_chunks, repeat):
+    rng = random.Random(0)
+    text = random_text(rng, UNICODE_WORDS, n_supports * 4)
+    chunks = random_chunks(rng, n_chunks, n_chunks // 2)
+    retrieved = random_retrieved(rng, n_chunks // 2)
+    supports = random_supports(rng, n_supports, len(text), n_chunks)
+    records = chunk_records(chunks)
+    byte_supports = support_records(to_byte_offsets(text, supports))
+
+    def timed(fn, *args):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(*args)
+            best = min(best, time.perf_counter() - start)
+        return best * 1000
+
+    def old():
+        idx_to_num, _ = legacy_build_citation_catalog(chunks, retrieved)
+        legacy_annotate_with_citations(text, supports, idx_to_num)
+
+    def new():
+        idx_to_num, _ = main.build_citation_catalog(records, retrieved)
+        main.annotate_with_citations(text, byte_supports, idx_to_num)
+
+    print(f"{n_supports} supports, {n_chunks} grounding chunks, {len(text)} chars")
+    old_catalog = timed(legacy_build_citation_catalog, chunks, retrieved)
+    new_catalog = timed(main.build_citation_catalog, records, retrieved)
+    old_map, _ = legacy_build_citation_catalog(chunks, retrieved)
+    old_annotate = timed(legacy_annotate_with_citations, text, supports, old_map)
+    new_annotate = timed(main.annotate_with_citations, text, byte_supports, old_map)
+    print(f"  catalog:  previous {old_catalog:9.1f} ms   new {new_catalog:7.2f} ms")
+    print(f"  annotate: previous {old_annotate:9.1f} ms   new {new_annotate:7.2f} ms (byte offsets)")
+    print(f"  total:    previous {timed(old):9.1f} ms   new {timed(new):7.2f} ms")
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--supports", type=int, default=10000)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    bench(args.supports, args.chunks, args.repeat)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,83 @@
+"""Microbenchmark: per-request Vertex object setup, rebuilt vs. shared registry.
+
+Runs offline: application default credentials are replaced with anonymous
+ones, so the SDK objects build without a login and no Vertex calls are
+made. Usage:
+
+    python bench_client_setup.py [--iterations 2000]
+"""
+import argparse
+import os
+import time
+
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench-project")
+os.environ.setdefault("RAG_CORPUS_RESOURCE", "projects/bench-project/locations/us-central1/ragCorpora/1")
+os.environ.setdefault("WARMUP_ENABLED", "0")  # the warm-up would send a real retrieval
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+# VertexRagStore and the RAG clients ask for credentials while being built
+google.auth.default = lambda *args, **kwargs: (AnonymousCredentials(), os.environ["GOOGLE_CLOUD_PROJECT"])
+
+import main
+from vertexai import rag
+from vertexai.generative_models import GenerativeModel, Tool
+
+
+def rebuild_per_request(top_k: int):
+    """What chat() did before the registry: fresh objects on every message."""
+    resources = [rag.RagResource(rag_corpus=main.RAG_SHARDS[0].corpus)]
+    config = rag.RagRetrievalConfig(top_k=top_k)
+    tool = Tool.from_retrieval(
+        retrieval=rag.Retrieval(
+            source=rag.VertexRagStore(rag_resources=resources, rag_retrieval_config=config)
+        )
+    )
+    model = GenerativeModel(model_name=main.MODEL_NAME, tools=[tool])
+    # retrieve_contexts() built its own resources/config as well
+    [rag.RagResource(rag_corpus=main.RAG_SHARDS[0].corpus)], rag.RagRetrievalConfig(top_k=top_k)
+    return model
+
+
+def from_registry(top_k: int):
+    main.get_rag_resources(main.RAG_SHARDS[0]), main.get_retrieval_config(top_k)
+    return main.get_generative_model(top_k=top_k)
+
+
+def timeit(fn, iterations: int, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(*args)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    from_registry(args.top_k)  # first build happens once per process
+    rows = [
+        ("rebuild per request", timeit(rebuild_per_request, args.iterations, args.top_k)),
+        ("shared registry", timeit(from_registry, args.iterations, args.top_k)),
+    ]
+
+    try:
+        from vertexai.rag.utils import _gapic_utils
+        create = _gapic_utils.create_rag_service_client
+        n = max(1, args.iterations // 100)
+        fresh = timeit(lambda: main._vertex_registry.clear() or create(), n)
+        shared = timeit(create, args.iterations)
+        rows += [("RAG client per call", fresh), ("RAG client shared", shared)]
+    except Exception as e:
+        print(f"(skipping RAG service client timing: {e})")
+
+    print(f"{'setup':<24}{'us/request':>12}")
+    for name, us in rows:
+        print(f"{name:<24}{us:>12.1f}")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,132 @@
+"""Measure import time and cold start of the app.
+
+Import: `python -X importtime -c "import main"` (warm-up off) in fresh
+processes, reporting main's cumulative import time, the slowest top-level
+imports, and, for comparison, what importing the Vertex SDK would add.
+
+Cold start: spawns gunicorn like the Dockerfile does and times, from spawn,
+the first TCP connect, the first /healthz 200 and the first /readyz 200.
+By default the real SDK is used with a placeholder project (no Vertex call
+succeeds, so the warm-up retrieval is skipped or fails fast); --fake serves
+the app on fake_vertex instead.
+
+    python bench_cold_start.py --repeat 5
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict
+
+import requests
+
+from loadtest import free_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENV = {
+    "GOOGLE_CLOUD_PROJECT": "cold-start",
+    "RAG_CORPUS_RESOURCE": "projects/cold-start/locations/us-central1/ragCorpora/1",
+    "PYTHONWARNINGS": "ignore",
+}
+_IMPORTTIME_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def import_times(code: str, env: dict) -> Dict[str, int]:
+    """Cumulative µs: "total" for main/vertexai, plus each module main imports directly."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env={**os.environ, **env},
+                         cwd=HERE, capture_output=True, text=True, check=True).stderr
+    # Children are listed before their parent, one indent level deeper
+    entries = [(len(m.group(3)), m.group(4), int(m.group(2))) for m in _IMPORTTIME_RE.finditer(out)]
+    times: Dict[str, int] = {}
+    for i, (depth, name, us) in enumerate(entries):
+        if depth != 1 or name.split(".")[0] not in ("main", "vertexai"):
+            continue
+        times["total"] = times.get("total", 0) + us
+        for child_depth, child, child_us in reversed(entries[:i]):
+            if child_depth == 1:
+                break
+            if child_depth == 3:
+                times[child] = child_us
+    return times
+
+
+def measure_imports(repeat: int, show: int) -> None:
+    env = {**ENV, "WARMUP_ENABLED": "0"}
+    totals, sdk = [], []
+    for _ in range(repeat):
+        top = import_times("import main", env)
+        totals.append(top.pop("total") / 1000)
+        sdk.append(import_times("import vertexai, vertexai.rag, vertexai.generative_models", env)["total"] / 1000)
+    print(f"import main:            median {statistics.median(totals):7.0f} ms  (min {min(totals):.0f})")
+    print(f"deferred Vertex SDK:    median {statistics.median(sdk):7.0f} ms  (paid by the warm-up thread)")
+    print("slowest imports under main:")
+    for name, us in sorted(top.items(), key=lambda kv: -kv[1])[:show]:
+        print(f"  {name:<24} {us / 1000:7.1f} ms")
+
+
+def _wait(check, deadline: float) -> float:
+    while time.monotonic() < deadline:
+        if check():
+            return time.monotonic()
+        time.sleep(0.005)
+    raise RuntimeError("timed out")
+
+
+def cold_start(fake: bool):
+    port = free_port()
+    app = "loadtest:create_app()" if fake else "main:app"
+    cmd = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", "1",
+           "--worker-class", "gthread", "--threads", "8", "--log-level", "warning", app]
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, env={**os.environ, **ENV}, cwd=HERE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def connects():
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return True
+        except OSError:
+            return False
+
+    def ok(path):
+        def check():
+            try:
+                return requests.get(f"http://127.0.0.1:{port}{path}", timeout=0.5).status_code == 200
+            except requests.RequestException:
+                return False
+        return check
+
+    try:
+        deadline = started + 60
+        bound = _wait(connects, deadline)
+        healthy = _wait(ok("/healthz"), deadline)
+        ready = _wait(ok("/readyz"), deadline)
+        status = requests.get(f"http://127.0.0.1:{port}/readyz", timeout=1).json()
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return {"bind": (bound - started) * 1000, "healthz": (healthy - started) * 1000,
+            "readyz": (ready - started) * 1000, "steps_ms": status.get("steps_ms")}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--show", type=int, default=8, help="slowest imports to list")
+    parser.add_argument("--fake", action="store_true", help="serve on fake_vertex instead of the real SDK")
+    args = parser.parse_args()
+
+    measure_imports(args.repeat, args.show)
+    runs = [cold_start(args.fake) for _ in range(args.repeat)]
+    print(f"cold start ({'fake' if args.fake else 'real'} SDK, ms from spawn, median of {args.repeat}):")
+    for key in ("bind", "healthz", "readyz"):
+        print(f"  first {key:<8} {statistics.median(r[key] for r in runs):7.0f}")
+    print(f"  warm-up steps (last run): {runs[-1]['steps_ms']}")
+
+
+if __name__ == "__main__":
+    run()
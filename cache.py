@@ -0,0 +1,280 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Case/whitespace/punctuation-insensitive form of a user query."""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = _WS_RE.sub(" ", text).strip()
+    return text.strip(" \"'“”‘’").rstrip("?!. ").strip()
+
+
+def hash_parts(*parts: Any) -> str:
+    """Stable sha256 over JSON-serialisable parts."""
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class MemoryCache:
+    """In-process cache with LRU eviction and a per-entry TTL. Thread-safe."""
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600,
+                 on_evict: Optional[Callable[[str, Any], None]] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._on_evict = on_evict
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats.misses += 1
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.monotonic() + self.ttl_seconds)
+            while len(self._data) > self.max_entries:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.stats.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._data):
+                self._remove(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._data.pop(key)
+        if self._on_evict:
+            self._on_evict(key, value)
+
+
+class SqliteCache:
+    """SQLite-backed cache with the same interface as MemoryCache.
+
+    Stands in for a shared store: every worker (or instance) pointing at the
+    same file sees the same entries. Values must be JSON-serialisable.
+    """
+
+    def __init__(self, path: str, max_entries: int = 5000, ttl_seconds: float = 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+            self.stats.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        blob = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, blob, now + self.ttl_seconds, now),
+            )
+            overflow = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access LIMIT ?)",
+                    (overflow,),
+                )
+                self.stats.evictions += overflow
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+def make_backend(kind: str, max_entries: int, ttl_seconds: float, sqlite_path: str):
+    """Build a cache backend from config; returns None when caching is off."""
+    kind = (kind or "").strip().lower()
+    if kind in ("", "off", "none", "0", "false"):
+        return None
+    if kind == "sqlite":
+        return SqliteCache(sqlite_path, max_entries=max_entries, ttl_seconds=ttl_seconds)
+    if kind != "memory":
+        logger.warning(f"Unknown cache backend '{kind}', using memory")
+    return MemoryCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+
+class AnswerCache:
+    """Final /chat payloads keyed by normalized query, settings and history.
+
+    The corpus version token is part of every key and stored with every entry,
+    so bumping it after documents are re-ingested makes all older answers
+    unreachable.
+    """
+
+    def __init__(self, backend, corpus_version: str = ""):
+        self.backend = backend
+        self.corpus_version = corpus_version
+
+    def key(self, query: str, top_k: int, model: str, corpus: str,
+            history: List[Dict[str, str]], *extra: Any) -> str:
+        return "answer:" + hash_parts(
+            normalize_query(query), top_k, model, corpus, self.corpus_version, hash_parts(history), *extra
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        if entry.get("corpus_version") != self.corpus_version:
+            self.backend.delete(key)
+            return None
+        return entry["payload"]
+
+    def put(self, key: str, payload: Dict[str, Any]) -> None:
+        self.backend.set(key, {"corpus_version": self.corpus_version, "payload": payload})
+
+    def set_corpus_version(self, version: str) -> None:
+        self.corpus_version = version
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.backend.stats.as_dict(), "entries": len(self.backend),
+                "corpus_version": self.corpus_version}
+
+
+class RetrievalCache:
+    """Parsed retrieve_contexts() results with the chunks stored once.
+
+    Entries only hold (chunk key, score) pairs. The chunk dicts live in a
+    reference-counted pool keyed by source_uri + page span (and the chunk text,
+    so two chunks from the same page stay distinct), shared by every cached
+    query that retrieved them, and are dropped with the last entry using them.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl_seconds: float = 3600, corpus_version: str = ""):
+        self.corpus_version = corpus_version
+        self._pool_lock = threading.Lock()
+        self._pool: Dict[tuple, list] = {}
+        self._entries = MemoryCache(max_entries=max_entries, ttl_seconds=ttl_seconds, on_evict=self._release)
+
+    def key(self, query: str, top_k: int, corpus: Any) -> str:
+        return "retrieval:" + hash_parts(normalize_query(query), top_k, corpus, self.corpus_version)
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        refs = self._entries.get(key)
+        if refs is None:
+            return None
+        contexts = []
+        with self._pool_lock:
+            for chunk_key, score in refs:
+                slot = self._pool.get(chunk_key)
+                if slot is None:
+                    # Evicted between the lookup and here
+                    return None
+                contexts.append({**slot[0], "score": score})
+        return contexts
+
+    def put(self, key: str, contexts: List[Dict[str, Any]]) -> None:
+        refs = []
+        with self._pool_lock:
+            for c in contexts:
+                chunk_key = (c.get("source_uri"), c.get("page_number"), c.get("page_range"), c.get("text"))
+                slot = self._pool.get(chunk_key)
+                if slot is None:
+                    chunk = {k: v for k, v in c.items() if k != "score"}
+                    slot = self._pool[chunk_key] = [chunk, 0]
+                slot[1] += 1
+                refs.append((chunk_key, c.get("score")))
+        self._entries.set(key, tuple(refs))
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _release(self, _key: str, refs: tuple) -> None:
+        with self._pool_lock:
+            for chunk_key, _score in refs:
+                slot = self._pool.get(chunk_key)
+                if slot is None:
+                    continue
+                slot[1] -= 1
+                if slot[1] <= 0:
+                    del self._pool[chunk_key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._entries.stats.as_dict(), "entries": len(self._entries),
+                "interned_chunks": len(self._pool), "corpus_version": self.corpus_version}
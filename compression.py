@@ -0,0 +1,107 @@
+"""Accept-Encoding negotiation and response compression (brotli, gzip).
+
+Brotli is optional: without the `brotli` package only gzip is offered.
+Static files are compressed once per (path, mtime, encoding) and reused.
+"""
+import gzip
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = frozenset({
+    "application/json", "text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+    "image/svg+xml",
+})
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick "br" or "gzip" from an Accept-Encoding header, honouring q=0."""
+    offered = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            offered[name] = q
+    wildcard = offered.get("*", 0.0)
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        if offered.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, static: bool = False) -> bytes:
+    """Compress for the wire; static assets get the slower, denser settings."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+
+
+class StaticCompressionCache:
+    """Compressed bodies of static files keyed by (path, mtime, encoding). Thread-safe LRU."""
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[Tuple, bytes]" = OrderedDict()
+
+    def get_or_compress(self, key: Tuple, data: bytes, encoding: str) -> bytes:
+        with self._lock:
+            body = self._data.get(key)
+            if body is not None:
+                self._data.move_to_end(key)
+                return body
+        body = compress(data, encoding, static=True)
+        with self._lock:
+            self._data[key] = body
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return body
+
+
+def compress_response(resp, accept_encoding: str, min_size: int = 512,
+                      static_cache: Optional[StaticCompressionCache] = None, static_key: Optional[Tuple] = None):
+    """Compress a finished Flask response in place when the client accepts it.
+
+    Streams, partial/conditional responses, already-encoded bodies and small
+    payloads are left alone.
+    """
+    if (resp.status_code != 200 or resp.is_streamed and not resp.direct_passthrough
+            or resp.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in resp.headers or "Content-Range" in resp.headers):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return resp
+    # send_file responses stream from disk; static assets are small, read them in
+    resp.direct_passthrough = False
+    data = resp.get_data()
+    if len(data) < min_size:
+        return resp
+    if static_cache is not None and static_key is not None:
+        body = static_cache.get_or_compress(static_key + (encoding,), data, encoding)
+    else:
+        body = compress(data, encoding)
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = encoding
+    etag, _ = resp.get_etag()
+    if etag:
+        # Weak, like nginx does: same resource, different bytes; 304s keep working
+        resp.set_etag(etag, weak=True)
+    return resp
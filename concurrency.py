@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, Optional
+
+
+class Overloaded(Exception):
+    """A request was turned away by admission control."""
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("user", "event", "granted")
+
+    def __init__(self, user: Optional[str]):
+        self.user = user
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    """Bounds concurrent chats per process, with a short FIFO waiting queue.
+
+    Up to max_in_flight requests run at once. Up to max_queue more wait (at
+    most queue_timeout_s) for a slot; anything beyond that is rejected at once
+    with 503 so the client can retry elsewhere. A single user holding
+    max_per_user slots gets 429. A released slot is handed straight to the
+    longest-waiting request, so newcomers never overtake the queue.
+    """
+
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 16, queue_timeout_s: float = 10.0,
+                 max_per_user: int = 4, retry_after_s: int = 2):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout_s = queue_timeout_s
+        self.max_per_user = max_per_user
+        self.retry_after_s = retry_after_s
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters: "deque[_Waiter]" = deque()
+        self._per_user: Dict[str, int] = defaultdict(int)
+        self.admitted = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+
+    def acquire(self, user: Optional[str] = None) -> "Ticket":
+        with self._lock:
+            if user and self.max_per_user and self._per_user[user] >= self.max_per_user:
+                self.rejected["per_user"] += 1
+                raise Overloaded(429, "Too many concurrent requests for this user", self.retry_after_s)
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._admit(user)
+                return Ticket(self, user)
+            if len(self._waiters) >= self.max_queue:
+                self.rejected["queue_full"] += 1
+                raise Overloaded(503, "Server is at capacity", self.retry_after_s)
+            waiter = _Waiter(user)
+            self._waiters.append(waiter)
+        waiter.event.wait(self.queue_timeout_s)
+        with self._lock:
+            # The slot may have been handed over right as the wait timed out
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                self.rejected["queue_timeout"] += 1
+                raise Overloaded(503, "Server is at capacity", self.retry_after_s)
+        return Ticket(self, user)
+
+    def _admit(self, user: Optional[str]) -> None:
+        self._in_flight += 1
+        if user:
+            self._per_user[user] += 1
+        self.admitted += 1
+
+    def _release(self, user: Optional[str]) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            if user:
+                self._per_user[user] -= 1
+                if self._per_user[user] <= 0:
+                    del self._per_user[user]
+            if self._waiters and self._in_flight < self.max_in_flight:
+                waiter = self._waiters.popleft()
+                self._admit(waiter.user)
+                waiter.granted = True
+                waiter.event.set()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+            }
+
+
+class Ticket:
+    """An admitted request's slot; release() is idempotent."""
+
+    def __init__(self, controller: AdmissionController, user: Optional[str]):
+        self._controller = controller
+        self._user = user
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._controller._release(self._user)
+
+
+class RateLimiter:
+    """Token bucket: `rate` acquisitions per second, bursts up to `burst`. Thread-safe.
+
+    acquire() reserves the next free slot and sleeps until it comes up, so
+    concurrent callers are spaced out evenly. rate <= 0 means unlimited.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a token; False (nothing reserved) if that would take longer than timeout."""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return False
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return True
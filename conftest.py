@@ -0,0 +1,45 @@
+"""Offline test setup: main running on the fake Vertex SDK.
+
+main reads its configuration and binds the Vertex SDK when it is imported,
+so tests get it from the `main` fixture instead of importing it. The fake
+is only installed once a test asks for it: test_rag.py and
+test_page_links.py talk to the real Vertex AI.
+"""
+import importlib
+import os
+
+import pytest
+
+import fake_vertex
+
+TEST_ENV = {
+    "GOOGLE_CLOUD_PROJECT": "test-project",
+    "RAG_CORPUS_RESOURCE": "projects/test-project/locations/us-central1/ragCorpora/1",
+    "WARMUP_ENABLED": "0",
+    "ANSWER_CACHE_BACKEND": "memory",
+    "BATCH_RATE_PER_SECOND": "0",
+}
+
+
+@pytest.fixture(scope="session")
+def fake():
+    """The live fake_vertex config; tests may count calls or inject faults on it."""
+    return fake_vertex.install(fake_vertex.FakeVertexConfig(retrieval_ms=1, generation_ms=1, dist="fixed"))
+
+
+@pytest.fixture(scope="session")
+def main(fake):
+    for name, value in TEST_ENV.items():
+        os.environ.setdefault(name, value)
+    return importlib.import_module("main")
+
+
+@pytest.fixture
+def signed_in_client(main):
+    """signed_in_client(user_id) -> a Flask test client whose session is signed in."""
+    def make(user_id="test-user"):
+        client = main.app.test_client()
+        with client.session_transaction() as s:
+            s["user"] = {"id": user_id, "name": user_id, "email": f"{user_id}@example.com"}
+        return client
+    return make
@@ -0,0 +1,159 @@
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def new_conversation_id() -> str:
+    """Opaque id kept in the session cookie; the history itself stays server-side."""
+    return secrets.token_urlsafe(24)
+
+
+class MemoryConversationStore:
+    """Per-conversation history in process memory.
+
+    Each conversation is a bounded deque, so appends are O(1) and old turns
+    fall off the front. Conversations are kept in access order, which makes
+    dropping idle ones a cheap walk from the oldest end.
+    """
+
+    def __init__(self, max_turns: int = 20, idle_ttl_seconds: float = 7200, max_conversations: int = 10000):
+        self.max_turns = max_turns
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._conversations: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def history(self, cid: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
+        with self._lock:
+            self._evict_idle()
+            item = self._touch(cid, create=False)
+            if item is None:
+                return []
+            turns = list(item)
+        return turns[-limit:] if limit else turns
+
+    def append(self, cid: str, user: str, bot: str) -> None:
+        with self._lock:
+            self._touch(cid, create=True).append({"user": user, "bot": bot})
+            self._evict_idle()
+
+    def clear(self, cid: str) -> None:
+        with self._lock:
+            self._conversations.pop(cid, None)
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def _touch(self, cid: str, create: bool):
+        entry = self._conversations.get(cid)
+        if entry is None:
+            if not create:
+                return None
+            entry = (deque(maxlen=self.max_turns), [0.0])
+            self._conversations[cid] = entry
+        entry[1][0] = time.monotonic()
+        self._conversations.move_to_end(cid)
+        return entry[0]
+
+    def _evict_idle(self) -> None:
+        cutoff = time.monotonic() - self.idle_ttl_seconds
+        while self._conversations:
+            cid, (_, last_used) = next(iter(self._conversations.items()))
+            if last_used[0] >= cutoff and len(self._conversations) <= self.max_conversations:
+                break
+            del self._conversations[cid]
+
+
+class SqliteConversationStore:
+    """Conversation history in a SQLite file shared by all workers on a host."""
+
+    # Idle conversations are swept every this many appends
+    SWEEP_EVERY = 200
+
+    def __init__(self, path: str, max_turns: int = 20, idle_ttl_seconds: float = 7200):
+        self.max_turns = max_turns
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._lock = threading.Lock()
+        self._appends = 0
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, cid TEXT NOT NULL,"
+            " user TEXT NOT NULL, bot TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS turns_cid ON turns (cid, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (cid TEXT PRIMARY KEY, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS conversations_last_used ON conversations (last_used)")
+
+    def history(self, cid: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
+        limit = min(limit or self.max_turns, self.max_turns)
+        with self._lock:
+            row = self._conn.execute("SELECT last_used FROM conversations WHERE cid = ?", (cid,)).fetchone()
+            if row is None or row[0] < time.time() - self.idle_ttl_seconds:
+                return []
+            self._conn.execute("UPDATE conversations SET last_used = ? WHERE cid = ?", (time.time(), cid))
+            rows = self._conn.execute(
+                "SELECT user, bot FROM turns WHERE cid = ? ORDER BY id DESC LIMIT ?", (cid, limit)
+            ).fetchall()
+        return [{"user": u, "bot": b} for u, b in reversed(rows)]
+
+    def append(self, cid: str, user: str, bot: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT INTO turns (cid, user, bot, created) VALUES (?, ?, ?, ?)", (cid, user, bot, now)
+                )
+                self._conn.execute(
+                    "INSERT INTO conversations (cid, last_used) VALUES (?, ?)"
+                    " ON CONFLICT(cid) DO UPDATE SET last_used = excluded.last_used",
+                    (cid, now),
+                )
+                # Trim to the newest max_turns rows of this conversation
+                self._conn.execute(
+                    "DELETE FROM turns WHERE cid = ? AND id <= ("
+                    " SELECT id FROM turns WHERE cid = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (cid, cid, self.max_turns),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._appends += 1
+            if self._appends % self.SWEEP_EVERY == 0:
+                self._evict_idle(now)
+
+    def clear(self, cid: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE cid = ?", (cid,))
+            self._conn.execute("DELETE FROM conversations WHERE cid = ?", (cid,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def _evict_idle(self, now: float) -> None:
+        cutoff = now - self.idle_ttl_seconds
+        self._conn.execute(
+            "DELETE FROM turns WHERE cid IN (SELECT cid FROM conversations WHERE last_used < ?)", (cutoff,)
+        )
+        self._conn.execute("DELETE FROM conversations WHERE last_used < ?", (cutoff,))
+
+
+def make_conversation_store(kind: str, max_turns: int, idle_ttl_seconds: float, sqlite_path: str):
+    kind = (kind or "memory").strip().lower()
+    if kind == "sqlite":
+        return SqliteConversationStore(sqlite_path, max_turns=max_turns, idle_ttl_seconds=idle_ttl_seconds)
+    if kind != "memory":
+        logger.warning(f"Unknown conversation store '{kind}', using memory")
+    return MemoryConversationStore(max_turns=max_turns, idle_ttl_seconds=idle_ttl_seconds)
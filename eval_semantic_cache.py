@@ -0,0 +1,152 @@
+"""Offline evaluation of the semantic query cache on a query log.
+
+The log is JSONL with one object per line holding a "query" and, optionally,
+a "label" naming the intent it belongs to. Queries are replayed in order: a
+miss inserts the query, and a hit is false when its label differs from the
+label of the cached query it matched.
+
+--country-swaps replays a built-in set instead: groups of paraphrases of one
+question, asked for several countries. Hits within a group and country are
+right; a hit on the same question for another country is a false hit. The
+false-hit rate is shown with the entity guard (as served) and without it.
+
+    python eval_semantic_cache.py queries.jsonl --thresholds 0.8,0.85,0.9,0.95
+    python eval_semantic_cache.py --country-swaps
+    python eval_semantic_cache.py --bench 50000
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+import numpy as np
+
+from semantic_cache import DEFAULT_CAPACITY, DEFAULT_THRESHOLD, SemanticCache, entity_key
+
+# Paraphrases of one question per group; {country} is filled in per country
+PARAPHRASE_GROUPS = [
+    ["tobacco ad rules {country}", "what are {country}'s tobacco advertising restrictions",
+     "tobacco advertising restrictions in {country}"],
+    ["health warning size {country}", "how big must health warnings be in {country}",
+     "what are the health warning size requirements on cigarette packs in {country}"],
+    ["can I sell e-cigarettes online in {country}", "is online sale of e-cigarettes allowed in {country}",
+     "e-cigarette online sales rules {country}"],
+    ["plain packaging rules in {country}", "what are the plain packaging requirements in {country}",
+     "does {country} have plain packaging laws"],
+    ["What are the rules on tobacco advertising on billboards and in print media in {country}?",
+     "Are billboard and print media tobacco adverts banned in {country}?"],
+    ["minimum age to buy tobacco in {country}", "what is the legal age for buying cigarettes in {country}"],
+]
+COUNTRIES = ["Poland", "Germany", "France", "Spain", "Italy", "Ireland", "Australia", "Canada", "Brazil", "Japan"]
+
+
+def country_swap_items(seed: int = 0):
+    """(query, label) pairs for every paraphrase x country, in a shuffled order."""
+    items = [(template.format(country=country), f"{group}:{country}")
+             for group, templates in enumerate(PARAPHRASE_GROUPS)
+             for template in templates for country in COUNTRIES]
+    random.Random(seed).shuffle(items)
+    return items
+
+
+def load_log(path):
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get("query"):
+                items.append((event["query"], event.get("label")))
+    return items
+
+
+def evaluate(items, threshold, capacity, dim, guard=True):
+    cache = SemanticCache(capacity=capacity, threshold=threshold, dim=dim)
+    hits = false_hits = labelled_hits = 0
+    latencies = []
+    for query, label in items:
+        start = time.perf_counter()
+        if guard:
+            cached = cache.lookup(query, namespace=0)
+        else:
+            slot, score = cache.search(cache.vectorizer.transform([query]), 0)
+            cached = cache._payloads[int(slot[0])] if slot[0] >= 0 and score[0] >= threshold else None
+        latencies.append(time.perf_counter() - start)
+        if cached is None:
+            cache.add(query, 0, {"query": query, "label": label})
+            continue
+        hits += 1
+        if label is not None and cached["label"] is not None:
+            labelled_hits += 1
+            if cached["label"] != label:
+                false_hits += 1
+    lat_us = np.array(latencies) * 1e6
+    return {
+        "threshold": threshold,
+        "queries": len(items),
+        "hit_rate": hits / len(items) if items else 0.0,
+        "false_hit_rate": false_hits / labelled_hits if labelled_hits else None,
+        "lookup_p50_us": float(np.percentile(lat_us, 50)) if len(lat_us) else 0.0,
+        "lookup_p99_us": float(np.percentile(lat_us, 99)) if len(lat_us) else 0.0,
+    }
+
+
+def bench_search(entries, dim, batch):
+    """Time single lookups (the request path) and batched top-1 search against a full cache."""
+    rng = random.Random(0)
+    cache = SemanticCache(capacity=entries, dim=dim)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(5000)]
+    for i in range(entries):
+        cache.add(" ".join(rng.choices(words, k=6)), 0, i)
+    texts = [" ".join(rng.choices(words, k=6)) for _ in range(batch)]
+    queries = cache.vectorizer.transform(texts)
+    entities = np.array([entity_key(t) for t in texts], dtype=np.int64)
+    single = []
+    for text in texts:
+        start = time.perf_counter()
+        cache.lookup(text, 0)
+        single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    cache.search(queries, 0, entities)
+    batched = time.perf_counter() - start
+    print(f"entries={entries} dim={dim}")
+    print(f"  single lookup p50: {np.percentile(single, 50) * 1e6:.0f} us, p99: {np.percentile(single, 99) * 1e6:.0f} us")
+    print(f"  batched search:    {batched / batch * 1e6:.0f} us/query (batch of {batch})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", nargs="?", help="JSONL query log")
+    parser.add_argument("--country-swaps", action="store_true", help="evaluate the built-in country-swap set")
+    parser.add_argument("--thresholds", default="0.7,0.75,0.8,0.85,0.9,0.95")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--bench", type=int, metavar="ENTRIES", help="benchmark search at this cache size")
+    parser.add_argument("--batch", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.bench:
+        bench_search(args.bench, args.dim, args.batch)
+    if args.country_swaps:
+        items = country_swap_items()
+    elif args.log:
+        items = load_log(args.log)
+    else:
+        return
+
+    thresholds = sorted({float(x) for x in args.thresholds.split(",")} | {DEFAULT_THRESHOLD})
+    print(f"{'threshold':>9} {'hit rate':>9} {'false hits':>10} {'no guard':>9} {'p50 us':>8} {'p99 us':>8}")
+    for t in thresholds:
+        r = evaluate(items, t, args.capacity, args.dim)
+        unguarded = evaluate(items, t, args.capacity, args.dim, guard=False)
+        fhr, raw = ("n/a" if x["false_hit_rate"] is None else f"{x['false_hit_rate']:.1%}" for x in (r, unguarded))
+        shipped = "  <- default" if t == DEFAULT_THRESHOLD else ""
+        print(f"{t:>9.2f} {r['hit_rate']:>9.1%} {fhr:>10} {raw:>9} {r['lookup_p50_us']:>8.0f} "
+              f"{r['lookup_p99_us']:>8.0f}{shipped}")
+
+
+if __name__ == "__main__":
+    main()
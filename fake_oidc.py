@@ -0,0 +1,132 @@
+"""Local stand-in for Google's OpenID Connect endpoints, for login tests and benchmarks.
+
+Serves discovery, JWKS, an authorization endpoint that signs the user in at
+once (redirecting back with a code), a token endpoint returning an RS256
+id_token, and userinfo. Every request sleeps `latency_ms` first, to play the
+part of the round trip to Google, and is counted per endpoint.
+
+    provider = FakeOIDCProvider(client_id="cid", client_secret="secret", latency_ms=80)
+    base_url = provider.start()   # OIDC_DISCOVERY_URL=f"{base_url}/.well-known/openid-configuration"
+    ...
+    provider.stop()
+"""
+import base64
+import secrets
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+from urllib.parse import urlencode
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import Flask, abort, jsonify, redirect, request
+from google.auth import crypt, jwt
+from werkzeug.serving import make_server
+
+
+def _b64(n: int) -> str:
+    raw = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+class FakeOIDCProvider:
+    def __init__(self, client_id: str = "fake-client-id", client_secret: str = "fake-client-secret",
+                 latency_ms: float = 0, user: Optional[Dict[str, Any]] = None, port: int = 0):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.latency_ms = latency_ms
+        self.user = user or {"sub": "1234567890", "name": "Test User", "email": "test.user@example.com",
+                             "email_verified": True, "picture": None}
+        self.calls: Counter = Counter()
+        self._codes = set()
+        self._lock = threading.Lock()
+        self.kid = secrets.token_hex(8)
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = self._key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption())
+        self._signer = crypt.RSASigner.from_string(pem, key_id=self.kid)
+        self._port = port
+        self._server = None
+        self.base_url = ""
+        self.app = self._build_app()
+
+    def id_token(self, **overrides: Any) -> str:
+        """A signed id_token for self.user; overrides replace claims (e.g. exp, aud)."""
+        now = int(time.time())
+        claims = {"iss": self.base_url, "aud": self.client_id, "iat": now, "exp": now + 3600,
+                  **{k: v for k, v in self.user.items() if v is not None}}
+        claims.update(overrides)
+        return jwt.encode(self._signer, claims).decode()
+
+    def _build_app(self) -> Flask:
+        app = Flask("fake_oidc")
+
+        @app.before_request
+        def _latency():
+            self.calls[request.endpoint] += 1
+            if self.latency_ms:
+                time.sleep(self.latency_ms / 1000)
+
+        @app.get("/.well-known/openid-configuration")
+        def discovery():
+            resp = jsonify(
+                issuer=self.base_url,
+                authorization_endpoint=f"{self.base_url}/authorize",
+                token_endpoint=f"{self.base_url}/token",
+                userinfo_endpoint=f"{self.base_url}/userinfo",
+                jwks_uri=f"{self.base_url}/certs",
+            )
+            resp.headers["Cache-Control"] = "public, max-age=3600"
+            return resp
+
+        @app.get("/certs")
+        def certs():
+            numbers = self._key.public_key().public_numbers()
+            resp = jsonify(keys=[{"kty": "RSA", "alg": "RS256", "use": "sig", "kid": self.kid,
+                                  "n": _b64(numbers.n), "e": _b64(numbers.e)}])
+            resp.headers["Cache-Control"] = "public, max-age=3600"
+            return resp
+
+        @app.get("/authorize")
+        def authorize():
+            if request.args.get("client_id") != self.client_id:
+                abort(400)
+            code = secrets.token_urlsafe(16)
+            with self._lock:
+                self._codes.add(code)
+            query = urlencode({"code": code, "state": request.args.get("state", "")})
+            return redirect(f"{request.args['redirect_uri']}?{query}")
+
+        @app.post("/token")
+        def token():
+            form = request.form
+            if form.get("client_id") != self.client_id or form.get("client_secret") != self.client_secret:
+                return jsonify(error="invalid_client"), 401
+            with self._lock:
+                known = form.get("code") in self._codes
+                self._codes.discard(form.get("code"))
+            if not known:
+                return jsonify(error="invalid_grant"), 400
+            return jsonify(access_token=secrets.token_urlsafe(24), token_type="Bearer", expires_in=3599,
+                           scope="openid email profile", id_token=self.id_token())
+
+        @app.get("/userinfo")
+        def userinfo():
+            if not request.headers.get("Authorization", "").startswith("Bearer "):
+                abort(401)
+            return jsonify({k: v for k, v in self.user.items() if v is not None})
+
+        return app
+
+    def start(self) -> str:
+        """Serve in a background thread; returns the base URL (also the issuer)."""
+        self._server = make_server("127.0.0.1", self._port, self.app, threaded=True)
+        self.base_url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, name="fake-oidc", daemon=True).start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
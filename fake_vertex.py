@@ -0,0 +1,325 @@
+"""In-process stand-in for the parts of the Vertex AI SDK that main.py uses.
+
+Call install() before importing main: it registers fake `vertexai`,
+`vertexai.generative_models` and `vertexai.rag` modules. Retrieval returns
+realistic contexts (with chunk.page_span), generation returns an answer with
+grounding_chunks/grounding_supports when the RAG tool is attached, or [n]
+markers when it isn't, and every call sleeps for a latency drawn from a
+configurable distribution. No network access or credentials are needed.
+
+Faults can be injected too: a share of calls failing with 429/503, a share
+of calls taking several times longer (tail latency), or a full outage.
+
+All knobs can be set through FAKE_VERTEX_* environment variables (see
+FakeVertexConfig.from_env), which is how gunicorn-based benchmarks pass them.
+"""
+import math
+import os
+import random
+import sys
+import threading
+import time
+import types
+from types import SimpleNamespace
+from typing import List
+
+try:
+    from google.api_core import exceptions as _api_exceptions
+except ImportError:
+    _api_exceptions = None
+
+_WORDS = (
+    "tobacco product advertising sponsorship packaging health warning retail display "
+    "member state directive article paragraph regulation prohibited permitted label "
+    "nicotine cigarette heated electronic vending sale minors marketing communication "
+    "pictorial text surface area unit packet market authority penalty compliance"
+).split()
+
+
+class FakeVertexConfig:
+    """Latency and payload shape of the fake backend.
+
+    Latencies are medians in milliseconds. With dist="lognormal" each call draws
+    from a log-normal distribution around the median with shape `sigma` (0.5
+    gives a p95 of ~2.3x the median); "fixed" always uses the median.
+
+    Faults: each call fails with HTTP `error_code` (429 or 503) with
+    probability `error_rate`, and takes `slow_factor` times longer with
+    probability `slow_rate`. `outage` makes every call fail; it can be
+    flipped at runtime. `faults` limits them to "retrieval", "generation" or
+    "both".
+    """
+
+    def __init__(self, retrieval_ms: float = 300, generation_ms: float = 1500, dist: str = "lognormal",
+                 sigma: float = 0.5, stream_chunks: int = 8, context_chars: int = 1500,
+                 answer_sentences: int = 8, documents: int = 40, seed: int = None,
+                 error_rate: float = 0.0, error_code: int = 503, slow_rate: float = 0.0,
+                 slow_factor: float = 10.0, outage: bool = False, faults: str = "both"):
+        self.retrieval_ms = retrieval_ms
+        self.generation_ms = generation_ms
+        self.dist = dist
+        self.sigma = sigma
+        self.stream_chunks = stream_chunks
+        self.context_chars = context_chars
+        self.answer_sentences = answer_sentences
+        self.documents = documents
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.outage = outage
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.calls = {"retrieval": 0, "generation": 0}
+        self.errors = {"retrieval": 0, "generation": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FakeVertexConfig":
+        env = os.environ.get
+        seed = env("FAKE_VERTEX_SEED")
+        return cls(
+            retrieval_ms=float(env("FAKE_VERTEX_RETRIEVAL_MS", "300")),
+            generation_ms=float(env("FAKE_VERTEX_GENERATION_MS", "1500")),
+            dist=env("FAKE_VERTEX_LATENCY_DIST", "lognormal"),
+            sigma=float(env("FAKE_VERTEX_SIGMA", "0.5")),
+            stream_chunks=int(env("FAKE_VERTEX_STREAM_CHUNKS", "8")),
+            context_chars=int(env("FAKE_VERTEX_CONTEXT_CHARS", "1500")),
+            answer_sentences=int(env("FAKE_VERTEX_ANSWER_SENTENCES", "8")),
+            documents=int(env("FAKE_VERTEX_DOCUMENTS", "40")),
+            seed=int(seed) if seed else None,
+            error_rate=float(env("FAKE_VERTEX_ERROR_RATE", "0")),
+            error_code=int(env("FAKE_VERTEX_ERROR_CODE", "503")),
+            slow_rate=float(env("FAKE_VERTEX_SLOW_RATE", "0")),
+            slow_factor=float(env("FAKE_VERTEX_SLOW_FACTOR", "10")),
+            outage=env("FAKE_VERTEX_OUTAGE", "0") == "1",
+            faults=env("FAKE_VERTEX_FAULTS", "both"),
+        )
+
+    def latency(self, median_ms: float) -> float:
+        """Seconds to sleep for one call."""
+        if median_ms <= 0:
+            return 0.0
+        with self._lock:
+            if self.dist == "lognormal":
+                seconds = self.rng.lognormvariate(math.log(median_ms), self.sigma) / 1000
+            else:
+                seconds = median_ms / 1000
+            if self.slow_rate and self.rng.random() < self.slow_rate:
+                seconds *= self.slow_factor
+        return seconds
+
+    def count(self, kind: str) -> None:
+        """Count a call and raise the injected fault, if this call gets one."""
+        with self._lock:
+            self.calls[kind] += 1
+            fail = self.faults in (kind, "both") and (
+                self.outage or (self.error_rate and self.rng.random() < self.error_rate))
+            if fail:
+                self.errors[kind] += 1
+        if fail:
+            raise _fault(self.error_code, f"injected {kind} fault")
+
+
+class FakeVertexError(Exception):
+    """Stand-in for google.api_core errors when that package is missing."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+def _fault(code: int, message: str) -> Exception:
+    if _api_exceptions is not None:
+        return _api_exceptions.from_http_status(code, message)
+    return FakeVertexError(code, message)
+
+
+config = FakeVertexConfig()
+
+
+def _text(rng: random.Random, chars: int) -> str:
+    words = []
+    size = 0
+    while size < chars:
+        w = rng.choice(_WORDS)
+        words.append(w)
+        size += len(w) + 1
+    return " ".join(words)[:chars].rstrip() + "."
+
+
+def _contexts(query: str, top_k: int, corpus: str = "") -> List[SimpleNamespace]:
+    # Deterministic per corpus and query, so repeated questions retrieve the same chunks
+    rng = random.Random(f"{corpus}|{query}")
+    docs = rng.sample(range(config.documents), min(top_k, config.documents))
+    out = []
+    for rank, doc in enumerate(docs):
+        first = rng.randint(1, 120)
+        last = first + rng.choice((0, 0, 1, 2))
+        out.append(SimpleNamespace(
+            source_uri=f"gs://fake-legal-docs/regulation-{doc:03d}.pdf",
+            source_display_name=f"Tobacco Regulation {doc:03d}",
+            text=_text(rng, config.context_chars),
+            # Cosine distance, like a RagManagedDb corpus: lower is more relevant
+            score=round(0.1 + rank * 0.04 + rng.random() * 0.02, 4),
+            chunk=SimpleNamespace(page_span=SimpleNamespace(first_page=first, last_page=last)),
+        ))
+    return out
+
+
+def _answer_sentences(prompt: str) -> List[str]:
+    rng = random.Random(str(prompt)[-200:])
+    return [
+        f"{rng.choice(_WORDS).capitalize()} {_text(rng, rng.randint(60, 160))}"
+        for _ in range(max(1, config.answer_sentences))
+    ]
+
+
+class FakeResponse:
+    """Mimics GenerationResponse: .text, .candidates, .usage_metadata and .to_dict()."""
+
+    def __init__(self, text: str, chunks=None, supports=None, prompt_tokens: int = 0):
+        self.text = text
+        self._chunks = chunks or []
+        self._supports = supports or []
+        grounding = None
+        if self._chunks:
+            grounding = SimpleNamespace(
+                grounding_chunks=[
+                    SimpleNamespace(retrieved_context=SimpleNamespace(**c)) for c in self._chunks
+                ],
+                grounding_supports=[
+                    SimpleNamespace(segment=SimpleNamespace(**s["segment"]),
+                                    grounding_chunk_indices=s["grounding_chunk_indices"])
+                    for s in self._supports
+                ],
+            )
+        self.candidates = [SimpleNamespace(grounding_metadata=grounding)]
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens, cached_content_token_count=0,
+            candidates_token_count=len(text) // 4,
+        )
+
+    def to_dict(self):
+        cand = {"content": {"role": "model", "parts": [{"text": self.text}]}}
+        if self._chunks:
+            cand["grounding_metadata"] = {
+                "grounding_chunks": [{"retrieved_context": dict(c)} for c in self._chunks],
+                "grounding_supports": [dict(s) for s in self._supports],
+            }
+        return {"candidates": [cand]}
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name=None, tools=None, system_instruction=None, **_kwargs):
+        self.model_name = model_name
+        self.tools = tools or []
+        self.system_instruction = system_instruction
+
+    def _top_k(self) -> int:
+        for tool in self.tools:
+            source = getattr(getattr(tool, "retrieval", None), "source", None)
+            cfg = getattr(source, "rag_retrieval_config", None)
+            if cfg is not None:
+                return getattr(cfg, "top_k", 5) or 5
+        return 0
+
+    def _corpus(self) -> str:
+        for tool in self.tools:
+            source = getattr(getattr(tool, "retrieval", None), "source", None)
+            for resource in getattr(source, "rag_resources", None) or []:
+                return getattr(resource, "rag_corpus", "") or ""
+        return ""
+
+    def _build(self, prompt: str):
+        """Return (text, chunks, supports) for the whole answer."""
+        sentences = _answer_sentences(prompt)
+        top_k = self._top_k()
+        if not top_k:
+            # No RAG tool: cite the prompt's numbered excerpts inline
+            n = len([line for line in str(prompt).splitlines() if line.startswith("[")]) or 1
+            rng = random.Random(str(prompt)[:200])
+            return " ".join(f"{s} [{rng.randint(1, n)}]" for s in sentences), [], []
+        query = str(prompt).rsplit("Current User Query:", 1)[-1].strip()
+        chunks = [
+            {"uri": c.source_uri, "title": c.source_display_name, "text": c.text}
+            for c in _contexts(query, top_k, self._corpus())
+        ]
+        rng = random.Random(query)
+        text = ""
+        supports = []
+        for s in sentences:
+            start = len(text.encode("utf-8"))
+            text += s + " "
+            end = start + len(s.encode("utf-8"))
+            supports.append({
+                "segment": {"start_index": start, "end_index": end, "text": s},
+                "grounding_chunk_indices": sorted(rng.sample(range(len(chunks)), min(2, len(chunks)))),
+            })
+        return text.rstrip(), chunks, supports
+
+    def generate_content(self, prompt, stream: bool = False):
+        config.count("generation")
+        text, chunks, supports = self._build(prompt)
+        prompt_tokens = len(str(prompt)) // 4
+        if stream:
+            return self._stream(text, chunks, supports, prompt_tokens)
+        time.sleep(config.latency(config.generation_ms))
+        return FakeResponse(text, chunks, supports, prompt_tokens)
+
+    def _stream(self, text, chunks, supports, prompt_tokens):
+        n = max(1, config.stream_chunks)
+        total = config.latency(config.generation_ms)
+        step = -(-len(text) // n)
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        for i, piece in enumerate(pieces):
+            time.sleep(total / len(pieces))
+            last = i == len(pieces) - 1
+            # Grounding metadata arrives with the final chunk
+            yield FakeResponse(piece, chunks if last else None, supports if last else None, prompt_tokens)
+
+
+class FakeTool:
+    @classmethod
+    def from_retrieval(cls, retrieval):
+        tool = cls()
+        tool.retrieval = retrieval
+        return tool
+
+
+def _retrieval_query(rag_resources=None, text="", rag_retrieval_config=None, **_kwargs):
+    config.count("retrieval")
+    time.sleep(config.latency(config.retrieval_ms))
+    top_k = getattr(rag_retrieval_config, "top_k", 5) or 5
+    corpus = getattr(rag_resources[0], "rag_corpus", "") if rag_resources else ""
+    return SimpleNamespace(contexts=SimpleNamespace(contexts=_contexts(text, top_k, corpus)))
+
+
+def install(cfg: FakeVertexConfig = None) -> FakeVertexConfig:
+    """Register the fake SDK modules; returns the live config (mutable)."""
+    global config
+    if cfg is not None:
+        config = cfg
+
+    vertexai = types.ModuleType("vertexai")
+    vertexai.init = lambda **_kwargs: None
+
+    generative_models = types.ModuleType("vertexai.generative_models")
+    generative_models.GenerativeModel = FakeGenerativeModel
+    generative_models.Tool = FakeTool
+
+    rag = types.ModuleType("vertexai.rag")
+    rag.RagResource = lambda **kwargs: SimpleNamespace(**kwargs)
+    rag.RagRetrievalConfig = lambda **kwargs: SimpleNamespace(**kwargs)
+    rag.VertexRagStore = lambda **kwargs: SimpleNamespace(**kwargs)
+    rag.Retrieval = lambda **kwargs: SimpleNamespace(**kwargs)
+    rag.retrieval_query = _retrieval_query
+
+    vertexai.generative_models = generative_models
+    vertexai.rag = rag
+    sys.modules.update({
+        "vertexai": vertexai,
+        "vertexai.generative_models": generative_models,
+        "vertexai.rag": rag,
+    })
+    return config
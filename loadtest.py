@@ -0,0 +1,153 @@
+"""Load test /chat on one gunicorn instance backed by the fake Vertex SDK.
+
+Starts gunicorn with the app wired to fake_vertex (so every request waits on
+simulated Vertex latency instead of the real service), drives /chat from many
+concurrent clients with pre-signed login sessions, and reports requests/sec
+and the status mix (200 vs. 429/503 rejections).
+
+    python loadtest.py --mode sync --concurrency 16 --duration 20
+    python loadtest.py --mode gthread --threads 40 --concurrency 64 --duration 20
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+SECRET_KEY = "loadtest-secret"
+
+
+def create_app():
+    """gunicorn entry point: the real app on top of the fake Vertex SDK."""
+    import fake_vertex
+    fake_vertex.install(fake_vertex.FakeVertexConfig.from_env())
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "loadtest")
+    os.environ.setdefault("RAG_CORPUS_RESOURCE", "projects/loadtest/locations/us-central1/ragCorpora/1")
+    import main
+    return main.app
+
+
+def session_cookie(user_id: str, secret_key: str = SECRET_KEY) -> str:
+    """A signed Flask session cookie for a logged-in user (login bypass)."""
+    from flask import Flask
+    from flask.sessions import SecureCookieSessionInterface
+    app = Flask("loadtest")
+    app.secret_key = secret_key
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    return serializer.dumps({"user": {"id": user_id, "name": user_id, "email": f"{user_id}@example.com"}})
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, mode: str, threads: int, env: dict, log=None) -> subprocess.Popen:
+    """Start gunicorn and wait for /healthz; server output goes to `log` (a file) when given."""
+    cmd = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", "1",
+           "--timeout", "120", "--log-level", "warning"]
+    if mode == "gthread":
+        cmd += ["--worker-class", "gthread", "--threads", str(threads)]
+    cmd.append("loadtest:create_app()")
+    proc = subprocess.Popen(cmd, env={**os.environ, **env, "SECRET_KEY": SECRET_KEY},
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=log, stderr=log)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/healthz", timeout=1).ok:
+                return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("server did not come up")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_clients(base_url: str, concurrency: int, duration: float):
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client(n: int):
+        http = requests.Session()
+        http.cookies.set("session", session_cookie(f"user-{n}"))
+        i = 0
+        while time.time() < stop_at:
+            i += 1
+            start = time.perf_counter()
+            try:
+                # Unique questions so the answer/retrieval caches don't absorb the load
+                resp = http.post(f"{base_url}/chat", json={"message": f"load question {n}-{i}"}, timeout=120)
+                status = resp.status_code
+            except requests.RequestException:
+                status = "error"
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(elapsed)
+            if status in (429, 503):
+                time.sleep(0.1)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return statuses, latencies, time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["sync", "gthread"], default="gthread")
+    parser.add_argument("--threads", type=int, default=40, help="gunicorn threads (gthread mode)")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--retrieval-ms", type=float, default=300)
+    parser.add_argument("--generation-ms", type=float, default=1500)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    parser.add_argument("--max-queue", type=int, default=16)
+    args = parser.parse_args()
+
+    port = free_port()
+    env = {
+        "FAKE_VERTEX_RETRIEVAL_MS": str(args.retrieval_ms),
+        "FAKE_VERTEX_GENERATION_MS": str(args.generation_ms),
+        "MAX_IN_FLIGHT_CHATS": str(args.max_in_flight),
+        "MAX_QUEUED_CHATS": str(args.max_queue),
+        "MAX_IN_FLIGHT_PER_USER": "0",
+        "CHAT_EXECUTOR_WORKERS": str(2 * args.max_in_flight),
+        "ANSWER_CACHE_BACKEND": "off",
+        "RETRIEVAL_CACHE_MAX_ENTRIES": "0",
+    }
+    server = start_server(port, args.mode, args.threads, env)
+    try:
+        statuses, latencies, elapsed = run_clients(f"http://127.0.0.1:{port}", args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+    ok = statuses.get(200, 0)
+    print(f"mode={args.mode} threads={args.threads if args.mode == 'gthread' else 1} "
+          f"clients={args.concurrency} duration={elapsed:.1f}s")
+    print(f"  throughput: {ok / elapsed:.2f} req/s (200 OK)")
+    print(f"  latency:    p50 {percentile(latencies, 50):.2f}s  p95 {percentile(latencies, 95):.2f}s")
+    print(f"  statuses:   {dict(statuses)}")
+
+
+if __name__ == "__main__":
+    main()
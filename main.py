@@ -1,20 +1,39 @@
 import os
+import re
+import hmac
+import json
+import time
 import logging
-from typing import Any, Dict, List, Tuple
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 from functools import wraps
 
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
-import requests
+from flask import Flask, Response, g, request, jsonify, make_response, render_template, session, redirect, url_for, stream_with_context
 from requests_oauthlib import OAuth2Session
 
+from cache import AnswerCache, RetrievalCache, hash_parts, make_backend, normalize_query
+from compression import StaticCompressionCache, compress_response
+from concurrency import AdmissionController, Overloaded, RateLimiter
+from conversation_store import make_conversation_store, new_conversation_id
+from metrics import Registry, StageTimer
+from oidc import OIDCProvider, make_session
+from query_log import QueryLogRecorder
+from retrieval_policy import DepthPolicy, skip_reason
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCall, is_retryable
+from sharding import Shard, merge_contexts, parse_shards, route
+from singleflight import SharedStream, SingleFlight, Waiter
+
 load_dotenv()
 # Only disable HTTPS requirement for local development
 if os.environ.get('FLASK_ENV') == 'development':
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-import vertexai
-from vertexai.generative_models import GenerativeModel, Tool
-from vertexai import rag
+# The Vertex AI SDK takes seconds to import; it is loaded by vertex_sdk() on
+# first use (normally by the background warm-up) so gunicorn binds right away
+if TYPE_CHECKING:
+    from vertexai.generative_models import GenerativeModel, Tool
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,27 +42,404 @@ PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("PROJECT_I
 LOCATION = os.environ.get("VERTEX_LOCATION", "us-central1")
 MODEL_NAME = os.environ.get("VERTEX_MODEL_NAME", "gemini-2.0-flash-001")
 RAG_CORPUS = os.environ.get("RAG_CORPUS_RESOURCE")
+# Sharded corpora, e.g. "eu=projects/p/locations/europe-west3/ragCorpora/1,apac=...".
+# Retrieval fans out to the shards routed for the query (by the countries or
+# regions it names, when RAG_ROUTING_ENABLED) and merges a global top-k;
+# shards slower than RAG_SHARD_TIMEOUT_MS are left out. RAG_SCORE_ORDER says
+# how the corpora score contexts: "distance" (lower is better) or "similarity"
+RAG_SHARDS = parse_shards(os.environ.get("RAG_CORPORA", ""))
+RAG_ROUTING_ENABLED = os.environ.get("RAG_ROUTING_ENABLED", "1") == "1"
+RAG_SHARD_TIMEOUT_S = float(os.environ.get("RAG_SHARD_TIMEOUT_MS", "4000")) / 1000
+RAG_SCORE_HIGHER_IS_BETTER = os.environ.get("RAG_SCORE_ORDER", "distance").strip().lower() == "similarity"
+if RAG_SHARDS:
+    # Identifies the whole shard set in cache and single-flight keys
+    RAG_CORPUS = ",".join(f"{s.name}={s.corpus}" for s in RAG_SHARDS)
+elif RAG_CORPUS:
+    # Queried through the vertexai.init location, as before sharding
+    RAG_SHARDS = [Shard("default", RAG_CORPUS, None)]
+# How answers get grounded:
+#   "tool"   - Gemini re-runs retrieval through the RAG tool and returns grounding metadata
+#   "inline" - contexts from retrieve_contexts() are retrieved once and passed in the prompt
+GROUNDING_MODE = os.environ.get("RAG_GROUNDING_MODE", "tool").strip().lower()
 
 # OAuth Configuration
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
-GOOGLE_DISCOVERY_URL = "https://accounts.google.com/.well-known/openid_configuration"
-AUTHORIZATION_BASE_URL = "https://accounts.google.com/o/oauth2/auth"
-TOKEN_URL = "https://oauth2.googleapis.com/token"
-USERINFO_URL = "https://openidconnect.googleapis.com/v1/userinfo"
+GOOGLE_DISCOVERY_URL = os.environ.get("OIDC_DISCOVERY_URL",
+                                      "https://accounts.google.com/.well-known/openid-configuration")
+# Discovery and signing keys are cached for their max-age (else this TTL);
+# the login calls share a keep-alive pool of OIDC_HTTP_POOL_SIZE connections
+OIDC_CACHE_TTL_S = float(os.environ.get("OIDC_CACHE_TTL_SECONDS", "3600"))
+OIDC_HTTP_TIMEOUT_S = float(os.environ.get("OIDC_HTTP_TIMEOUT_SECONDS", "10"))
+OIDC_HTTP_POOL_SIZE = int(os.environ.get("OIDC_HTTP_POOL_SIZE", "10"))
 
 if not PROJECT_ID or not RAG_CORPUS:
-    logger.warning("Missing GOOGLE_CLOUD_PROJECT/PROJECT_ID or RAG_CORPUS_RESOURCE.")
+    logger.warning("Missing GOOGLE_CLOUD_PROJECT/PROJECT_ID or RAG_CORPUS_RESOURCE/RAG_CORPORA.")
+
+# Per-stage deadlines (seconds) and the size of the pool that runs Vertex calls
+RETRIEVAL_TIMEOUT_S = float(os.environ.get("RETRIEVAL_TIMEOUT_SECONDS", "10"))
+GENERATION_TIMEOUT_S = float(os.environ.get("GENERATION_TIMEOUT_SECONDS", "60"))
+CHAT_EXECUTOR_WORKERS = int(os.environ.get("CHAT_EXECUTOR_WORKERS", "32"))
+# Retrieval depth: the client's top_k (RETRIEVAL_DEFAULT_TOP_K when missing) is
+# capped at RETRIEVAL_MAX_TOP_K. With ADAPTIVE_RETRIEVAL_ENABLED, greetings and
+# small talk skip retrieval, and in inline mode other queries retrieve
+# RETRIEVAL_INITIAL_TOP_K chunks first, then top_k when the best score is worse
+# than RETRIEVAL_LOW_CONFIDENCE_SCORE or the first scores are within
+# RETRIEVAL_FLAT_TAIL_DELTA of each other (scores in RAG_SCORE_ORDER). Tool mode
+# always retrieves top_k, the depth Gemini's RAG tool grounds on.
+ADAPTIVE_RETRIEVAL_ENABLED = os.environ.get("ADAPTIVE_RETRIEVAL_ENABLED", "1") == "1"
+RETRIEVAL_DEFAULT_TOP_K = int(os.environ.get("RETRIEVAL_DEFAULT_TOP_K", "5"))
+RETRIEVAL_MAX_TOP_K = int(os.environ.get("RETRIEVAL_MAX_TOP_K", "10"))
+RETRIEVAL_INITIAL_TOP_K = int(os.environ.get("RETRIEVAL_INITIAL_TOP_K", "3"))
+RETRIEVAL_LOW_CONFIDENCE_SCORE = float(os.environ.get("RETRIEVAL_LOW_CONFIDENCE_SCORE", "0.5"))
+RETRIEVAL_FLAT_TAIL_DELTA = float(os.environ.get("RETRIEVAL_FLAT_TAIL_DELTA", "0.03"))
+# Share one Vertex call between concurrent identical retrievals/generations
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+# Vertex resilience: transient errors (429/5xx) are retried with jittered
+# backoff inside the stage deadline. When CIRCUIT_FAILURE_RATIO of the recent
+# calls (at least CIRCUIT_MIN_CALLS) failed, a circuit breaker fails fast
+# until the cool-down ends (ratio 0 disables it)
+VERTEX_RETRY_ATTEMPTS = int(os.environ.get("VERTEX_RETRY_ATTEMPTS", "3"))
+VERTEX_RETRY_BASE_DELAY_S = float(os.environ.get("VERTEX_RETRY_BASE_DELAY_MS", "200")) / 1000
+VERTEX_RETRY_MAX_DELAY_S = float(os.environ.get("VERTEX_RETRY_MAX_DELAY_MS", "2000")) / 1000
+CIRCUIT_FAILURE_RATIO = float(os.environ.get("CIRCUIT_FAILURE_RATIO", "0.5"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_RESET_S = float(os.environ.get("CIRCUIT_RESET_SECONDS", "30"))
+# Hedged retrieval: start a second identical query once the first has run
+# longer than this quantile of recent retrieval latencies
+RETRIEVAL_HEDGE_ENABLED = os.environ.get("RETRIEVAL_HEDGE_ENABLED", "0") == "1"
+RETRIEVAL_HEDGE_QUANTILE = float(os.environ.get("RETRIEVAL_HEDGE_QUANTILE", "0.95"))
+RETRIEVAL_HEDGE_MIN_DELAY_S = float(os.environ.get("RETRIEVAL_HEDGE_MIN_DELAY_MS", "50")) / 1000
+# Admission control for chat requests: in-flight limit per process, waiting
+# queue depth and how long a request may wait, and a per-user in-flight cap
+MAX_IN_FLIGHT_CHATS = int(os.environ.get("MAX_IN_FLIGHT_CHATS", "16"))
+MAX_QUEUED_CHATS = int(os.environ.get("MAX_QUEUED_CHATS", "16"))
+CHAT_QUEUE_TIMEOUT_S = float(os.environ.get("CHAT_QUEUE_TIMEOUT_SECONDS", "10"))
+MAX_IN_FLIGHT_PER_USER = int(os.environ.get("MAX_IN_FLIGHT_PER_USER", "4"))
+
+# /chat/batch: up to BATCH_MAX_ITEMS questions per request, BATCH_CONCURRENCY
+# of them answered at once, and at most BATCH_RATE_PER_SECOND items started
+# per second across all batches on the instance (0 = unlimited). Each question
+# takes its own admission slot, so a batch never runs more than the user's
+# MAX_IN_FLIGHT_PER_USER minus one (kept for their interactive chats); with
+# MAX_IN_FLIGHT_PER_USER=1 batches are refused with 429
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_RATE_PER_S = float(os.environ.get("BATCH_RATE_PER_SECOND", "2"))
+
+# Answer cache: "memory", "sqlite" (a file shared by all workers on the host) or "off".
+# Bump RAG_CORPUS_VERSION whenever documents are re-ingested.
+ANSWER_CACHE_BACKEND = os.environ.get("ANSWER_CACHE_BACKEND", "memory")
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_TTL_S = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_SQLITE_PATH = os.environ.get("ANSWER_CACHE_SQLITE_PATH", "/tmp/policy_bot_answers.sqlite")
+RAG_CORPUS_VERSION = os.environ.get("RAG_CORPUS_VERSION", "")
+# Retrieval cache for parsed retrieve_contexts() results (0 entries disables it)
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", "2048"))
+RETRIEVAL_CACHE_TTL_S = float(os.environ.get("RETRIEVAL_CACHE_TTL_SECONDS", "3600"))
+# Optional paraphrase cache for first-turn questions (needs numpy). A hit also
+# needs the same places and numbers in the question, whatever the threshold.
+# Lookup time grows with SEMANTIC_CACHE_CAPACITY (p99 under 0.5 ms at 4096)
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+SEMANTIC_CACHE_CAPACITY = int(os.environ.get("SEMANTIC_CACHE_CAPACITY", "4096"))
+SEMANTIC_CACHE_DIM = int(os.environ.get("SEMANTIC_CACHE_DIM", "128"))
+
+# Server-side conversation history; the session cookie only carries an opaque id.
+# "memory" (per process) or "sqlite" (a file shared by all workers on the host).
+# Neither is shared between instances: on Cloud Run keep session affinity on
+# (terraform/main.tf), and expect a conversation to lose its history when its
+# instance is recycled or scaled in.
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "memory")
+CONVERSATION_SQLITE_PATH = os.environ.get("CONVERSATION_SQLITE_PATH", "/tmp/policy_bot_conversations.sqlite")
+CONVERSATION_MAX_TURNS = int(os.environ.get("CONVERSATION_MAX_TURNS", "20"))
+CONVERSATION_BOT_CHARS = int(os.environ.get("CONVERSATION_BOT_CHARS", "2000"))
+CONVERSATION_IDLE_TTL_S = float(os.environ.get("CONVERSATION_IDLE_TTL_SECONDS", "7200"))
+
+# Prompt assembly: estimated-token budget for conversation history
+PROMPT_HISTORY_TOKEN_BUDGET = int(os.environ.get("PROMPT_HISTORY_TOKEN_BUDGET", "1500"))
+
+# Observability: Prometheus /metrics (optionally behind a bearer token), and the
+# per-request stage breakdown as a Server-Timing header and/or a log line.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "1") == "1"
+TIMING_LOGS_ENABLED = os.environ.get("TIMING_LOGS_ENABLED", "1") == "1"
+# Query log (opt-in): one JSONL event per /chat and /chat/stream request, written
+# off the request path to rotating files in QUERY_LOG_DIR, for replay_queries.py.
+# The raw query text is logged unredacted. User and conversation ids are stored
+# as hashes salted with QUERY_LOG_SALT, which is required: without it (or set to
+# SECRET_KEY) the log stays off
+QUERY_LOG_ENABLED = os.environ.get("QUERY_LOG_ENABLED", "0") == "1"
+QUERY_LOG_DIR = os.environ.get("QUERY_LOG_DIR", "/tmp/policy_bot_query_log")
+QUERY_LOG_MAX_BYTES = int(float(os.environ.get("QUERY_LOG_MAX_MB", "50")) * 1024 * 1024)
+QUERY_LOG_BACKUPS = int(os.environ.get("QUERY_LOG_BACKUPS", "10"))
+QUERY_LOG_SALT = os.environ.get("QUERY_LOG_SALT", "")
+
+# Response size: compact (v2) /chat payloads cut context texts to
+# COMPACT_PREVIEW_CHARS, and JSON/static responses of at least
+# RESPONSE_COMPRESSION_MIN_BYTES are sent brotli/gzip encoded when accepted.
+COMPACT_PREVIEW_CHARS = int(os.environ.get("COMPACT_PREVIEW_CHARS", "200"))
+RESPONSE_COMPRESSION = os.environ.get("RESPONSE_COMPRESSION", "1") == "1"
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "512"))
+
+# Warm-up: after binding, import the Vertex SDK, build the shared clients, run
+# one small retrieval and prefetch the OIDC discovery document and keys in the
+# background; /readyz turns 200 when done. Each step may take at most
+# WARMUP_STEP_TIMEOUT_SECONDS, so the four of them finish well inside the
+# startup probe's 30 s
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+WARMUP_QUERY = os.environ.get("WARMUP_QUERY", "tobacco advertising restrictions")
+WARMUP_STEP_TIMEOUT_S = float(os.environ.get("WARMUP_STEP_TIMEOUT_SECONDS", "5"))
+
+if GROUNDING_MODE not in ("tool", "inline"):
+    logger.warning(f"Unknown RAG_GROUNDING_MODE '{GROUNDING_MODE}', falling back to 'tool'.")
+    GROUNDING_MODE = "tool"
+
+if QUERY_LOG_ENABLED and (not QUERY_LOG_SALT or QUERY_LOG_SALT == os.environ.get("SECRET_KEY")):
+    logger.error("QUERY_LOG_ENABLED=1 needs its own QUERY_LOG_SALT (not SECRET_KEY); the query log stays off.")
+    QUERY_LOG_ENABLED = False
+
+_chat_executor = ThreadPoolExecutor(max_workers=CHAT_EXECUTOR_WORKERS, thread_name_prefix="chat")
+
+_answer_backend = make_backend(ANSWER_CACHE_BACKEND, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_S, ANSWER_CACHE_SQLITE_PATH)
+answer_cache = AnswerCache(_answer_backend, RAG_CORPUS_VERSION) if _answer_backend is not None else None
+retrieval_cache = (
+    RetrievalCache(RETRIEVAL_CACHE_MAX_ENTRIES, RETRIEVAL_CACHE_TTL_S, RAG_CORPUS_VERSION)
+    if RETRIEVAL_CACHE_MAX_ENTRIES > 0 else None
+)
+conversation_store = make_conversation_store(
+    CONVERSATION_STORE, CONVERSATION_MAX_TURNS, CONVERSATION_IDLE_TTL_S, CONVERSATION_SQLITE_PATH
+)
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    try:
+        from semantic_cache import SemanticCache, namespace_id
+        semantic_cache = SemanticCache(SEMANTIC_CACHE_CAPACITY, SEMANTIC_CACHE_THRESHOLD,
+                                       SEMANTIC_CACHE_DIM, ANSWER_CACHE_TTL_S)
+    except ImportError as e:
+        logger.warning(f"Semantic cache disabled: {e}")
+
+chat_admission = AdmissionController(
+    max_in_flight=MAX_IN_FLIGHT_CHATS,
+    max_queue=MAX_QUEUED_CHATS,
+    queue_timeout_s=CHAT_QUEUE_TIMEOUT_S,
+    max_per_user=MAX_IN_FLIGHT_PER_USER,
+)
+# Batch items block on chat executor futures, so they run on their own pool.
+# Each waits for an admission slot first; more threads than slots plus queue
+# places would only be turned away
+_batch_executor = ThreadPoolExecutor(max_workers=max(1, MAX_IN_FLIGHT_CHATS + MAX_QUEUED_CHATS),
+                                     thread_name_prefix="batch")
+batch_rate_limiter = RateLimiter(BATCH_RATE_PER_S, burst=max(1, BATCH_CONCURRENCY))
 
-if PROJECT_ID:
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
+query_log = (QueryLogRecorder(QUERY_LOG_DIR, QUERY_LOG_SALT, QUERY_LOG_MAX_BYTES, QUERY_LOG_BACKUPS)
+             if QUERY_LOG_ENABLED else None)
+
+metrics_registry = Registry()
+stage_seconds = metrics_registry.histogram(
+    "policy_bot_stage_seconds", "Duration of chat pipeline and OAuth stages.", ("stage",))
+request_seconds = metrics_registry.histogram(
+    "policy_bot_request_seconds", "Request duration by endpoint and status.", ("endpoint", "status"))
+vertex_errors = metrics_registry.counter(
+    "policy_bot_vertex_errors_total", "Vertex AI calls that failed or missed their deadline.", ("call", "error"))
+stage_timer = StageTimer(
+    enabled=SERVER_TIMING_ENABLED or TIMING_LOGS_ENABLED,
+    histogram=stage_seconds if METRICS_ENABLED else None,
+)
+
+depth_policy = DepthPolicy(
+    enabled=ADAPTIVE_RETRIEVAL_ENABLED, default_k=RETRIEVAL_DEFAULT_TOP_K, max_k=RETRIEVAL_MAX_TOP_K,
+    initial_k=RETRIEVAL_INITIAL_TOP_K, low_confidence=RETRIEVAL_LOW_CONFIDENCE_SCORE,
+    flat_tail=RETRIEVAL_FLAT_TAIL_DELTA, higher_is_better=RAG_SCORE_HIGHER_IS_BETTER,
+)
+retrieval_flights = SingleFlight(_chat_executor, stage_timer.submit, SINGLE_FLIGHT_ENABLED)
+generation_flights = SingleFlight(_chat_executor, stage_timer.submit, SINGLE_FLIGHT_ENABLED)
+
+# Hedged attempts get their own pool: they are started from chat executor threads
+_hedge_executor = (ThreadPoolExecutor(max_workers=CHAT_EXECUTOR_WORKERS, thread_name_prefix="hedge")
+                   if RETRIEVAL_HEDGE_ENABLED else None)
+# One retry/hedge/circuit policy per shard, so a failing region doesn't trip the others
+retrieval_calls: Dict[str, ResilientCall] = {
+    shard.name: ResilientCall(
+        "retrieval" if len(RAG_SHARDS) == 1 else f"retrieval:{shard.name}",
+        CircuitBreaker(CIRCUIT_FAILURE_RATIO, CIRCUIT_MIN_CALLS, CIRCUIT_RESET_S),
+        attempts=VERTEX_RETRY_ATTEMPTS, base_delay=VERTEX_RETRY_BASE_DELAY_S, max_delay=VERTEX_RETRY_MAX_DELAY_S,
+        executor=_hedge_executor, submit=stage_timer.submit,
+        hedge_quantile=RETRIEVAL_HEDGE_QUANTILE if RETRIEVAL_HEDGE_ENABLED else None,
+        hedge_min_delay=RETRIEVAL_HEDGE_MIN_DELAY_S,
+    )
+    for shard in RAG_SHARDS
+}
+# Shard queries are started from chat executor threads too
+_shard_executor = (ThreadPoolExecutor(max_workers=CHAT_EXECUTOR_WORKERS * len(RAG_SHARDS), thread_name_prefix="shard")
+                   if len(RAG_SHARDS) > 1 else None)
+generation_calls = ResilientCall(
+    "generation", CircuitBreaker(CIRCUIT_FAILURE_RATIO, CIRCUIT_MIN_CALLS, CIRCUIT_RESET_S),
+    attempts=VERTEX_RETRY_ATTEMPTS, base_delay=VERTEX_RETRY_BASE_DELAY_S, max_delay=VERTEX_RETRY_MAX_DELAY_S,
+)
+degraded_answers = metrics_registry.counter(
+    "policy_bot_degraded_answers_total", "Answers served without sources or without generation.", ("reason",))
+retrieval_depth = metrics_registry.counter(
+    "policy_bot_retrieval_depth_total", "Retrievals by chosen top_k (0 = skipped) and reason.", ("k", "reason"))
+shards_dropped = metrics_registry.counter(
+    "policy_bot_rag_shards_dropped_total", "Shards left out of a merged retrieval.", ("shard", "reason"))
+
+def _admission_gauges() -> Dict[Tuple[str, ...], float]:
+    stats = chat_admission.stats()
+    return {("running",): stats["in_flight"], ("queued",): stats["waiting"]}
+
+def _admission_rejections() -> Dict[Tuple[str, ...], float]:
+    return {(reason,): count for reason, count in chat_admission.stats()["rejected"].items()}
+
+def _cache_lookups() -> Dict[Tuple[str, ...], float]:
+    out: Dict[Tuple[str, ...], float] = {}
+    for name, cache in (("answers", answer_cache), ("retrieval", retrieval_cache), ("semantic", semantic_cache)):
+        if cache is not None:
+            stats = cache.stats()
+            out[(name, "hit")] = stats["hits"]
+            out[(name, "miss")] = stats["misses"]
+    return out
+
+metrics_registry.callback("policy_bot_chats_in_flight", "Chats running or queued for admission.",
+                          _admission_gauges, ("state",))
+metrics_registry.callback("policy_bot_chats_rejected_total", "Chats turned away by admission control.",
+                          _admission_rejections, ("reason",), kind="counter")
+def _single_flight_calls() -> Dict[Tuple[str, ...], float]:
+    out: Dict[Tuple[str, ...], float] = {}
+    for level, flights in (("retrieval", retrieval_flights), ("generation", generation_flights)):
+        stats = flights.stats()
+        for outcome in ("leaders", "coalesced", "abandoned"):
+            out[(level, outcome)] = stats[outcome]
+    return out
+
+metrics_registry.callback("policy_bot_single_flight_calls_total",
+                          "Vertex calls started (leaders), joined by identical requests (coalesced) "
+                          "or dropped after every waiter left (abandoned).",
+                          _single_flight_calls, ("level", "outcome"), kind="counter")
+def _resilience_stats(key: str) -> Callable[[], Dict[Tuple[str, ...], float]]:
+    return lambda: {(c.name,): c.stats()[key] for c in (*retrieval_calls.values(), generation_calls)}
+
+def _circuit_states() -> Dict[Tuple[str, ...], float]:
+    out: Dict[Tuple[str, ...], float] = {}
+    for c in (*retrieval_calls.values(), generation_calls):
+        state = c.breaker.state
+        for s in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+            out[(c.name, s)] = 1 if s == state else 0
+    return out
+
+metrics_registry.callback("policy_bot_vertex_retries_total", "Vertex calls retried after a transient error.",
+                          _resilience_stats("retries"), ("call",), kind="counter")
+metrics_registry.callback("policy_bot_vertex_hedges_total", "Hedged second attempts started.",
+                          _resilience_stats("hedges"), ("call",), kind="counter")
+metrics_registry.callback("policy_bot_vertex_hedge_wins_total", "Hedged attempts that answered first.",
+                          _resilience_stats("hedge_wins"), ("call",), kind="counter")
+metrics_registry.callback("policy_bot_circuit_rejected_total", "Vertex calls refused by an open circuit.",
+                          _resilience_stats("circuit_rejected"), ("call",), kind="counter")
+metrics_registry.callback("policy_bot_circuit_state", "Circuit breaker state per Vertex call (1 = current).",
+                          _circuit_states, ("call", "state"))
+metrics_registry.callback("policy_bot_cache_lookups_total", "Cache lookups by cache and result.",
+                          _cache_lookups, ("cache", "result"), kind="counter")
+if query_log is not None:
+    metrics_registry.callback("policy_bot_query_log_events_total", "Query log events written or dropped.",
+                              lambda: {(k,): v for k, v in query_log.stats().items() if k != "queued"},
+                              ("outcome",), kind="counter")
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'tobacco-legal-info-system-2024')
 
+# Bodies generated after the headers are sent (SSE chat, NDJSON batch)
+STREAMED_MIMETYPES = ("text/event-stream", "application/x-ndjson")
+
+@app.before_request
+def _begin_request_timing():
+    g.timing_token = stage_timer.begin()
+    g.started_at = time.time()
+
+QUERY_LOG_ENDPOINTS = ("chat", "chat_stream")
+
+@app.after_request
+def _record_query(resp):
+    # Registered first so it runs last, after compression; streams record when they end
+    if query_log is not None and request.endpoint in QUERY_LOG_ENDPOINTS and resp.mimetype not in STREAMED_MIMETYPES:
+        record_query(request.endpoint, resp.status_code, resp.content_length or 0)
+    return resp
+
+@app.after_request
+def _add_server_timing(resp):
+    timings = stage_timer.current()
+    if timings is None:
+        return resp
+    streaming = resp.mimetype in STREAMED_MIMETYPES
+    if SERVER_TIMING_ENABLED:
+        # Headers leave before a stream's stages run; its breakdown is logged instead
+        resp.headers["Server-Timing"] = timings.server_timing(total=not streaming)
+    if not streaming:
+        finish_request_timing(timings, request.endpoint, resp.status_code)
+    return resp
+
+_static_compression = StaticCompressionCache()
+
+@app.after_request
+def _compress(resp):
+    # Registered after _add_server_timing, so it runs first and shows up in the breakdown
+    if not RESPONSE_COMPRESSION:
+        return resp
+    static_key = (request.path, resp.headers.get("ETag")) if request.endpoint == "static" else None
+    with stage_timer.stage("compress"):
+        return compress_response(resp, request.headers.get("Accept-Encoding", ""),
+                                 RESPONSE_COMPRESSION_MIN_BYTES, _static_compression, static_key)
+
+@app.teardown_request
+def _end_request_timing(_exc):
+    stage_timer.end(g.pop("timing_token", None))
+
+def finish_request_timing(timings, endpoint: Optional[str], status) -> None:
+    """Record a finished request in the histogram and the stage timings log."""
+    if METRICS_ENABLED:
+        request_seconds.observe(timings.elapsed(), endpoint=endpoint or "none", status=status)
+    if TIMING_LOGS_ENABLED and timings.stages:
+        logger.info("Stage timings: " + json.dumps({
+            "endpoint": endpoint,
+            "status": status,
+            "total_ms": round(timings.elapsed() * 1000, 1),
+            "stages_ms": timings.as_ms(),
+        }, sort_keys=True))
+
+def record_query(endpoint: str, status: int, response_bytes: int) -> None:
+    """Queue this request's query log event (rejected and failed requests too)."""
+    payload = request.get_json(silent=True) or {}
+    timings = stage_timer.current()
+    started = g.get("started_at") or time.time()
+    query_log.record({
+        "ts": round(started, 3),
+        "endpoint": endpoint,
+        "user": query_log.anonymize((session.get('user') or {}).get('id')),
+        "session": query_log.anonymize(session.get('cid')),
+        "query": (payload.get("message") or "").strip() if isinstance(payload, dict) else "",
+        "top_k": payload.get("top_k") if isinstance(payload, dict) else None,
+        "v": payload.get("v") if isinstance(payload, dict) else None,
+        "history_turns": g.get("history_turns"),
+        "status": status,
+        "total_ms": round((timings.elapsed() if timings else time.time() - started) * 1000, 1),
+        "stages_ms": timings.as_ms() if timings else {},
+        "request_bytes": request.content_length or 0,
+        "response_bytes": response_bytes,
+    })
+
 # OAuth helper functions
-def get_google_provider_cfg():
-    return requests.get(GOOGLE_DISCOVERY_URL).json()
+oidc_provider = OIDCProvider(GOOGLE_DISCOVERY_URL, GOOGLE_CLIENT_ID, make_session(OIDC_HTTP_POOL_SIZE),
+                             ttl=OIDC_CACHE_TTL_S, timeout=OIDC_HTTP_TIMEOUT_S)
+
+def get_google_provider_cfg() -> Dict[str, Any]:
+    return oidc_provider.config()
+
+def current_conversation_id() -> str:
+    cid = session.get('cid')
+    if not cid:
+        cid = session['cid'] = new_conversation_id()
+    return cid
 
 def login_required(f):
     @wraps(f)
@@ -53,6 +449,33 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def admission_controlled(f):
+    """Run the view only when chat_admission has a free slot.
+
+    Saturation is answered right away with 429/503 and Retry-After. The slot is
+    held until the response is closed, so streamed answers keep it while they
+    stream.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user = (session.get('user') or {}).get('id')
+        try:
+            ticket = chat_admission.acquire(user)
+        except Overloaded as e:
+            logger.warning(f"Rejected chat request ({e.status}): {e.reason}")
+            resp = jsonify(error=e.reason)
+            resp.status_code = e.status
+            resp.headers["Retry-After"] = str(e.retry_after)
+            return resp
+        try:
+            resp = make_response(f(*args, **kwargs))
+        except BaseException:
+            ticket.release()
+            raise
+        resp.call_on_close(ticket.release)
+        return resp
+    return decorated_function
+
 # System prompt for legal advisory behavior
 SYSTEM_PROMPT = """
 You are a helpful tobacco legal information assistant that provides factual information from legal documents to help marketing teams understand tobacco regulations. You present facts clearly while being conversational and helpful.
@@ -90,25 +513,241 @@ GUIDELINES:
 # RAG helpers
 # -----------------------------
 
-def build_rag_tool(top_k: int = 5) -> Tool:
-    rag_retrieval_config = rag.RagRetrievalConfig(top_k=top_k)
-    return Tool.from_retrieval(
-        retrieval=rag.Retrieval(
-            source=rag.VertexRagStore(
-                rag_resources=[rag.RagResource(rag_corpus=RAG_CORPUS)],
-                rag_retrieval_config=rag_retrieval_config,
+class VertexRegistry:
+    """Process-wide cache of Vertex SDK objects, built once per key.
+
+    Keys carry everything the object depends on (model, top_k, corpus), so a
+    config change simply builds a new entry. Objects are created lazily and the
+    registry is emptied in forked children, so each gunicorn worker builds its
+    own clients and no gRPC channel is shared across processes.
+    """
+
+    def __init__(self):
+        # Re-entrant: factories may build their own dependencies through the registry
+        self._lock = threading.RLock()
+        self._objects: Dict[Tuple, Any] = {}
+
+    def get(self, key: Tuple, factory):
+        obj = self._objects.get(key)
+        if obj is None:
+            with self._lock:
+                obj = self._objects.get(key)
+                if obj is None:
+                    obj = factory()
+                    self._objects[key] = obj
+        return obj
+
+    def clear(self) -> None:
+        with self._lock:
+            self._objects.clear()
+
+_vertex_registry = VertexRegistry()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_vertex_registry.clear)
+
+def _share_rag_service_clients() -> None:
+    """Make the RAG SDK reuse one service client per process.
+
+    rag.retrieval_query creates a new RAG service client and a RAG data client
+    (and with them new channels) on every call, and VertexRagStore creates a
+    data client whenever it is built.
+    """
+    try:
+        from vertexai.rag.utils import _gapic_utils
+    except ImportError:
+        return
+    for name in ("create_rag_service_client", "create_rag_data_service_client"):
+        create_client = getattr(_gapic_utils, name, None)
+        if create_client is None:
+            logger.info(f"{name} not found, RAG client sharing not available in this SDK version")
+            continue
+        if getattr(create_client, "_shared", False):
+            continue
+
+        def shared_client(api_path_override=None, _name=name, _create=create_client):
+            return _vertex_registry.get((_name, api_path_override), lambda: _create(api_path_override))
+
+        shared_client._shared = True
+        setattr(_gapic_utils, name, shared_client)
+
+_sdk_lock = threading.Lock()
+_sdk: Optional[SimpleNamespace] = None
+
+def vertex_sdk() -> SimpleNamespace:
+    """The Vertex AI SDK (vertexai, rag, GenerativeModel, Tool), imported on first use.
+
+    Also runs vertexai.init and installs the shared RAG service clients, once
+    per process.
+    """
+    global _sdk
+    if _sdk is None:
+        with _sdk_lock:
+            if _sdk is None:
+                import vertexai
+                from vertexai import rag
+                from vertexai.generative_models import GenerativeModel, Tool
+                if PROJECT_ID:
+                    vertexai.init(project=PROJECT_ID, location=LOCATION)
+                _share_rag_service_clients()
+                _sdk = SimpleNamespace(vertexai=vertexai, rag=rag, GenerativeModel=GenerativeModel, Tool=Tool)
+    return _sdk
+
+def get_rag_resources(shard: Shard) -> List[Any]:
+    return _vertex_registry.get(("rag_resources", shard.corpus),
+                                lambda: [vertex_sdk().rag.RagResource(rag_corpus=shard.corpus)])
+
+def shard_endpoint(shard: Shard) -> Dict[str, str]:
+    """retrieval_query overrides for a corpus outside VERTEX_LOCATION (its regional endpoint)."""
+    if not shard.location or shard.location in (LOCATION, "global"):
+        return {}
+    return {"parent_override": shard.corpus.split("/ragCorpora/")[0],
+            "api_path_override": f"{shard.location}-aiplatform.googleapis.com"}
+
+def route_shards(query: str) -> List[Shard]:
+    return route(query, RAG_SHARDS, RAG_ROUTING_ENABLED)
+
+def get_retrieval_config(top_k: int) -> Any:
+    return _vertex_registry.get(("rag_retrieval_config", top_k),
+                                lambda: vertex_sdk().rag.RagRetrievalConfig(top_k=top_k))
+
+def build_rag_tool(top_k: int, shard: Shard) -> "Tool":
+    def factory():
+        sdk = vertex_sdk()
+        return sdk.Tool.from_retrieval(
+            retrieval=sdk.rag.Retrieval(
+                source=sdk.rag.VertexRagStore(
+                    rag_resources=get_rag_resources(shard),
+                    rag_retrieval_config=get_retrieval_config(top_k),
+                )
             )
         )
+    return _vertex_registry.get(("rag_tool", top_k, shard.corpus), factory)
+
+def get_generative_model(top_k: int = 5, with_rag_tool: bool = True,
+                         shard: Optional[Shard] = None) -> "GenerativeModel":
+    """Shared GenerativeModel with SYSTEM_PROMPT as its system instruction.
+
+    Optionally attaches the RAG retrieval tool for `shard` (default: the first
+    configured one; the tool takes a single corpus).
+    """
+    tool_shard = (shard or RAG_SHARDS[0]) if with_rag_tool else None
+    tool_top_k = top_k if with_rag_tool else None
+    return _vertex_registry.get(
+        ("model", MODEL_NAME, tool_top_k, tool_shard.corpus if tool_shard else None),
+        lambda: vertex_sdk().GenerativeModel(
+            model_name=MODEL_NAME,
+            tools=[build_rag_tool(top_k, tool_shard)] if tool_shard else None,
+            system_instruction=SYSTEM_PROMPT,
+        ),
     )
 
 def retrieve_contexts(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-    """Return contexts with source_uri, title (source_display_name), text, score."""
-    rag_retrieval_config = rag.RagRetrievalConfig(top_k=top_k)
-    resp = rag.retrieval_query(
-        rag_resources=[rag.RagResource(rag_corpus=RAG_CORPUS)],
-        text=query,
-        rag_retrieval_config=rag_retrieval_config,
-    )
+    """Return contexts with source_uri, title (source_display_name), text, score.
+
+    Served from the retrieval cache when the normalized query was seen before.
+    """
+    with stage_timer.stage("retrieval"):
+        return _retrieve_contexts(query, top_k)
+
+def retrieve_adaptive(query: str, top_k: int) -> List[Dict[str, Any]]:
+    """retrieve_contexts at depth_policy's first k, topped up to top_k when the scores look unsure.
+
+    Inline mode only: in tool mode Gemini's RAG tool retrieves top_k itself,
+    concurrently, so the Sources retrieval stays at top_k to match it.
+    """
+    adaptive = depth_policy.enabled and GROUNDING_MODE == "inline"
+    k = depth_policy.first_k(top_k) if adaptive else top_k
+    contexts = retrieve_contexts(query, k)
+    reason = "requested" if adaptive else "fixed"
+    if k < top_k:
+        reason = depth_policy.expand_reason(contexts, k) or "confident"
+        if reason != "confident":
+            k = top_k
+            contexts = top_up_contexts(contexts, retrieve_contexts(query, k), k)
+    log_retrieval_depth(k, reason, top_k, contexts)
+    return contexts
+
+def top_up_contexts(first: List[Dict[str, Any]], more: List[Dict[str, Any]], top_k: int) -> List[Dict[str, Any]]:
+    """`first` followed by the chunks of `more` it doesn't already hold, up to top_k."""
+    # Vertex retrieval has no offset, so an expansion can't ask for just the next chunks
+    seen = {(c.get("source_uri"), c.get("page_range"), c.get("text")) for c in first}
+    merged = list(first)
+    for c in more:
+        if len(merged) >= top_k:
+            break
+        key = (c.get("source_uri"), c.get("page_range"), c.get("text"))
+        if key not in seen:
+            seen.add(key)
+            merged.append(c)
+    return merged
+
+def log_retrieval_depth(k: int, reason: str, top_k: int, contexts: Optional[List[Dict[str, Any]]] = None) -> None:
+    """Count and log the chosen depth with the scores it was based on, for tuning the thresholds."""
+    retrieval_depth.inc(k=str(k), reason=reason)
+    scores = [c.get("score") for c in contexts or []]
+    depth = {"k": k, "reason": reason, "top_k": top_k, "contexts": len(scores),
+             "best_score": scores[0] if scores else None, "last_score": scores[-1] if scores else None}
+    logger.info(f"Retrieval depth: {json.dumps(depth, sort_keys=True)}")
+
+def _retrieve_contexts(query: str, top_k: int) -> List[Dict[str, Any]]:
+    cache_key = retrieval_cache.key(query, top_k, RAG_CORPUS) if retrieval_cache else None
+    if cache_key:
+        cached = retrieval_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    contexts = query_shards(query, top_k)
+    if cache_key and contexts:
+        retrieval_cache.put(cache_key, contexts)
+    return contexts
+
+def query_shards(query: str, top_k: int) -> List[Dict[str, Any]]:
+    """Global top_k over the shards routed for the query, queried in parallel (uncached).
+
+    Each shard has RAG_SHARD_TIMEOUT_S; a shard that is late or failing is
+    left out of the merge. Only when every shard fails is the first error
+    raised.
+    """
+    shards = route_shards(query)
+    if len(shards) == 1:
+        return query_rag_contexts(query, top_k, shards[0])
+    futures = [stage_timer.submit(_shard_executor, query_rag_contexts, query, top_k, shard, RAG_SHARD_TIMEOUT_S)
+               for shard in shards]
+    wait(futures, timeout=RAG_SHARD_TIMEOUT_S)
+    results: List[List[Dict[str, Any]]] = []
+    error: Optional[BaseException] = None
+    for shard, future in zip(shards, futures):
+        if not future.done():
+            future.cancel()
+            shards_dropped.inc(shard=shard.name, reason="timeout")
+            logger.warning(f"RAG shard '{shard.name}' missed its {RAG_SHARD_TIMEOUT_S:g}s deadline, merging without it")
+            error = error or FuturesTimeout()
+        elif future.exception() is not None:
+            e = future.exception()
+            shards_dropped.inc(shard=shard.name, reason=type(e).__name__)
+            logger.warning(f"RAG shard '{shard.name}' failed ({type(e).__name__}: {e}), merging without it")
+            error = error or e
+        else:
+            results.append(future.result())
+    if not results:
+        raise error
+    return merge_contexts(results, top_k, RAG_SCORE_HIGHER_IS_BETTER)
+
+def _retrieval_query(query: str, top_k: int, shard: Shard):
+    try:
+        return vertex_sdk().rag.retrieval_query(
+            rag_resources=get_rag_resources(shard),
+            text=query,
+            rag_retrieval_config=get_retrieval_config(top_k),
+            **shard_endpoint(shard),
+        )
+    except Exception as e:
+        vertex_errors.inc(call="retrieval", error=type(e).__name__)
+        raise
+
+def query_rag_contexts(query: str, top_k: int, shard: Shard,
+                       budget: float = RETRIEVAL_TIMEOUT_S) -> List[Dict[str, Any]]:
+    """Run rag.retrieval_query on one shard (retried/hedged) and parse the contexts (uncached)."""
+    resp = retrieval_calls[shard.name].call(_retrieval_query, query, top_k, shard, budget=budget)
     contexts: List[Dict[str, Any]] = []
     
     try:
@@ -144,45 +783,129 @@ def retrieve_contexts(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
     
     return contexts
 
-def extract_grounding_from_generation(gen_response) -> Dict[str, Any]:
-    """Parse model text + grounding chunks/supports from a GenerationResponse."""
-    out: Dict[str, Any] = {"text": getattr(gen_response, "text", None)}
-    d = None
+class GroundingChunk:
+    """A source the answer can cite (Vertex grounding chunk or inline excerpt)."""
+
+    __slots__ = ("uri", "title", "text", "page_number", "page_range")
+
+    def __init__(self, uri: Optional[str] = None, title: Optional[str] = None, text: Optional[str] = None,
+                 page_number: Optional[int] = None, page_range: Optional[str] = None):
+        self.uri = uri
+        self.title = title
+        self.text = text
+        self.page_number = page_number
+        self.page_range = page_range
+
+class GroundingSupport:
+    """End of a supported answer segment (UTF-8 byte offset) and the chunks backing it."""
+
+    __slots__ = ("end_index", "chunk_indices")
+
+    def __init__(self, end_index: Optional[int], chunk_indices: List[int]):
+        self.end_index = end_index
+        self.chunk_indices = chunk_indices
+
+def _raw_message(msg: Any) -> Any:
+    """The underlying protobuf of a proto-plus message (plain objects pass through)."""
+    pb = getattr(type(msg), "pb", None)
+    if pb is None:
+        return msg
     try:
-        d = gen_response.to_dict() if hasattr(gen_response, "to_dict") else None
+        return pb(msg)
     except Exception:
-        d = None
-    if d:
-        cand0 = (d.get("candidates") or [{}])[0]
-        gm = cand0.get("grounding_metadata") or {}
-        chunks = []
-        for ch in gm.get("grounding_chunks") or []:
-            rc = (ch.get("retrieved_context") or {})
-            uri = rc.get("uri") or rc.get("source_uri")
-            title = rc.get("title") or rc.get("source_display_name")
-            text = rc.get("text")
-            chunks.append({"uri": uri, "title": title, "text": text})
-        out["grounding_chunks"] = chunks
-        out["grounding_supports"] = gm.get("grounding_supports") or []
-        return out
-    # Fallback attribute access
+        return msg
+
+def extract_grounding_from_generation(gen_response) -> Dict[str, Any]:
+    """Parse model text + grounding chunks/supports from a GenerationResponse.
+
+    Reads only the fields we use straight off the grounding metadata proto
+    (no to_dict() of the whole response, chunk texts included). Missing
+    fields give empty lists.
+    """
+    out: Dict[str, Any] = {"text": _response_text(gen_response) or None,
+                           "grounding_chunks": [], "grounding_supports": []}
     try:
-        c0 = gen_response.candidates[0]
-        gm = getattr(c0, "grounding_metadata", None)
-        if gm and getattr(gm, "grounding_chunks", None):
-            chunks = []
-            for ch in gm.grounding_chunks:
-                rc = getattr(ch, "retrieved_context", None)
-                uri = getattr(rc, "uri", None) if rc else None
-                title = getattr(rc, "title", None) if rc else None
-                text = getattr(rc, "text", None) if rc else None
-                chunks.append({"uri": uri, "title": title, "text": text})
-            out["grounding_chunks"] = chunks
-            out["grounding_supports"] = getattr(gm, "grounding_supports", [])
-    except Exception:
-        pass
+        candidates = gen_response.candidates
+        gm = candidates[0].grounding_metadata if candidates else None
+    except (AttributeError, IndexError):
+        return out
+    if gm is None:
+        return out
+    gm = _raw_message(gm)
+    chunks = out["grounding_chunks"]
+    for ch in getattr(gm, "grounding_chunks", None) or ():
+        rc = getattr(ch, "retrieved_context", None)
+        if rc is None:
+            chunks.append(GroundingChunk())
+            continue
+        chunks.append(GroundingChunk(
+            uri=getattr(rc, "uri", None) or getattr(rc, "source_uri", None) or None,
+            title=getattr(rc, "title", None) or getattr(rc, "source_display_name", None) or None,
+            text=getattr(rc, "text", None) or None,
+        ))
+    supports = out["grounding_supports"]
+    for sup in getattr(gm, "grounding_supports", None) or ():
+        seg = getattr(sup, "segment", None)
+        supports.append(GroundingSupport(
+            getattr(seg, "end_index", None) if seg is not None else None,
+            list(getattr(sup, "grounding_chunk_indices", None) or ()),
+        ))
     return out
 
+def format_contexts_for_prompt(contexts: List[Dict[str, Any]]) -> str:
+    """Render retrieved contexts as numbered excerpts the model can cite as [n]."""
+    if not contexts:
+        return ""
+    lines = [
+        "",
+        "",
+        "Retrieved legal excerpts (base your answer on these and cite them inline as [n] "
+        "right after the statement they support):",
+    ]
+    for i, c in enumerate(contexts, start=1):
+        title = c.get("title") or c.get("source_uri") or "Source"
+        pages = f" (page {c['page_range']})" if c.get("page_range") else ""
+        lines.append(f"[{i}] {title}{pages}")
+        lines.append((c.get("text") or "").strip())
+    return "\n".join(lines)
+
+_INLINE_CITATION_RE = re.compile(r"\s*\[(\d+(?:\s*,\s*\d+)*)\]")
+
+def extract_grounding_from_inline_citations(text: str, contexts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Turn [n] markers written by the model into grounding chunks/supports.
+
+    Returns the same shape as extract_grounding_from_generation, with the markers
+    stripped from the text, so citation numbering works the same in both modes.
+    Like Vertex grounding supports, segment.end_index is a UTF-8 byte offset.
+    """
+    chunks = [GroundingChunk(
+        uri=c.get("source_uri"),
+        title=c.get("title"),
+        text=c.get("text"),
+        page_number=c.get("page_number"),
+        page_range=c.get("page_range"),
+    ) for c in contexts]
+    text = text or ""
+    supports: List[GroundingSupport] = []
+    parts: List[str] = []
+    pos = 0
+    out_len = 0
+    for m in _INLINE_CITATION_RE.finditer(text):
+        idxs = [int(n) - 1 for n in re.split(r"\s*,\s*", m.group(1))]
+        idxs = [i for i in idxs if 0 <= i < len(chunks)]
+        if not idxs:
+            # Not one of our excerpt numbers (e.g. "[2016]"), leave it in the answer
+            continue
+        parts.append(text[pos:m.start()])
+        out_len += len(parts[-1].encode("utf-8"))
+        pos = m.end()
+        if supports and supports[-1].end_index == out_len:
+            supports[-1].chunk_indices.extend(idxs)
+        else:
+            supports.append(GroundingSupport(out_len, idxs))
+    parts.append(text[pos:])
+    return {"text": "".join(parts), "grounding_chunks": chunks, "grounding_supports": supports}
+
 # -----------------------------
 # Inline citation formatting
 # -----------------------------
@@ -194,7 +917,7 @@ def _mk_source_key(uri: str, title: str, text: str) -> str:
     return "unknown"
 
 def build_citation_catalog(
-    gen_chunks: List[Dict[str, Any]],
+    gen_chunks: List[GroundingChunk],
     retrieved: List[Dict[str, Any]]
 ):
     """Return (index->number map, catalog list)."""
@@ -207,23 +930,24 @@ def build_citation_catalog(
 
     catalog: List[Dict[str, Any]] = []
     index_to_cite_num: Dict[int, int] = {}
+    # source key -> citation number, so repeated chunks are found in O(1)
+    numbers: Dict[str, int] = {}
 
-    def ensure_entry(chunk: Dict[str, Any]) -> int:
-        uri = chunk.get("uri")
-        title = chunk.get("title")
-        text = chunk.get("text")
+    def ensure_entry(chunk: GroundingChunk) -> int:
+        uri = chunk.uri
+        title = chunk.title
+        text = chunk.text
         key = _mk_source_key(uri, title, text)
-        for i, e in enumerate(catalog):
-            if e["_key"] == key:
-                return i + 1
+        num = numbers.get(key)
+        if num is not None:
+            return num
         merged = {
             "uri": convert_gs_to_authenticated_url(uri or (by_title.get(title) or {}).get("source_uri")),
             "title": title or (by_uri.get(uri) or {}).get("title"),
             "text": text,
             "score": None,
-            "page_number": chunk.get("page_number"),
-            "page_range": chunk.get("page_range"),
-            "_key": key,
+            "page_number": chunk.page_number,
+            "page_range": chunk.page_range,
         }
         if merged["uri"] and merged["uri"] in by_uri:
             retrieved_item = by_uri[merged["uri"]]
@@ -238,37 +962,75 @@ def build_citation_catalog(
             merged["page_number"] = merged["page_number"] or retrieved_item.get("page_number")
             merged["page_range"] = merged["page_range"] or retrieved_item.get("page_range")
         catalog.append(merged)
+        numbers[key] = len(catalog)
         return len(catalog)
 
     for idx, ch in enumerate(gen_chunks or []):
         cite_num = ensure_entry(ch)
         index_to_cite_num[idx] = cite_num
 
-    for e in catalog:
-        e.pop("_key", None)
-
     return index_to_cite_num, catalog
 
-def annotate_with_citations(text: str, supports: List[Dict[str, Any]], idx_to_num: Dict[int, int]) -> str:
+def _byte_to_char_offsets(text: str, byte_offsets) -> Dict[int, int]:
+    """Map UTF-8 byte offsets into text to str indices in one pass.
+
+    Offsets outside the text or inside a multi-byte character are left out.
+    """
+    data = text.encode("utf-8")
+    out: Dict[int, int] = {}
+    prev_b = prev_c = 0
+    for b in sorted(set(byte_offsets)):
+        if b < 0 or b > len(data):
+            continue
+        try:
+            prev_c += len(data[prev_b:b].decode("utf-8"))
+        except UnicodeDecodeError:
+            continue
+        prev_b = b
+        out[b] = prev_c
+    return out
+
+def annotate_with_citations(text: str, supports: List[GroundingSupport], idx_to_num: Dict[int, int],
+                            byte_offsets: bool = True) -> str:
+    """Insert [n] markers at the end of every supported segment.
+
+    segment.end_index is a UTF-8 byte offset, as Vertex reports it (pass
+    byte_offsets=False for str indices). Offsets outside the text or inside a
+    multi-byte character are skipped. Markers at the same position appear with
+    the later support first. All markers are spliced in with one join.
+    """
     if not text or not supports:
         return text or ""
-    def end_idx(s): 
-        seg = s.get("segment") or {}
-        return seg.get("end_index", 0)
-    supports_sorted = sorted(supports, key=end_idx, reverse=True)
-    out = text
-    for s in supports_sorted:
-        seg = s.get("segment") or {}
-        end_i = seg.get("end_index")
-        if end_i is None or end_i > len(out) or end_i < 0:
+    pending: List[Tuple[int, str]] = []
+    for s in supports:
+        end_i = s.end_index
+        if end_i is None:
             continue
-        idxs = s.get("grounding_chunk_indices") or []
-        ids = [idx_to_num[i] for i in idxs if i in idx_to_num]
-        if not ids:
+        ids = {idx_to_num[i] for i in s.chunk_indices if i in idx_to_num}
+        if ids:
+            pending.append((end_i, "".join(f"[{n}]" for n in sorted(ids))))
+    to_char = None
+    if byte_offsets and not text.isascii():
+        to_char = _byte_to_char_offsets(text, (end_i for end_i, _ in pending))
+    markers: Dict[int, List[str]] = {}
+    for end_i, marker in pending:
+        if to_char is not None:
+            end_i = to_char.get(end_i)
+            if end_i is None:
+                continue
+        elif end_i > len(text) or end_i < 0:
             continue
-        marker = "".join(f"[{n}]" for n in sorted(set(ids)))
-        out = out[:end_i] + marker + out[end_i:]
-    return out
+        markers.setdefault(end_i, []).append(marker)
+    if not markers:
+        return text
+    parts: List[str] = []
+    prev = 0
+    for pos in sorted(markers):
+        parts.append(text[prev:pos])
+        parts.extend(reversed(markers[pos]))
+        prev = pos
+    parts.append(text[prev:])
+    return "".join(parts)
 
 def convert_gs_to_authenticated_url(gs_uri: str) -> str:
     """Convert gs:// URI to authenticated https:// URL"""
@@ -290,6 +1052,675 @@ def render_sources_block(catalog: List[Dict[str, Any]]) -> str:
         lines.append(f"{i}. [{title}]({uri}){score_txt}")
     return "\n".join(lines)
 
+# -----------------------------
+# Chat pipeline
+# -----------------------------
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), cheap enough for every request."""
+    return (len(text) + 3) // 4 if text else 0
+
+def _summarize_turn(text: str, max_chars: int = 200) -> str:
+    first = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+    return first if len(first) <= max_chars else first[:max_chars].rstrip() + "…"
+
+def pack_conversation_history(conversation_history: List[Dict[str, str]], budget: int) -> Tuple[str, Dict[str, int]]:
+    """Fit as much history as the token budget allows, newest turns first.
+
+    A turn that doesn't fit in full is kept with the answer cut to its first
+    sentence; once even that doesn't fit, older turns are dropped.
+    """
+    lines: List[str] = []
+    remaining = budget
+    stats = {"turns": 0, "summarized": 0, "dropped": 0}
+    for i, exchange in enumerate(reversed(conversation_history)):
+        line = f"User: {exchange['user']}\nSystem: {exchange['bot']}\n"
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            line = f"User: {exchange['user']}\nSystem: {_summarize_turn(exchange['bot'])}\n"
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                stats["dropped"] = len(conversation_history) - i
+                break
+            stats["summarized"] += 1
+        lines.append(line)
+        remaining -= cost
+        stats["turns"] += 1
+    if not lines:
+        return "", stats
+    return "Previous conversation context:\n" + "".join(reversed(lines)).rstrip("\n"), stats
+
+def build_prompt(user_msg: str, conversation_history: List[Dict[str, str]],
+                 retrieved: Optional[List[Dict[str, Any]]] = None) -> Tuple[str, Dict[str, int]]:
+    """Assemble the per-request prompt; returns (prompt, estimated tokens per section).
+
+    SYSTEM_PROMPT is not part of it: it goes to the model as system instruction.
+    """
+    history, history_stats = pack_conversation_history(conversation_history, PROMPT_HISTORY_TOKEN_BUDGET)
+    excerpts = format_contexts_for_prompt(retrieved).strip() if retrieved else ""
+    query = f"Current User Query: {user_msg}"
+    prompt = "\n\n".join(part for part in (history, excerpts, query) if part)
+    usage = {
+        "system_instruction": estimate_tokens(SYSTEM_PROMPT),
+        "history": estimate_tokens(history),
+        "excerpts": estimate_tokens(excerpts),
+        "query": estimate_tokens(query),
+        "history_turns": history_stats["turns"],
+        "history_summarized": history_stats["summarized"],
+        "history_dropped": history_stats["dropped"],
+    }
+    usage["prompt"] = usage["history"] + usage["excerpts"] + usage["query"]
+    return prompt, usage
+
+def model_token_usage(gen_response) -> Dict[str, int]:
+    """Token counts reported by Vertex, when present."""
+    meta = getattr(gen_response, "usage_metadata", None)
+    if not meta:
+        return {}
+    return {
+        "model_prompt_tokens": getattr(meta, "prompt_token_count", 0) or 0,
+        "model_cached_tokens": getattr(meta, "cached_content_token_count", 0) or 0,
+        "model_output_tokens": getattr(meta, "candidates_token_count", 0) or 0,
+    }
+
+class StageTimeout(Exception):
+    """A chat pipeline stage did not finish before its deadline."""
+
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} did not finish within {timeout:g}s")
+        self.stage = stage
+
+class VertexUnavailable(Exception):
+    """Vertex is failing or its circuit is open, and there is nothing to fall back on."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Vertex AI is temporarily unavailable")
+        self.retry_after = retry_after
+
+def upstream_unavailable(e: BaseException) -> bool:
+    """Errors that mean "Vertex is unhealthy" rather than "this request is wrong"."""
+    return isinstance(e, CircuitOpenError) or is_retryable(e)
+
+UNAVAILABLE_NOTICE = ("The assistant cannot generate an answer right now. "
+                      "These passages from the legal documents match your question:")
+
+def unavailable_answer(retrieved: List[Dict[str, Any]], error: BaseException) -> Dict[str, Any]:
+    """Degraded answer while generation is down: the retrieved passages as sources.
+
+    Raises VertexUnavailable when retrieval came back empty too.
+    """
+    logger.warning(f"Generation unavailable ({type(error).__name__}: {error}), serving retrieved passages")
+    if not retrieved:
+        raise VertexUnavailable(getattr(error, "retry_after", 1.0))
+    degraded_answers.inc(reason="generation_unavailable")
+    gen = extract_grounding_from_inline_citations(UNAVAILABLE_NOTICE, retrieved)
+    return build_answer(UNAVAILABLE_NOTICE, gen, retrieved, degraded=True)
+
+def _answer_cache_parts(top_k: int) -> Tuple:
+    return (top_k, MODEL_NAME, RAG_CORPUS, RAG_CORPUS_VERSION, GROUNDING_MODE)
+
+def lookup_cached_answer(user_msg: str, top_k: int,
+                         conversation_history: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+    """Exact answer cache first, then (first turns only) the semantic cache."""
+    if answer_cache is not None:
+        cached = answer_cache.get(answer_cache.key(user_msg, top_k, MODEL_NAME, RAG_CORPUS,
+                                                   conversation_history, GROUNDING_MODE))
+        if cached is not None:
+            return {**cached, "cached": True}
+    # Paraphrase matches are only safe without conversation context
+    if semantic_cache is not None and not conversation_history:
+        cached = semantic_cache.lookup(user_msg, namespace_id(*_answer_cache_parts(top_k)))
+        if cached is not None:
+            return {**cached, "cached": True}
+    return None
+
+def store_answer(user_msg: str, top_k: int, conversation_history: List[Dict[str, str]],
+                 result: Dict[str, Any]) -> None:
+    if result.get("degraded"):
+        return
+    if answer_cache is not None:
+        answer_cache.put(answer_cache.key(user_msg, top_k, MODEL_NAME, RAG_CORPUS,
+                                          conversation_history, GROUNDING_MODE), result)
+    if semantic_cache is not None and not conversation_history:
+        semantic_cache.add(user_msg, namespace_id(*_answer_cache_parts(top_k)), result)
+
+def start_retrieval(user_msg: str, top_k: int) -> Optional[Tuple[Waiter, float]]:
+    """Join (or start) retrieve_adaptive for this query; returns (waiter, deadline).
+
+    Returns None when the query needs no retrieval (greetings, small talk).
+    Concurrent identical queries share one retrieval. The waiter must be
+    left: collect_retrieval does it, and so must any early exit.
+    """
+    if depth_policy.enabled:
+        reason = skip_reason(user_msg)
+        if reason:
+            log_retrieval_depth(0, reason, top_k)
+            return None
+    key = ("retrieval", normalize_query(user_msg), top_k, RAG_CORPUS)
+    waiter = retrieval_flights.join(key, lambda _flight, q, k: retrieve_adaptive(q, k), user_msg, top_k)
+    return waiter, time.monotonic() + RETRIEVAL_TIMEOUT_S
+
+def collect_retrieval(retrieval: Optional[Tuple[Waiter, float]]) -> Tuple[List[Dict[str, Any]], bool]:
+    """Wait for retrieval up to its deadline; returns (contexts, degraded).
+
+    A late or failing retrieval (Vertex unhealthy, circuit open) degrades the
+    answer to an empty sources list instead of holding or failing the request.
+    """
+    if retrieval is None:
+        return [], False
+    waiter, deadline = retrieval
+    try:
+        return waiter.result(timeout=max(0.0, deadline - time.monotonic())), False
+    except FuturesTimeout:
+        vertex_errors.inc(call="retrieval", error="timeout")
+        degraded_answers.inc(reason="retrieval_timeout")
+        logger.warning(f"Retrieval missed its {RETRIEVAL_TIMEOUT_S:g}s deadline, answering with degraded sources")
+        return [], True
+    except Exception as e:
+        if not upstream_unavailable(e):
+            raise
+        degraded_answers.inc(reason="retrieval_unavailable")
+        logger.warning(f"Retrieval unavailable ({type(e).__name__}: {e}), answering with degraded sources")
+        return [], True
+    finally:
+        waiter.leave()
+
+def build_generation(user_msg: str, conversation_history: List[Dict[str, str]],
+                     retrieved: List[Dict[str, Any]], top_k: int):
+    """Build the prompt and model for one chat turn; returns (prompt, model, usage).
+
+    top_k 0 means no retrieval: the model gets no RAG tool either.
+    """
+    with stage_timer.stage("prompt"):
+        if GROUNDING_MODE == "inline":
+            # Single retrieval: ground on the contexts we already have instead of
+            # letting the RAG tool query the corpus a second time.
+            prompt, usage = build_prompt(user_msg, conversation_history, retrieved)
+            model = get_generative_model(with_rag_tool=False)
+        else:
+            prompt, usage = build_prompt(user_msg, conversation_history)
+            model = (get_generative_model(top_k=top_k, shard=route_shards(user_msg)[0]) if top_k
+                     else get_generative_model(with_rag_tool=False))
+    return prompt, model, usage
+
+def _generation_key(prompt: str, top_k: int, stream: bool) -> Tuple:
+    # Same prompt to the same model (and RAG tool) is the same upstream call
+    return ("generation", stream, MODEL_NAME, GROUNDING_MODE, top_k, RAG_CORPUS, hash_parts(prompt))
+
+def _generate_content(model, prompt: str):
+    try:
+        return model.generate_content(prompt)
+    except Exception as e:
+        vertex_errors.inc(call="generation", error=type(e).__name__)
+        raise
+
+def _open_generation_stream(model, prompt: str):
+    """Start a streamed generation and wait for its first chunk; returns (chunks, first)."""
+    try:
+        chunks = iter(model.generate_content(prompt, stream=True))
+        first = next(chunks, None)
+    except Exception as e:
+        vertex_errors.inc(call="generation", error=type(e).__name__)
+        raise
+    return chunks, first
+
+def generate_answer(flight, model, prompt: str):
+    """model.generate_content with retries, timed as the "generation" stage."""
+    with stage_timer.stage("generation"):
+        return generation_calls.call(_generate_content, model, prompt, budget=GENERATION_TIMEOUT_S,
+                                     cancelled=lambda: flight.abandoned)
+
+def pump_stream(flight, model, prompt: str) -> None:
+    """Feed a streamed generation into flight.data (a SharedStream) for all waiters.
+
+    Opening the stream is retried until the first chunk arrives; after that an
+    error ends the stream. Stops reading early once every waiter has left.
+    """
+    shared = flight.data
+    with stage_timer.stage("generation"):
+        try:
+            chunks, first = generation_calls.call(_open_generation_stream, model, prompt,
+                                                  budget=GENERATION_TIMEOUT_S, cancelled=lambda: flight.abandoned)
+        except Exception as e:
+            shared.finish(e)
+            return
+        try:
+            if first is not None:
+                shared.append(first)
+            for chunk in chunks:
+                if flight.abandoned:
+                    close = getattr(chunks, "close", None)
+                    if close:
+                        close()
+                    break
+                shared.append(chunk)
+        except Exception as e:
+            vertex_errors.inc(call="generation", error=type(e).__name__)
+            shared.finish(e)
+            return
+    shared.finish()
+
+def run_chat_turn(user_msg: str, conversation_history: List[Dict[str, str]], top_k: int) -> Tuple[str, Dict[str, Any]]:
+    """Answer one message; returns (model_text, response payload).
+
+    In "tool" mode retrieval and generation don't depend on each other, so they
+    run concurrently and the turn takes roughly as long as the slower one.
+    Identical concurrent turns share their retrieval and generation calls.
+    While generation is unavailable the retrieved passages are served instead.
+    Raises StageTimeout when generation misses its deadline.
+    """
+    with stage_timer.stage("cache_lookup"):
+        cached = lookup_cached_answer(user_msg, top_k, conversation_history)
+    if cached is not None:
+        return cached["response"], cached
+
+    retrieval = start_retrieval(user_msg, top_k)
+    tool_top_k = top_k if retrieval else 0
+    try:
+        retrieved: List[Dict[str, Any]] = []
+        degraded = False
+        if GROUNDING_MODE == "inline":
+            retrieved, degraded = collect_retrieval(retrieval)
+
+        full_prompt, model, usage = build_generation(user_msg, conversation_history, retrieved, tool_top_k)
+        generation = generation_flights.join(_generation_key(full_prompt, tool_top_k, False),
+                                             generate_answer, model, full_prompt)
+        unavailable = None
+        try:
+            gen_response = generation.result(timeout=GENERATION_TIMEOUT_S)
+        except FuturesTimeout:
+            vertex_errors.inc(call="generation", error="timeout")
+            raise StageTimeout("generation", GENERATION_TIMEOUT_S)
+        except Exception as e:
+            if not upstream_unavailable(e):
+                raise
+            unavailable = e
+        finally:
+            generation.leave()
+
+        if GROUNDING_MODE != "inline":
+            retrieved, degraded = collect_retrieval(retrieval)
+    finally:
+        if retrieval:
+            retrieval[0].leave()
+    if unavailable is not None:
+        result = unavailable_answer(retrieved, unavailable)
+        return result["response"], result
+    model_text, gen = parse_generation(gen_response, retrieved)
+    usage.update(model_token_usage(gen_response))
+    result = build_answer(model_text, gen, retrieved, degraded=degraded, usage=usage)
+    with stage_timer.stage("cache_store"):
+        store_answer(user_msg, top_k, conversation_history, result)
+    return model_text, result
+
+def stream_chat_turn(user_msg: str, conversation_history: List[Dict[str, str]], top_k: int):
+    """Streaming variant of run_chat_turn.
+
+    Yields ("token", text) for every delta and finally ("final", payload). The
+    generation deadline covers the whole stream, checked while waiting for
+    each chunk. Identical concurrent turns share one upstream stream, which
+    keeps going if this client disconnects while others still read it. If
+    generation fails before the first token, the retrieved passages are
+    served as in run_chat_turn.
+    """
+    with stage_timer.stage("cache_lookup"):
+        cached = lookup_cached_answer(user_msg, top_k, conversation_history)
+    if cached is not None:
+        yield "token", cached["response"]
+        yield "final", cached
+        return
+
+    retrieval = start_retrieval(user_msg, top_k)
+    tool_top_k = top_k if retrieval else 0
+    generation = None
+    try:
+        retrieved: List[Dict[str, Any]] = []
+        degraded = False
+        if GROUNDING_MODE == "inline":
+            retrieved, degraded = collect_retrieval(retrieval)
+
+        full_prompt, model, usage = build_generation(user_msg, conversation_history, retrieved, tool_top_k)
+        generation = generation_flights.join(_generation_key(full_prompt, tool_top_k, True),
+                                             pump_stream, model, full_prompt, init=SharedStream)
+        started = time.monotonic()
+        deadline = started + GENERATION_TIMEOUT_S
+        parts: List[str] = []
+        grounding: Dict[str, Any] = {}
+        unavailable = None
+        i = 0
+        while True:
+            try:
+                item = generation.data.get(i, timeout=max(0.0, deadline - time.monotonic()))
+            except FuturesTimeout:
+                vertex_errors.inc(call="generation", error="timeout")
+                raise StageTimeout("generation", GENERATION_TIMEOUT_S)
+            except Exception as e:
+                # Only before the first token: a half-streamed answer can't fall back
+                if parts or not upstream_unavailable(e):
+                    raise
+                unavailable = e
+                break
+            if item is SharedStream.END:
+                break
+            i += 1
+            delta = _response_text(item)
+            if delta:
+                if not parts:
+                    stage_timer.record("first_token", time.monotonic() - started)
+                parts.append(delta)
+                yield "token", delta
+            usage.update(model_token_usage(item))
+            if GROUNDING_MODE == "tool":
+                with stage_timer.stage("grounding"):
+                    g = extract_grounding_from_generation(item)
+                if g.get("grounding_chunks"):
+                    grounding = g
+
+        if GROUNDING_MODE != "inline":
+            retrieved, degraded = collect_retrieval(retrieval)
+    finally:
+        # Also runs on GeneratorExit when the client goes away mid-stream
+        if generation is not None:
+            generation.leave()
+        if retrieval:
+            retrieval[0].leave()
+    if unavailable is not None:
+        result = unavailable_answer(retrieved, unavailable)
+        yield "token", result["response"]
+        yield "final", result
+        return
+    raw_text = "".join(parts)
+    if GROUNDING_MODE == "inline":
+        with stage_timer.stage("grounding"):
+            gen = extract_grounding_from_inline_citations(raw_text, retrieved)
+    else:
+        gen = {**grounding, "text": raw_text}
+    result = build_answer(gen.get("text") or raw_text, gen, retrieved, degraded=degraded, usage=usage)
+    with stage_timer.stage("cache_store"):
+        store_answer(user_msg, top_k, conversation_history, result)
+    yield "final", result
+
+def _response_text(gen_response) -> str:
+    # .text raises when a (streamed) candidate carries no text part
+    try:
+        return gen_response.text or ""
+    except Exception:
+        return ""
+
+def parse_generation(gen_response, retrieved: List[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+    """Return (model_text, grounding) for a complete GenerationResponse."""
+    with stage_timer.stage("grounding"):
+        if GROUNDING_MODE == "inline":
+            gen = extract_grounding_from_inline_citations(_response_text(gen_response), retrieved)
+        else:
+            gen = extract_grounding_from_generation(gen_response)
+    model_text = gen.get("text") or _response_text(gen_response)
+    return model_text, gen
+
+def build_answer(model_text: str, gen: Dict[str, Any], retrieved: List[Dict[str, Any]],
+                 degraded: bool = False, usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """Number the citations and assemble the /chat response payload."""
+    if usage:
+        logger.info(f"Prompt tokens: {json.dumps(usage, sort_keys=True)}")
+    with stage_timer.stage("citations"):
+        idx_to_num, catalog = build_citation_catalog(gen.get("grounding_chunks", []), retrieved)
+        annotated = annotate_with_citations(model_text, gen.get("grounding_supports", []), idx_to_num)
+        sources_block = render_sources_block(catalog)
+    response_markdown = annotated + sources_block
+    return {
+        "response": model_text,
+        "annotated_text": annotated,
+        "response_markdown": response_markdown,
+        "sources": catalog,
+        "retrieved_contexts": retrieved,
+        "grounding_mode": GROUNDING_MODE,
+        "degraded": degraded,
+        "cached": False,
+        "usage": usage or {}
+    }
+
+def batch_items(payload: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Questions of a /chat/batch request as [{"query", "country"?}].
+
+    Takes "queries" (a list of strings) or "template" containing "{country}"
+    plus "countries". Raises ValueError for a malformed or oversized batch.
+    """
+    queries = payload.get("queries")
+    template = payload.get("template")
+    if queries is not None and template is not None:
+        raise ValueError("Send either 'queries' or 'template' with 'countries', not both.")
+    if template is not None:
+        countries = payload.get("countries")
+        if not isinstance(template, str) or "{country}" not in template:
+            raise ValueError("'template' must be a string containing {country}.")
+        if not isinstance(countries, list) or not all(isinstance(c, str) and c.strip() for c in countries):
+            raise ValueError("'countries' must be a list of country names.")
+        items = [{"query": template.replace("{country}", c.strip()), "country": c.strip()} for c in countries]
+    elif isinstance(queries, list) and all(isinstance(q, str) and q.strip() for q in queries):
+        items = [{"query": q.strip()} for q in queries]
+    else:
+        raise ValueError("Please include 'queries' (a list of questions) or 'template' and 'countries'.")
+    if not items:
+        raise ValueError("The batch is empty.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"At most {BATCH_MAX_ITEMS} questions per batch.")
+    return items
+
+def batch_width() -> int:
+    """Batch questions answered at once; 0 when the user's only admission slot must stay free for /chat."""
+    width = max(1, min(BATCH_CONCURRENCY, chat_admission.max_in_flight))
+    if chat_admission.max_per_user > 0:
+        width = min(width, chat_admission.max_per_user - 1)
+    return width
+
+def run_batch_item(index: int, item: Dict[str, str], top_k: int, version: int, fields: Tuple[str, ...],
+                   stop: threading.Event, user: Optional[str]) -> Dict[str, Any]:
+    """Answer one batch question; failures become an error line instead of raising.
+
+    The question holds an admission slot of its own while it runs, like a /chat.
+    """
+    line: Dict[str, Any] = {"index": index, **item}
+    batch_rate_limiter.acquire()
+    if stop.is_set():
+        return {**line, "ok": False, "status": 499, "error": "Batch cancelled"}
+    try:
+        ticket = chat_admission.acquire(user)
+    except Overloaded as e:
+        logger.warning(f"Rejected batch item {index} ({e.status}): {e.reason}")
+        return {**line, "ok": False, "status": e.status, "error": e.reason}
+    started = time.perf_counter()
+    try:
+        _, result = run_chat_turn(item["query"], [], top_k)
+        line.update(ok=True, status=200, result=format_answer(result, version, fields))
+    except StageTimeout as e:
+        logger.error(f"Batch item {index} deadline exceeded: {e}")
+        line.update(ok=False, status=504, error="The answer took too long, please try again.")
+    except VertexUnavailable as e:
+        logger.error(f"Batch item {index} unavailable: {e}")
+        line.update(ok=False, status=503, error="The assistant is temporarily unavailable, please try again shortly.")
+    except Exception as e:
+        logger.error(f"Error in batch item {index}: {e}")
+        line.update(ok=False, status=500, error=str(e))
+    finally:
+        ticket.release()
+    line["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return line
+
+# Compact (v2) response format: one answer text, no chunk texts inside sources;
+# each distinct context text is sent once, truncated, and referenced by index.
+RESPONSE_FIELDS = ("answer", "text", "markdown", "sources", "retrieved", "contexts", "meta", "usage")
+DEFAULT_RESPONSE_FIELDS = ("answer", "sources", "contexts", "meta")
+
+def requested_format(payload: Dict[str, Any]) -> Tuple[int, Tuple[str, ...]]:
+    """(version, fields) from the request body, or ?v=&fields= in the URL.
+
+    Version 1 (the default) is the full payload; fields only apply to v2.
+    Raises ValueError for an unknown version or field.
+    """
+    version = payload.get("v") or request.args.get("v") or 1
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unknown response version '{version}'")
+    if version not in (1, 2):
+        raise ValueError(f"Unknown response version '{version}'")
+    fields = payload.get("fields") or request.args.get("fields")
+    if not fields:
+        return version, DEFAULT_RESPONSE_FIELDS
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    fields = tuple(f.strip() for f in fields if f and f.strip())
+    unknown = [f for f in fields if f not in RESPONSE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s) {', '.join(unknown)}; choose from {', '.join(RESPONSE_FIELDS)}")
+    return version, fields
+
+def _preview(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > limit // 2 else cut).rstrip() + "…"
+
+def compact_answer(result: Dict[str, Any], fields: Tuple[str, ...] = DEFAULT_RESPONSE_FIELDS,
+                   preview_chars: int = COMPACT_PREVIEW_CHARS) -> Dict[str, Any]:
+    """Render a build_answer() payload in the v2 format with the selected fields."""
+    out: Dict[str, Any] = {"v": 2}
+    if "answer" in fields:
+        out["answer"] = result.get("annotated_text") or result.get("response") or ""
+    if "text" in fields:
+        out["text"] = result.get("response") or ""
+    if "markdown" in fields:
+        out["markdown"] = result.get("response_markdown") or ""
+
+    with_contexts = "contexts" in fields
+    contexts: List[str] = []
+    context_ids: Dict[str, int] = {}
+
+    def entry(item: Dict[str, Any], uri_key: str) -> Dict[str, Any]:
+        e = {"uri": item.get(uri_key), "title": item.get("title"), "score": item.get("score"),
+             "page_number": item.get("page_number"), "page_range": item.get("page_range")}
+        e = {k: v for k, v in e.items() if v is not None}
+        text = item.get("text")
+        if with_contexts and text:
+            ctx = context_ids.get(text)
+            if ctx is None:
+                ctx = context_ids[text] = len(contexts)
+                contexts.append(_preview(text, preview_chars))
+            e["ctx"] = ctx
+        return e
+
+    if "sources" in fields:
+        out["sources"] = [entry(src, "uri") for src in result.get("sources") or []]
+    if "retrieved" in fields:
+        out["retrieved"] = [entry(c, "source_uri") for c in result.get("retrieved_contexts") or []]
+    if with_contexts:
+        out["contexts"] = contexts
+    if "meta" in fields:
+        out["grounding_mode"] = result.get("grounding_mode")
+        out["degraded"] = result.get("degraded", False)
+        out["cached"] = result.get("cached", False)
+    if "usage" in fields:
+        out["usage"] = result.get("usage") or {}
+    return out
+
+def format_answer(result: Dict[str, Any], version: int, fields: Tuple[str, ...]) -> Dict[str, Any]:
+    return compact_answer(result, fields) if version == 2 else result
+
+# -----------------------------
+# Warm-up
+# -----------------------------
+
+class Warmup:
+    """Background warm-up of the Vertex SDK and clients, reported by /readyz.
+
+    Every step is best effort and gets WARMUP_STEP_TIMEOUT_S: a step that
+    fails or hangs (no credentials yet, Vertex hiccup) is logged and left
+    to the first chat. The instance turns ready when the warm-up ends,
+    however it ends; a failed SDK import is reported in the status.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.started = time.perf_counter()
+        self.steps: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.retrieval_primed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if not WARMUP_ENABLED:
+            self.ready.set()
+            return
+        self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def _step(self, name: str, fn, *args):
+        """fn(*args) on its own thread; raises TimeoutError after WARMUP_STEP_TIMEOUT_S (the call runs on)."""
+        start = time.perf_counter()
+        future: Future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"warmup-{name}", daemon=True).start()
+        try:
+            return future.result(timeout=WARMUP_STEP_TIMEOUT_S)
+        except FuturesTimeout:
+            raise TimeoutError(f"warm-up step '{name}' took longer than {WARMUP_STEP_TIMEOUT_S:g}s")
+        finally:
+            self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    def _run(self) -> None:
+        try:
+            self._warm()
+        except Exception as e:
+            logger.error(f"Warm-up stopped: {type(e).__name__}: {e}")
+        finally:
+            self.ready.set()
+            logger.info(f"Warm-up finished in {self.elapsed_ms():.0f} ms: {json.dumps(self.steps)}")
+
+    def _warm(self) -> None:
+        try:
+            self._step("sdk_import", vertex_sdk)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.error(f"Warm-up could not import the Vertex SDK, chats will retry it: {self.error}")
+            return
+        if PROJECT_ID and RAG_CORPUS:
+            try:
+                self._step("clients", lambda: ([get_rag_resources(s) for s in RAG_SHARDS], get_retrieval_config(5),
+                                               get_generative_model(top_k=5, with_rag_tool=GROUNDING_MODE == "tool")))
+                # Opens each shard's RAG channel and fetches credentials for the first chat
+                self._step("retrieval", lambda: [_retrieval_query(WARMUP_QUERY, 1, s) for s in RAG_SHARDS])
+                self.retrieval_primed = True
+            except Exception as e:
+                logger.warning(f"Warm-up incomplete, the first chat will finish the setup: {e}")
+        if GOOGLE_CLIENT_ID:
+            try:
+                # Discovery and signing keys, so a login only waits for the code exchange
+                self._step("oidc", oidc_provider.warm)
+            except Exception as e:
+                logger.warning(f"Could not prefetch the OIDC discovery document and keys: {e}")
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "status": "ready" if self.ready.is_set() else "warming",
+            "warmup": "enabled" if WARMUP_ENABLED else "disabled",
+            "steps_ms": dict(self.steps),
+            "retrieval_primed": self.retrieval_primed,
+            "error": self.error,
+        }
+
+warmup = Warmup()
+warmup.start()
+
 # -----------------------------
 # OAuth Routes
 # -----------------------------
@@ -310,7 +1741,8 @@ def login():
         # Start OAuth flow - ensure HTTPS for production
         redirect_uri = request.url_root.rstrip('/').replace('http://', 'https://') + '/login/callback'
         google = OAuth2Session(GOOGLE_CLIENT_ID, scope=["openid", "email", "profile"], redirect_uri=redirect_uri)
-        authorization_url, state = google.authorization_url(AUTHORIZATION_BASE_URL, access_type="offline", prompt="select_account")
+        authorization_url, state = google.authorization_url(get_google_provider_cfg()["authorization_endpoint"],
+                                                            access_type="offline", prompt="select_account")
         session['oauth_state'] = state
         return redirect(authorization_url)
     except Exception as e:
@@ -328,15 +1760,22 @@ def callback():
         # Fix authorization_response URL to use HTTPS
         auth_response = request.url.replace('http://', 'https://')
         
-        google = OAuth2Session(GOOGLE_CLIENT_ID, state=session['oauth_state'], redirect_uri=redirect_uri)
-        token = google.fetch_token(TOKEN_URL, client_secret=GOOGLE_CLIENT_SECRET, authorization_response=auth_response)
+        with stage_timer.stage("oauth_token"):
+            token = oidc_provider.exchange_code(auth_response, session['oauth_state'], redirect_uri,
+                                                GOOGLE_CLIENT_SECRET)
         
-        resp = google.get(USERINFO_URL)
-        user_info = resp.json()
+        # The id_token is verified locally against the cached signing keys,
+        # so the userinfo round trip is only needed when there is none
+        if token.get('id_token'):
+            with stage_timer.stage("oauth_id_token"):
+                user_info = oidc_provider.verify_id_token(token['id_token'])
+        else:
+            with stage_timer.stage("oauth_userinfo"):
+                user_info = oidc_provider.userinfo(token['access_token'])
         
         session['user'] = {
             'id': user_info['sub'],
-            'name': user_info['name'],
+            'name': user_info.get('name') or user_info.get('email'),
             'email': user_info['email'],
             'picture': user_info.get('picture')
         }
@@ -348,6 +1787,8 @@ def callback():
 
 @app.route('/logout')
 def logout():
+    if session.get('cid'):
+        conversation_store.clear(session['cid'])
     session.clear()
     return redirect(url_for('home'))
 
@@ -365,74 +1806,221 @@ def home():
 def healthz():
     return jsonify(status="ok"), 200
 
+@app.get("/readyz")
+def readyz():
+    """200 once the first chat won't pay for SDK import and client setup, else 503."""
+    if warmup.ready.is_set():
+        return jsonify(warmup.status()), 200
+    resp = jsonify(warmup.status())
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+@app.get("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify(error="Metrics are disabled"), 404
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return jsonify(error="Unauthorized"), 401
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+@login_required
+def cache_stats():
+    return jsonify(
+        answers=answer_cache.stats() if answer_cache else None,
+        retrieval=retrieval_cache.stats() if retrieval_cache else None,
+        semantic=semantic_cache.stats() if semantic_cache else None,
+    ), 200
+
 @app.post("/clear")
 @login_required
 def clear_conversation():
-    session.pop('conversation', None)
+    conversation_store.clear(current_conversation_id())
     return jsonify(status="cleared"), 200
 
 @app.post("/chat")
 @login_required
+@admission_controlled
 def chat():
     try:
         if not PROJECT_ID or not RAG_CORPUS:
-            return jsonify(error="Server missing GOOGLE_CLOUD_PROJECT/PROJECT_ID or RAG_CORPUS_RESOURCE"), 500
+            return jsonify(error="Server missing GOOGLE_CLOUD_PROJECT/PROJECT_ID or RAG_CORPUS_RESOURCE/RAG_CORPORA"), 500
 
         payload = request.get_json(silent=True) or {}
         user_msg = (payload.get("message") or "").strip()
-        top_k = int(payload.get("top_k") or 5)
         if not user_msg:
             return jsonify(error="Please include a 'message' field."), 400
+        try:
+            top_k = depth_policy.top_k(payload.get("top_k"))
+            version, fields = requested_format(payload)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
 
-        # Get conversation history from session
-        if 'conversation' not in session:
-            session['conversation'] = []
-        
-        conversation_history = session['conversation'][-4:]  # Keep last 4 exchanges
-        
-        # Build conversation context
-        context = ""
-        if conversation_history:
-            context = "\n\nPrevious conversation context:\n"
-            for exchange in conversation_history:
-                context += f"User: {exchange['user']}\nSystem: {exchange['bot']}\n"
-        
-        # Combine system prompt with context and current query
-        full_prompt = f"{SYSTEM_PROMPT}{context}\n\nCurrent User Query: {user_msg}"
-        
-        retrieved = retrieve_contexts(user_msg, top_k=top_k)
-        model = GenerativeModel(model_name=MODEL_NAME, tools=[build_rag_tool(top_k=top_k)])
-        gen_response = model.generate_content(full_prompt)
-        gen = extract_grounding_from_generation(gen_response)
-        model_text = gen.get("text") or getattr(gen_response, "text", "") or ""
+        with stage_timer.stage("session"):
+            cid = current_conversation_id()
+            conversation_history = conversation_store.history(cid)
+        g.history_turns = len(conversation_history)
 
-        idx_to_num, catalog = build_citation_catalog(gen.get("grounding_chunks", []), retrieved)
-        annotated = annotate_with_citations(model_text, gen.get("grounding_supports", []), idx_to_num)
-        sources_block = render_sources_block(catalog)
-        response_markdown = annotated + sources_block
-
-        # Store conversation in session
-        session['conversation'].append({
-            'user': user_msg,
-            'bot': model_text[:200]  # Store truncated response
-        })
-        
-        # Keep only last 5 exchanges
-        if len(session['conversation']) > 5:
-            session['conversation'] = session['conversation'][-5:]
+        model_text, result = run_chat_turn(user_msg, conversation_history, top_k)
+        with stage_timer.stage("session"):
+            conversation_store.append(cid, user_msg, model_text[:CONVERSATION_BOT_CHARS])
         
-        return jsonify({
-            "response": model_text,
-            "annotated_text": annotated,
-            "response_markdown": response_markdown,
-            "sources": catalog,
-            "retrieved_contexts": retrieved
-        })
+        return jsonify(format_answer(result, version, fields))
 
+    except StageTimeout as e:
+        logger.error(f"Chat deadline exceeded: {e}")
+        return jsonify(error="The answer took too long, please try again."), 504
+    except VertexUnavailable as e:
+        logger.error(f"Chat unavailable: {e}")
+        resp = jsonify(error="The assistant is temporarily unavailable, please try again shortly.")
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(int(e.retry_after + 0.999))
+        return resp
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
         return jsonify(error=str(e)), 500
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+@login_required
+@admission_controlled
+def chat_stream():
+    """Stream the answer as Server-Sent Events.
+
+    Emits `token` events with text deltas as Gemini generates them, then one
+    `final` event with the annotated text and sources (or an `error` event).
+    """
+    if not PROJECT_ID or not RAG_CORPUS:
+        return jsonify(error="Server missing GOOGLE_CLOUD_PROJECT/PROJECT_ID or RAG_CORPUS_RESOURCE/RAG_CORPORA"), 500
+
+    payload = request.get_json(silent=True) or {}
+    user_msg = (payload.get("message") or "").strip()
+    if not user_msg:
+        return jsonify(error="Please include a 'message' field."), 400
+    try:
+        top_k = depth_policy.top_k(payload.get("top_k"))
+        version, fields = requested_format(payload)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    # Resolve the id now: the session cookie is sent before the answer exists
+    with stage_timer.stage("session"):
+        cid = current_conversation_id()
+        conversation_history = conversation_store.history(cid)
+    g.history_turns = len(conversation_history)
+    timings = stage_timer.current()
+
+    def generate():
+        token = stage_timer.resume(timings)
+        status = 200
+        sent = 0
+        try:
+            for event, data in stream_chat_turn(user_msg, conversation_history, top_k):
+                if event == "final":
+                    with stage_timer.stage("session"):
+                        conversation_store.append(cid, user_msg, data["response"][:CONVERSATION_BOT_CHARS])
+                    data = format_answer(data, version, fields)
+                chunk = _sse(event, {"text": data} if event == "token" else data)
+                sent += len(chunk.encode("utf-8"))
+                yield chunk
+        except StageTimeout as e:
+            status = 504
+            logger.error(f"Chat stream deadline exceeded: {e}")
+            yield _sse("error", {"error": "The answer took too long, please try again."})
+        except VertexUnavailable as e:
+            status = 503
+            logger.error(f"Chat stream unavailable: {e}")
+            yield _sse("error", {"error": "The assistant is temporarily unavailable, please try again shortly.",
+                                 "retry_after": int(e.retry_after + 0.999)})
+        except Exception as e:
+            status = 500
+            logger.error(f"Error in chat stream: {e}")
+            yield _sse("error", {"error": str(e)})
+        finally:
+            if timings is not None:
+                finish_request_timing(timings, "chat_stream", status)
+            if query_log is not None:
+                record_query("chat_stream", status, sent)
+            stage_timer.end(token)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/chat/batch")
+@login_required
+def chat_batch():
+    """Answer many independent questions, streaming one NDJSON line per answer.
+
+    Each question goes through the /chat pipeline without conversation
+    history. Lines arrive in completion order (with their "index"); a failed
+    question gives an error line and the batch goes on. The last line is a
+    {"done": true, ...} summary. Admission is per question (run_batch_item),
+    not per batch.
+    """
+    if not PROJECT_ID or not RAG_CORPUS:
+        return jsonify(error="Server missing GOOGLE_CLOUD_PROJECT/PROJECT_ID or RAG_CORPUS_RESOURCE/RAG_CORPORA"), 500
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        top_k = depth_policy.top_k(payload.get("top_k"))
+        items = batch_items(payload)
+        version, fields = requested_format(payload)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    width = batch_width()
+    if width == 0:
+        return jsonify(error="Batches are not available: each user may only run one chat at a time."), 429
+    timings = stage_timer.current()
+    user = (session.get('user') or {}).get('id')
+
+    def generate():
+        token = stage_timer.resume(timings)
+        stop = threading.Event()
+        todo = iter(enumerate(items))
+        pending = set()
+        failed = 0
+        started = time.perf_counter()
+
+        def submit_next() -> None:
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.add(stage_timer.submit(_batch_executor, run_batch_item, *nxt, top_k, version, fields, stop,
+                                                 user))
+
+        try:
+            for _ in range(width):
+                submit_next()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    submit_next()
+                    line = future.result()
+                    failed += not line["ok"]
+                    yield json.dumps(line) + "\n"
+            yield json.dumps({"done": True, "total": len(items), "ok": len(items) - failed, "failed": failed,
+                              "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}) + "\n"
+        finally:
+            # Client gone: drop the questions that haven't started
+            stop.set()
+            for future in pending:
+                future.cancel()
+            if timings is not None:
+                finish_request_timing(timings, "chat_batch", 200)
+            stage_timer.end(token)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
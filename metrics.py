@@ -0,0 +1,230 @@
+"""Per-request stage timing and a small Prometheus text-format registry.
+
+Deliberately dependency-free: a handful of counters and histograms guarded by
+one lock each, plus gauges that read their value at scrape time.
+"""
+import contextvars
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Seconds; covers cache hits (ms) up to generation deadlines (60s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in items]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(counts), total)) for k, (counts, total) in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose samples are read from `fn` at scrape time.
+
+    `fn` returns {label values tuple: value}; use () as the key when the metric
+    has no labels.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, labels: Tuple[str, ...],
+                 fn: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(labels)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.fn().items()):
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name: str, help: str, fn: Callable[[], Dict[Tuple[str, ...], float]],
+                 labels: Tuple[str, ...] = (), kind: str = "gauge") -> CallbackMetric:
+        return self._add(CallbackMetric(name, help, kind, labels, fn))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """Stage durations of one request. Stages may be recorded from worker threads."""
+
+    __slots__ = ("started", "stages", "_lock")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        # A stage that runs more than once (e.g. streamed chunks) accumulates
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_ms(self) -> Dict[str, float]:
+        with self._lock:
+            stages = dict(self.stages)
+        return {name: round(seconds * 1000, 1) for name, seconds in stages.items()}
+
+    def server_timing(self, total: bool = True) -> str:
+        """Value for the Server-Timing response header."""
+        entries = [f"{name};dur={ms}" for name, ms in self.as_ms().items()]
+        if total:
+            entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+class StageTimer:
+    """Times pipeline stages into the current request's RequestTimings.
+
+    The current request is tracked in a context variable; work submitted to
+    thread pools must run under contextvars.copy_context() (see submit) for
+    its stages to be attributed. With timing disabled and no histogram, every
+    call is a no-op.
+    """
+
+    def __init__(self, enabled: bool = True, histogram: Optional[Histogram] = None):
+        self.enabled = enabled or histogram is not None
+        self.histogram = histogram
+        self._current: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+    def begin(self) -> Optional[contextvars.Token]:
+        if not self.enabled:
+            return None
+        return self._current.set(RequestTimings())
+
+    def resume(self, timings: Optional[RequestTimings]) -> Optional[contextvars.Token]:
+        """Make `timings` current again, e.g. inside a streamed response body."""
+        if not self.enabled or timings is None:
+            return None
+        return self._current.set(timings)
+
+    def end(self, token: Optional[contextvars.Token]) -> None:
+        if token is not None:
+            try:
+                self._current.reset(token)
+            except ValueError:
+                # Token from another context (a streamed body finishing elsewhere)
+                self._current.set(None)
+
+    def current(self) -> Optional[RequestTimings]:
+        return self._current.get()
+
+    def record(self, stage: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        timings = self._current.get()
+        if timings is not None:
+            timings.add(stage, seconds)
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=stage)
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @staticmethod
+    def submit(executor, fn, *args, **kwargs):
+        """executor.submit that carries the current request's timings along."""
+        return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,181 @@
+"""OpenID Connect helpers for the Google login.
+
+One pooled keep-alive HTTP session, the discovery document and the signing
+keys (JWKS) cached for their Cache-Control max-age (or a default TTL), and
+local verification of the id_token returned by the token exchange. With the
+cache warm, a login costs one upstream round trip: the code exchange.
+"""
+import base64
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Used when discovery can't be fetched and nothing is cached yet
+GOOGLE_ENDPOINTS = {
+    "issuer": "https://accounts.google.com",
+    "authorization_endpoint": "https://accounts.google.com/o/oauth2/v2/auth",
+    "token_endpoint": "https://oauth2.googleapis.com/token",
+    "userinfo_endpoint": "https://openidconnect.googleapis.com/v1/userinfo",
+    "jwks_uri": "https://www.googleapis.com/oauth2/v3/certs",
+}
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class OIDCError(Exception):
+    """The provider answered with something we can't accept (bad token, missing key)."""
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """A requests session keeping up to pool_size connections alive per host."""
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+class CachedDocument:
+    """A JSON document fetched on first use and refreshed once it expires.
+
+    The lifetime is the response's Cache-Control max-age, else `ttl`. When a
+    refresh fails the stale copy keeps being served (and retried after
+    `retry_after` seconds). Thread-safe; concurrent misses share one fetch.
+    """
+
+    def __init__(self, fetch: Callable[[], requests.Response], ttl: float, retry_after: float = 30.0):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._value: Optional[Dict[str, Any]] = None
+        self._expires = 0.0
+        self.fetches = 0
+
+    def get(self, refresh: bool = False) -> Dict[str, Any]:
+        value = self._value
+        if value is not None and not refresh and time.monotonic() < self._expires:
+            return value
+        with self._lock:
+            if self._value is not None and not refresh and time.monotonic() < self._expires:
+                return self._value
+            try:
+                resp = self._fetch()
+                resp.raise_for_status()
+                self._value = resp.json()
+                m = _MAX_AGE_RE.search(resp.headers.get("Cache-Control", ""))
+                self._expires = time.monotonic() + (int(m.group(1)) if m else self.ttl)
+            except Exception:
+                if self._value is None:
+                    raise
+                self._expires = time.monotonic() + self.retry_after
+            finally:
+                self.fetches += 1
+            return self._value
+
+
+def _b64_int(value: str) -> int:
+    return int.from_bytes(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)), "big")
+
+
+def jwk_to_pem(jwk: Dict[str, Any]) -> bytes:
+    """PEM public key for an RSA JWK."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
+
+    key = RSAPublicNumbers(_b64_int(jwk["e"]), _b64_int(jwk["n"])).public_key()
+    return key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+class OIDCProvider:
+    """Discovery, JWKS, code exchange and id_token verification for one client."""
+
+    def __init__(self, discovery_url: str, client_id: Optional[str], http: requests.Session,
+                 ttl: float = 3600.0, timeout: float = 10.0, clock_skew: int = 60):
+        self.client_id = client_id
+        self.http = http
+        self.timeout = timeout
+        self.clock_skew = clock_skew
+        self.discovery = CachedDocument(lambda: http.get(discovery_url, timeout=timeout), ttl)
+        self.jwks = CachedDocument(lambda: http.get(self.config()["jwks_uri"], timeout=timeout), ttl)
+        self._pems: Dict[str, bytes] = {}
+        self._pems_for: Optional[Dict[str, Any]] = None
+        self._key_refetched = 0.0
+
+    def config(self) -> Dict[str, Any]:
+        """The discovery document, or Google's well-known endpoints when it can't be fetched."""
+        try:
+            return self.discovery.get()
+        except Exception:
+            return GOOGLE_ENDPOINTS
+
+    def warm(self) -> None:
+        """Fetch discovery and JWKS ahead of the first login."""
+        self.discovery.get()
+        self.jwks.get()
+
+    def _keys(self, kid: Optional[str]) -> Dict[str, bytes]:
+        jwks = self.jwks.get()
+        if kid not in self._pems_map(jwks) and time.monotonic() - self._key_refetched > 60:
+            # Keys rotated since the last fetch; refetch at most once a minute
+            self._key_refetched = time.monotonic()
+            jwks = self.jwks.get(refresh=True)
+        return self._pems_map(jwks)
+
+    def _pems_map(self, jwks: Dict[str, Any]) -> Dict[str, bytes]:
+        if self._pems_for is not jwks:
+            self._pems = {k["kid"]: jwk_to_pem(k) for k in jwks.get("keys", []) if k.get("kty") == "RSA"}
+            self._pems_for = jwks
+        return self._pems
+
+    def exchange_code(self, authorization_response: str, state: str, redirect_uri: str,
+                      client_secret: str) -> Dict[str, Any]:
+        """Check the callback's state and trade its code for tokens.
+
+        Raises oauthlib errors for a bad callback and requests.HTTPError when
+        the token endpoint refuses the code.
+        """
+        from oauthlib.oauth2 import WebApplicationClient
+
+        client = WebApplicationClient(self.client_id)
+        code = client.parse_request_uri_response(authorization_response, state=state)["code"]
+        body = client.prepare_request_body(code=code, redirect_uri=redirect_uri, client_secret=client_secret)
+        resp = self.http.post(self.config()["token_endpoint"], data=body, timeout=self.timeout,
+                              headers={"Accept": "application/json",
+                                       "Content-Type": "application/x-www-form-urlencoded"})
+        resp.raise_for_status()
+        return resp.json()
+
+    def verify_id_token(self, id_token: str) -> Dict[str, Any]:
+        """Claims of an id_token after checking signature, expiry, audience and issuer."""
+        from google.auth import jwt
+
+        try:
+            kid = jwt.decode_header(id_token).get("kid")
+            keys = self._keys(kid)
+            if kid not in keys:
+                raise OIDCError(f"id_token signed with unknown key '{kid}'")
+            claims = jwt.decode(id_token, certs={kid: keys[kid]}, audience=self.client_id,
+                                clock_skew_in_seconds=self.clock_skew)
+        except OIDCError:
+            raise
+        except Exception as e:
+            raise OIDCError(f"id_token rejected: {e}") from e
+        issuer = self.config().get("issuer", "")
+        # Google also issues tokens with the scheme-less form of its issuer
+        if claims.get("iss") not in (issuer, issuer.replace("https://", "", 1)):
+            raise OIDCError(f"id_token from unexpected issuer '{claims.get('iss')}'")
+        return claims
+
+    def userinfo(self, access_token: str) -> Dict[str, Any]:
+        """Profile from the userinfo endpoint (only when no id_token came back)."""
+        resp = self.http.get(self.config()["userinfo_endpoint"], timeout=self.timeout,
+                             headers={"Authorization": f"Bearer {access_token}"})
+        resp.raise_for_status()
+        return resp.json()
+
+    def stats(self) -> Dict[str, int]:
+        return {"discovery_fetches": self.discovery.fetches, "jwks_fetches": self.jwks.fetches}
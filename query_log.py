@@ -0,0 +1,131 @@
+"""Opt-in recorder of chat traffic, for replaying production load (replay_queries.py).
+
+record() only puts the event on a bounded queue and never blocks the
+request: when the queue is full the event is dropped and counted. A daemon
+thread appends the events as JSON lines to <directory>/queries-<host>-<pid>.jsonl
+(one file per process, so gunicorn workers never interleave lines). Once the
+file reaches max_bytes it is renamed with a timestamp and a new one is
+started; only the newest `backups` rotated files are kept.
+
+User and conversation ids are replaced by salted hashes, stable across
+processes that share the salt, so sessions can still be told apart.
+"""
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class QueryLogRecorder:
+    def __init__(self, directory: str, salt: str, max_bytes: int = 50 * 1024 * 1024, backups: int = 10,
+                 queue_size: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._salt = salt.encode()
+        self._queue_size = queue_size
+        self._queue: Optional[queue.Queue] = None
+        self._pid: Optional[int] = None
+        self._prefix = ""
+        self.path = ""
+        self._file = None
+        self._size = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def anonymize(self, value: Optional[str]) -> Optional[str]:
+        if not value:
+            return None
+        return hmac.new(self._salt, str(value).encode(), hashlib.sha256).hexdigest()[:16]
+
+    def record(self, event: Dict[str, Any]) -> bool:
+        """Queue one event; False (and counted as dropped) when the writer is behind."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def _ensure_started(self) -> None:
+        # Started on first use in each process: gunicorn workers fork after import
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._prefix = f"queries-{socket.gethostname()}-{os.getpid()}"
+            self.path = os.path.join(self.directory, f"{self._prefix}.jsonl")
+            self._file = None
+            self._queue = queue.Queue(maxsize=self._queue_size)
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name="query-log", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, events: queue.Queue) -> None:
+        while True:
+            event = events.get()
+            if event is _STOP:
+                break
+            try:
+                self._write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logger.warning(f"Query log write failed: {e}")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line: str) -> None:
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._size = self._file.tell()
+        self._file.write(line)
+        # One line per event, readable by a replay while the service runs
+        self._file.flush()
+        self._size += len(line.encode("utf-8"))
+        with self._lock:
+            self.written += 1
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        os.replace(self.path, os.path.join(self.directory, f"{self._prefix}-{time.time_ns()}.jsonl"))
+        rotated = sorted(glob.glob(os.path.join(self.directory, f"{self._prefix}-*.jsonl")))
+        for old in rotated[:max(0, len(rotated) - self.backups)]:
+            os.remove(old)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write out the queued events and stop the writer thread."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"written": self.written, "dropped": self.dropped, "errors": self.errors,
+                    "queued": self._queue.qsize() if self._queue is not None else 0}
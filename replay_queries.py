@@ -0,0 +1,226 @@
+"""Replay a recorded query log (QUERY_LOG_ENABLED=1) against a policy bot instance.
+
+Reads the JSONL files written by query_log.py and sends every /chat and
+/chat/stream request again with its recorded message and top_k. Requests
+start on the recorded schedule (--speed 1), compressed N times (--speed N)
+or at a fixed rate (--qps Q); the requests of one recorded conversation go
+out in their recorded order, each only after the previous one has answered.
+Reports latency percentiles, the status mix and the error rate.
+
+By default the replay runs against a local gunicorn on the fake Vertex SDK
+(see loadtest.py). With --url it targets a running instance instead, which
+must use --secret-key as its SECRET_KEY so the replay can sign in its users.
+
+    python replay_queries.py /tmp/policy_bot_query_log --speed 4
+    python replay_queries.py queries.jsonl --qps 20 --output replay.json
+    python replay_queries.py logs/ --url http://localhost:8080 --secret-key "$SECRET_KEY"
+"""
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+import requests
+
+from loadtest import SECRET_KEY, free_port, percentile, session_cookie, start_server
+
+ENDPOINT_PATHS = {"chat": "/chat", "chat_stream": "/chat/stream"}
+
+
+def load_events(paths: List[str]) -> List[Dict[str, Any]]:
+    """Recorded chat events from files and directories of *.jsonl, oldest first."""
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, "*.jsonl"))) if os.path.isdir(path) else [path]
+    events = []
+    for name in files:
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash or rotation
+                if event.get("endpoint") in ENDPOINT_PATHS and event.get("query") and "ts" in event:
+                    events.append(event)
+    events.sort(key=lambda e: e["ts"])
+    return events
+
+
+def schedule(events: List[Dict[str, Any]], speed: float, qps: float) -> Dict[str, List[tuple]]:
+    """(offset seconds, event) lists per recorded conversation, in recorded order."""
+    sessions: Dict[str, List[tuple]] = defaultdict(list)
+    t0 = events[0]["ts"]
+    for i, event in enumerate(events):
+        offset = i / qps if qps else (event["ts"] - t0) / speed
+        key = event.get("session") or event.get("user") or f"anonymous-{i}"
+        sessions[key].append((offset, event))
+    return sessions
+
+
+def send(http: requests.Session, base_url: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    payload = {k: event[k] for k in ("top_k", "v") if event.get(k) is not None}
+    payload["message"] = event["query"]
+    endpoint = event["endpoint"]
+    result = {"endpoint": endpoint, "error": None}
+    start = time.perf_counter()
+    try:
+        with http.post(base_url + ENDPOINT_PATHS[endpoint], json=payload, timeout=180,
+                       stream=endpoint == "chat_stream") as resp:
+            result["status"] = resp.status_code
+            if endpoint == "chat_stream" and resp.ok:
+                for line in resp.iter_lines(decode_unicode=True):
+                    if line == "event: token" and "first_token_ms" not in result:
+                        result["first_token_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                    elif line == "event: error":
+                        result["error"] = "stream error event"
+            else:
+                resp.content  # read the whole body so the timing covers it
+    except requests.RequestException as e:
+        result["status"] = "error"
+        result["error"] = type(e).__name__
+    result["ms"] = round((time.perf_counter() - start) * 1000, 1)
+    result["ok"] = result["status"] == 200 and result["error"] is None
+    return result
+
+
+def replay(base_url: str, sessions: Dict[str, List[tuple]], secret_key: str) -> Dict[str, Any]:
+    results = []
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, peak
+    started = time.monotonic() + 0.5  # let every session thread get going first
+
+    def conversation(key: str, timeline: List[tuple]):
+        http = requests.Session()
+        user = timeline[0][1].get("user") or key
+        http.cookies.set("session", session_cookie(f"replay-{user}", secret_key))
+        for offset, event in timeline:
+            wait = started + offset - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            lag = max(0.0, -wait) * 1000
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            result = send(http, base_url, event)
+            result.update(session=key, offset_s=round(offset, 3), lag_ms=round(lag, 1),
+                          recorded_ms=event.get("total_ms"), recorded_status=event.get("status"))
+            with lock:
+                in_flight[0] -= 1
+                results.append(result)
+
+    threads = [threading.Thread(target=conversation, args=item, daemon=True) for item in sessions.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {"results": results, "elapsed_s": time.monotonic() - started, "peak_in_flight": in_flight[1]}
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {f"p{p}": percentile(values, p) for p in (50, 90, 95, 99)} | {"max": max(values, default=0.0)}
+
+
+def summarize(run: Dict[str, Any]) -> Dict[str, Any]:
+    results = run["results"]
+    ok = [r for r in results if r["ok"]]
+    summary = {
+        "requests": len(results),
+        "elapsed_s": round(run["elapsed_s"], 2),
+        "achieved_qps": round(len(results) / run["elapsed_s"], 2) if run["elapsed_s"] > 0 else 0.0,
+        "peak_in_flight": run["peak_in_flight"],
+        "statuses": dict(Counter(str(r["status"]) for r in results)),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "recorded_error_rate": round(sum(r["recorded_status"] != 200 for r in results) / len(results), 4)
+        if results else 0.0,
+        "latency_ms": latency_summary([r["ms"] for r in ok]),
+        "recorded_latency_ms": latency_summary([r["recorded_ms"] for r in results
+                                                if r["recorded_ms"] is not None and r["recorded_status"] == 200]),
+        "schedule_lag_ms": latency_summary([r["lag_ms"] for r in results]),
+        "by_endpoint": {},
+    }
+    for endpoint in sorted({r["endpoint"] for r in results}):
+        rows = [r for r in results if r["endpoint"] == endpoint]
+        rows_ok = [r for r in rows if r["ok"]]
+        summary["by_endpoint"][endpoint] = {
+            "requests": len(rows),
+            "error_rate": round(1 - len(rows_ok) / len(rows), 4),
+            "latency_ms": latency_summary([r["ms"] for r in rows_ok]),
+        }
+        first_tokens = [r["first_token_ms"] for r in rows_ok if "first_token_ms" in r]
+        if first_tokens:
+            summary["by_endpoint"][endpoint]["first_token_ms"] = latency_summary(first_tokens)
+    return summary
+
+
+def _fmt(latency: Dict[str, float]) -> str:
+    return "  ".join(f"{k} {v:.0f}" for k, v in latency.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("logs", nargs="+", help="query log files or directories")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay N times faster than recorded")
+    parser.add_argument("--qps", type=float, default=0, help="send at a fixed rate instead (requests/s)")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    parser.add_argument("--url", help="instance to replay against (default: a local fake-Vertex gunicorn)")
+    parser.add_argument("--secret-key", default=os.environ.get("SECRET_KEY", SECRET_KEY),
+                        help="the instance's SECRET_KEY, to sign the replayed users' sessions")
+    parser.add_argument("--threads", type=int, default=40, help="gunicorn threads (local instance)")
+    parser.add_argument("--retrieval-ms", type=float, default=300)
+    parser.add_argument("--generation-ms", type=float, default=1500)
+    parser.add_argument("--output", help="write the summary and per-request results as JSON")
+    args = parser.parse_args()
+    if args.speed <= 0 or args.qps < 0:
+        parser.error("--speed must be positive and --qps non-negative")
+
+    events = load_events(args.logs)
+    if args.limit:
+        events = events[:args.limit]
+    if not events:
+        parser.error("no chat events found in the query log")
+    sessions = schedule(events, args.speed, args.qps)
+
+    server = None
+    base_url = (args.url or "").rstrip("/")
+    if not base_url:
+        port = free_port()
+        server = start_server(port, "gthread", args.threads, {
+            "FAKE_VERTEX_RETRIEVAL_MS": str(args.retrieval_ms),
+            "FAKE_VERTEX_GENERATION_MS": str(args.generation_ms),
+        })
+        base_url = f"http://127.0.0.1:{port}"
+        args.secret_key = SECRET_KEY
+    try:
+        run = replay(base_url, sessions, args.secret_key)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(run)
+    pace = f"qps={args.qps:g}" if args.qps else f"speed={args.speed:g}x"
+    print(f"replayed {summary['requests']} requests from {len(sessions)} conversations, {pace}, "
+          f"in {summary['elapsed_s']:.1f}s ({summary['achieved_qps']:.2f} req/s, "
+          f"peak {summary['peak_in_flight']} in flight)")
+    print(f"  statuses:       {summary['statuses']}  error rate {summary['error_rate']:.2%} "
+          f"(recorded {summary['recorded_error_rate']:.2%})")
+    print(f"  latency ms:     {_fmt(summary['latency_ms'])}")
+    print(f"  recorded ms:    {_fmt(summary['recorded_latency_ms'])}")
+    print(f"  schedule lag:   {_fmt(summary['schedule_lag_ms'])}")
+    for endpoint, row in summary["by_endpoint"].items():
+        line = f"  {endpoint + ':':<15} {row['requests']} req, error rate {row['error_rate']:.2%}, " \
+               f"{_fmt(row['latency_ms'])}"
+        if "first_token_ms" in row:
+            line += f"; first token p50 {row['first_token_ms']['p50']:.0f}"
+        print(line)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": run["results"]}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
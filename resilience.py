@@ -0,0 +1,253 @@
+"""Retries, hedging and circuit breaking for upstream (Vertex AI) calls.
+
+ResilientCall wraps one kind of call. Each call gets a time budget.
+Transient failures (429, 5xx, connection errors) are retried with
+full-jitter exponential backoff for as long as the budget allows. A slow
+call can optionally be hedged: a second copy starts once the first has
+taken longer than a recent latency quantile, and the first to answer wins.
+A high failure ratio among recent calls opens a CircuitBreaker, which
+rejects calls with CircuitOpenError until a cool-down has passed; a single
+probe then decides whether to close it again.
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, TimeoutError as FuturesTimeout, wait
+from typing import Any, Callable, Dict, Optional
+
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Transient upstream errors: HTTP-mapped 429/5xx (google.api_core) or connection trouble."""
+    if isinstance(exc, (ConnectionError, TimeoutError, FuturesTimeout)):
+        return True
+    code = getattr(exc, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is temporarily unavailable")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Failure-ratio breaker: closed -> open -> half-open -> closed. Thread-safe.
+
+    Opens when at least `failure_ratio` of the last `window` calls failed
+    (once `min_calls` have been seen); failure_ratio <= 0 disables it.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_ratio: float = 0.5, min_calls: int = 10, reset_timeout: float = 30.0,
+                 window: int = 20):
+        self.failure_ratio = failure_ratio
+        self.min_calls = max(1, min_calls)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._outcomes: deque = deque(maxlen=max(window, self.min_calls))
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now; in half-open only one probe at a time does."""
+        if self.failure_ratio <= 0:
+            return True
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state != self.OPEN:
+                return 1.0
+            return max(1.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def release(self) -> None:
+        """End a call without a verdict (e.g. a bad request): frees the half-open probe slot."""
+        if self.failure_ratio <= 0:
+            return
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probing = False
+
+    def record(self, ok: bool) -> None:
+        if self.failure_ratio <= 0:
+            return
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self._state = self.CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+                else:
+                    self._open()
+                return
+            if self._state == self.OPEN:
+                # A call that started before the circuit opened
+                return
+            if len(self._outcomes) == self._outcomes.maxlen:
+                self._failures -= not self._outcomes[0]
+            self._outcomes.append(ok)
+            self._failures += not ok
+            if len(self._outcomes) >= self.min_calls and self._failures >= self.failure_ratio * len(self._outcomes):
+                self._open()
+
+    def _open(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self.opened += 1
+
+
+class LatencyTracker:
+    """Recent successful call durations, for picking a hedge delay."""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._samples: deque = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ResilientCall:
+    """Retry/hedge/break policy for one kind of upstream call.
+
+    `submit(executor, fn, *args)` runs hedged attempts; pass StageTimer.submit
+    to keep request context. Hedging is off when hedge_quantile is None.
+    """
+
+    def __init__(self, name: str, breaker: CircuitBreaker, attempts: int = 3,
+                 base_delay: float = 0.2, max_delay: float = 2.0,
+                 executor=None, submit: Optional[Callable] = None,
+                 hedge_quantile: Optional[float] = None, hedge_min_delay: float = 0.05):
+        self.name = name
+        self.breaker = breaker
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.executor = executor
+        self._submit = submit or (lambda ex, fn, *args: ex.submit(fn, *args))
+        self.hedge_quantile = hedge_quantile if executor is not None else None
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def backoff(self, retry: int) -> float:
+        """Full jitter: uniform in [0, min(max_delay, base_delay * 2**(retry-1))]."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (retry - 1))))
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_quantile is None:
+            return None
+        q = self.latency.quantile(self.hedge_quantile)
+        return None if q is None else max(self.hedge_min_delay, q)
+
+    def call(self, fn: Callable, *args: Any, budget: float,
+             cancelled: Optional[Callable[[], bool]] = None) -> Any:
+        """fn(*args) with retries within `budget` seconds.
+
+        Raises CircuitOpenError while the breaker is open, otherwise the last
+        error. Non-retryable errors are raised at once and count neither
+        for nor against the breaker; a half-open probe ending in one frees
+        the probe slot for the next call.
+        """
+        deadline = time.monotonic() + budget
+        retry = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError(self.name, self.breaker.retry_after())
+            started = time.monotonic()
+            try:
+                result = self._attempt(fn, args, deadline)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    self.breaker.record(False)
+                else:
+                    # Says nothing about upstream health (bad request, permission denied)
+                    self.breaker.release()
+                retry += 1
+                if not retryable or retry >= self.attempts or (cancelled and cancelled()):
+                    raise
+                delay = self.backoff(retry)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+                continue
+            self.breaker.record(True)
+            self.latency.add(time.monotonic() - started)
+            return result
+
+    def _attempt(self, fn: Callable, args: tuple, deadline: float) -> Any:
+        delay = self.hedge_delay()
+        if delay is None or time.monotonic() + delay >= deadline:
+            return fn(*args)
+        first = self._submit(self.executor, fn, *args)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        with self._lock:
+            self.hedges += 1
+        second = self._submit(self.executor, fn, *args)
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise FuturesTimeout()
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {"retries": self.retries, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+        return {**counts, "circuit": self.breaker.state, "circuit_opened": self.breaker.opened,
+                "circuit_rejected": self.breaker.rejected}
@@ -0,0 +1,79 @@
+"""How many chunks to retrieve for a query.
+
+Greetings and small talk skip retrieval. Other queries start with a small
+k, and are topped up to the full k only when the first scores look
+unsure: the best chunk is a weak match, or the scores are flat up to
+the k-th chunk (more equally good chunks probably follow).
+"""
+import re
+from typing import Any, Dict, List, Optional
+
+_NOISE_RE = re.compile(r"[^\w\s']+")
+_GREETING_RE = re.compile(
+    r"^(?:hi|hello|hey|hiya|howdy|greetings|good (?:morning|afternoon|evening|day)|"
+    r"thanks?(?: a lot)?|thank you(?: (?:very|so) much)?|many thanks|cheers|ok(?:ay)?|great|perfect|"
+    r"bye|goodbye|see you)(?: (?:there|all|everyone|again|bot))?$"
+)
+_OFF_TOPIC_RE = re.compile(
+    r"^(?:how are you(?: doing)?(?: today)?|who are you|what are you|what can you do|"
+    r"tell me a joke|what(?:'s| is) the (?:weather|time|date)(?: today)?|what time is it)$"
+)
+
+
+def skip_reason(query: str) -> Optional[str]:
+    """"greeting" or "off_topic" when the whole message is one, else None."""
+    text = " ".join(_NOISE_RE.sub(" ", (query or "").lower()).split())
+    if not text or _GREETING_RE.match(text):
+        return "greeting"
+    if _OFF_TOPIC_RE.match(text):
+        return "off_topic"
+    return None
+
+
+class DepthPolicy:
+    """Retrieval depth limits and the confidence test for expanding.
+
+    Scores are compared in the corpus' own order: distances (lower is
+    better) unless higher_is_better. A best score worse than
+    `low_confidence`, or a spread of at most `flat_tail` between the best
+    and the k-th score, means unsure.
+    """
+
+    def __init__(self, enabled: bool = True, default_k: int = 5, max_k: int = 10, initial_k: int = 3,
+                 low_confidence: float = 0.5, flat_tail: float = 0.03, higher_is_better: bool = False):
+        self.enabled = enabled
+        self.max_k = max(1, max_k)
+        self.default_k = min(max(1, default_k), self.max_k)
+        self.initial_k = max(1, initial_k)
+        self.low_confidence = low_confidence
+        self.flat_tail = flat_tail
+        self.higher_is_better = higher_is_better
+
+    def top_k(self, requested: Any) -> int:
+        """The client's top_k (default when missing), capped at max_k. Raises ValueError."""
+        if requested is None or requested == "":
+            return self.default_k
+        try:
+            k = int(requested)
+        except (TypeError, ValueError):
+            raise ValueError(f"'top_k' must be an integer, got '{requested}'")
+        return min(max(1, k), self.max_k)
+
+    def first_k(self, top_k: int) -> int:
+        return min(self.initial_k, top_k) if self.enabled else top_k
+
+    def expand_reason(self, contexts: List[Dict[str, Any]], k: int) -> Optional[str]:
+        """Why the first k contexts aren't enough, or None when they are."""
+        if len(contexts) < k:
+            # The corpus has nothing more to give
+            return None
+        scores = [c.get("score") for c in contexts[:k]]
+        if any(s is None for s in scores):
+            return "unscored"
+        sign = -1 if self.higher_is_better else 1
+        ranked = sorted(sign * s for s in scores)  # best first
+        if ranked[0] > sign * self.low_confidence:
+            return "low_confidence"
+        if k > 1 and ranked[-1] - ranked[0] <= self.flat_tail:
+            return "flat_tail"
+        return None
@@ -0,0 +1,195 @@
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from cache import hash_parts, normalize_query
+from sharding import place_terms
+
+DEFAULT_THRESHOLD = 0.85
+# A lookup reads the whole vector matrix: about 0.1 ms per 1000 entries at dim 128
+DEFAULT_CAPACITY = 4096
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_NUMBER_RE = re.compile(r"\b\d+\b")
+_STOPWORDS = frozenset(
+    "a about allowed an and any are as at be by can do does for from how i in is it may me must of on or "
+    "our permitted s tell the there to we what when where which who why with you your".split()
+)
+# Words that mean the same thing in a policy question, mapped to one stem
+_SYNONYMS = {
+    **dict.fromkeys(("ad", "ads", "advert", "adverts", "advertise", "advertisement", "advertisements",
+                     "advertising"), "advertis"),
+    **dict.fromkeys(("rules", "restriction", "restrictions", "regulation", "regulations", "requirement",
+                     "requirements", "law", "laws", "ban", "bans", "banned", "restricted"), "rule"),
+    **dict.fromkeys(("sell", "selling", "sold", "sales"), "sale"),
+    **dict.fromkeys(("big", "large", "sizes"), "size"),
+}
+
+
+def _canonical(word: str) -> str:
+    if word in _SYNONYMS:
+        return _SYNONYMS[word]
+    if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def entity_key(query: str) -> int:
+    """63-bit id of the places and numbers a query names; cached answers only match on an equal key.
+
+    Questions that differ only in the country ("... in Poland" / "... in
+    Germany") or an article number embed almost identically, but need
+    different answers.
+    """
+    numbers = _NUMBER_RE.findall(normalize_query(query))
+    return int(hash_parts(sorted(place_terms(query)), sorted(numbers))[:15], 16)
+
+
+class HashedNgramVectorizer:
+    """Local, stateless query embedding: hashed word and character n-grams.
+
+    Words are reduced to a stem shared with their synonyms ("ad"/"advertising",
+    "rules"/"restrictions") and feed unigram and unordered bigram features;
+    character trigrams of each word make close spellings overlap a little.
+    Vectors are L2-normalised so a dot product is the cosine similarity.
+    """
+
+    def __init__(self, dim: int = 128):
+        self.dim = dim
+
+    def features(self, text: str) -> List[str]:
+        words = [_canonical(w) for w in _TOKEN_RE.findall(normalize_query(text)) if w not in _STOPWORDS]
+        feats = [f"w:{w}" for w in words]
+        # Unordered, so "Poland tobacco ad rules" matches "tobacco ad rules in Poland"
+        feats += [f"b:{min(a, b)} {max(a, b)}" for a, b in zip(words, words[1:])]
+        for w in words:
+            padded = f"<{w}>"
+            feats += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return feats
+
+    def transform(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feat in self.features(text):
+                h = zlib.crc32(feat.encode("utf-8"))
+                # Word features weigh more than character trigrams
+                weight = 1.0 if feat[0] == "c" else 2.0
+                out[row, h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        np.divide(out, norms, out=out, where=norms > 0)
+        return out
+
+
+def namespace_id(*parts: Any) -> int:
+    """63-bit id for a cache partition (model, corpus, top_k, ...)."""
+    return int(hash_parts(*parts)[:15], 16)
+
+
+class SemanticCache:
+    """Answers for recent queries, matched by cosine similarity.
+
+    Query vectors live in one preallocated (capacity x dim) float32 matrix, so a
+    lookup is a single matrix-vector product into a preallocated buffer; only
+    the entries above the threshold are checked further. Entries only match
+    within their namespace and with the same entity_key (places and numbers
+    named); when full, the least recently used slot is reused.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, threshold: float = DEFAULT_THRESHOLD, dim: int = 128,
+                 ttl_seconds: float = 3600):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.vectorizer = HashedNgramVectorizer(dim)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entity_rejects = 0
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._namespaces = np.zeros(capacity, dtype=np.int64)
+        self._entities = np.zeros(capacity, dtype=np.int64)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._payloads: List[Any] = [None] * capacity
+        # Scratch space for lookup, used under the lock
+        self._score_buffer = np.zeros(capacity, dtype=np.float32)
+        self._near_buffer = np.zeros(capacity, dtype=bool)
+        self._size = 0
+
+    def _scores(self, vectors: np.ndarray, namespace: int) -> np.ndarray:
+        n = self._size
+        scores = vectors @ self._vectors[:n].T
+        invalid = (self._namespaces[:n] != namespace) | (self._expires[:n] < time.monotonic())
+        scores[:, invalid] = -1.0
+        return scores
+
+    def search(self, vectors: np.ndarray, namespace: int,
+               entities: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Batched top-1: returns (slot, similarity) per query row, slot -1 if empty.
+
+        With `entities` (one entity_key per row) only entries with the same key count.
+        """
+        n = self._size
+        if n == 0:
+            return np.full(len(vectors), -1), np.zeros(len(vectors), dtype=np.float32)
+        scores = self._scores(vectors, namespace)
+        if entities is not None:
+            scores[self._entities[:n][None, :] != entities[:, None]] = -1.0
+        best = scores.argmax(axis=1)
+        return best, scores[np.arange(len(vectors)), best]
+
+    def lookup(self, query: str, namespace: int) -> Optional[Any]:
+        vec = self.vectorizer.transform([query])[0]
+        entity = entity_key(query)
+        with self._lock:
+            n = self._size
+            if n == 0:
+                self.misses += 1
+                return None
+            scores = np.matmul(self._vectors[:n], vec, out=self._score_buffer[:n])
+            # Only the few entries above the threshold get the namespace, expiry and entity checks
+            near = np.flatnonzero(np.greater_equal(scores, self.threshold, out=self._near_buffer[:n]))
+            near = near[(self._namespaces[near] == namespace) & (self._expires[near] >= time.monotonic())]
+            matching = near[self._entities[near] == entity]
+            if not matching.size:
+                if near.size:
+                    # A near-identical question about another place or article number
+                    self.entity_rejects += 1
+                self.misses += 1
+                return None
+            slot = int(matching[scores[matching].argmax()])
+            self._last_used[slot] = time.monotonic()
+            self.hits += 1
+            return self._payloads[slot]
+
+    def add(self, query: str, namespace: int, payload: Any) -> None:
+        vec = self.vectorizer.transform([query])[0]
+        entity = entity_key(query)
+        now = time.monotonic()
+        with self._lock:
+            if self._size < self.capacity:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(self._last_used.argmin())
+                self.evictions += 1
+            self._vectors[slot] = vec
+            self._namespaces[slot] = namespace
+            self._entities[slot] = entity
+            self._expires[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
+            self._payloads[slot] = payload
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = 0
+            self._payloads = [None] * self.capacity
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entity_rejects": self.entity_rejects, "entries": self._size, "threshold": self.threshold}
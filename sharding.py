@@ -0,0 +1,154 @@
+"""RAG corpus shards: configuration, query routing by region and result merging.
+
+RAG_CORPORA lists the shards as comma-separated `name=corpus resource`
+pairs. Shards named after a region (eu, apac, americas) are routed to:
+a query that names a country or region only goes to the matching shards,
+while a query naming none goes to all of them. Shards with any other name
+(e.g. "global") are always queried.
+"""
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+_CORPUS_RE = re.compile(r"^projects/([^/]+)/locations/([^/]+)/ragCorpora/[^/]+$")
+
+
+class Shard(NamedTuple):
+    name: str
+    corpus: str
+    location: Optional[str]
+
+
+def parse_shards(spec: str) -> List[Shard]:
+    """Shards from "eu=projects/p/locations/europe-west3/ragCorpora/1,apac=...".
+
+    Raises ValueError for a malformed entry or a duplicate name.
+    """
+    shards: List[Shard] = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, corpus = entry.partition("=")
+        name, corpus = name.strip().lower(), corpus.strip()
+        if not sep or not name or not corpus:
+            raise ValueError(f"RAG_CORPORA entry '{entry}' should look like name=projects/.../ragCorpora/ID")
+        if any(s.name == name for s in shards):
+            raise ValueError(f"RAG_CORPORA names shard '{name}' twice")
+        m = _CORPUS_RE.match(corpus)
+        shards.append(Shard(name, corpus, m.group(2) if m else None))
+    return shards
+
+
+# Lower-case names and demonyms per region; matched as whole words
+REGION_TERMS: Dict[str, Iterable[str]] = {
+    "eu": (
+        "eu", "european union", "europe", "european", "eea", "tpd",
+        "austria", "austrian", "belgium", "belgian", "bulgaria", "bulgarian", "croatia", "croatian",
+        "cyprus", "cypriot", "czechia", "czech republic", "czech", "denmark", "danish", "estonia", "estonian",
+        "finland", "finnish", "france", "french", "germany", "german", "greece", "greek", "hungary",
+        "hungarian", "ireland", "irish", "italy", "italian", "latvia", "latvian", "lithuania", "lithuanian",
+        "luxembourg", "malta", "maltese", "netherlands", "dutch", "poland", "polish", "portugal",
+        "portuguese", "romania", "romanian", "slovakia", "slovak", "slovenia", "slovenian", "spain",
+        "spanish", "sweden", "swedish", "norway", "norwegian", "iceland", "liechtenstein", "switzerland",
+        "swiss", "united kingdom", "uk", "britain", "british", "england",
+    ),
+    "apac": (
+        "apac", "asia", "asian", "asia-pacific", "asia pacific", "pacific", "oceania",
+        "australia", "australian", "new zealand", "china", "chinese", "hong kong", "japan", "japanese",
+        "korea", "south korea", "korean", "india", "indian", "indonesia", "indonesian", "malaysia",
+        "malaysian", "philippines", "philippine", "singapore", "singaporean", "thailand", "thai",
+        "vietnam", "vietnamese", "taiwan", "taiwanese", "pakistan", "bangladesh", "sri lanka",
+    ),
+    "americas": (
+        "americas", "america", "american", "north america", "latin america", "south america",
+        "united states", "usa", "us", "u.s.", "canada", "canadian", "mexico", "mexican", "brazil",
+        "brazilian", "argentina", "argentine", "chile", "chilean", "colombia", "colombian", "peru",
+        "peruvian", "uruguay", "uruguayan", "ecuador", "venezuela", "paraguay", "bolivia", "panama",
+        "costa rica", "guatemala", "cuba", "jamaica",
+    ),
+}
+
+# One regex per region: longest terms first so "south korea" wins over "korea"
+_REGION_RES = {
+    region: re.compile(r"(?<![\w.])(?:" + "|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True))
+                       + r")(?![\w])")
+    for region, terms in REGION_TERMS.items()
+}
+# "US" only as the upper-case abbreviation, not the pronoun "us"
+_CASE_SENSITIVE = {"us": re.compile(r"\bUS\b")}
+
+
+_PLACE_RE = re.compile(
+    r"(?<![\w.])(?:" + "|".join(re.escape(t) for t in sorted({t for terms in REGION_TERMS.values() for t in terms},
+                                                             key=len, reverse=True))
+    + r")(?![\w])")
+
+
+def place_terms(query: str) -> Set[str]:
+    """Every country, region or demonym named in the query (lower-case, as written)."""
+    found = set()
+    for m in _PLACE_RE.finditer((query or "").lower()):
+        term = m.group(0)
+        if term in _CASE_SENSITIVE and not _CASE_SENSITIVE[term].search(query):
+            continue
+        found.add(term)
+    return found
+
+
+def detect_regions(query: str) -> Set[str]:
+    """Regions whose countries or names appear in the query."""
+    lowered = (query or "").lower()
+    found = set()
+    for region, regex in _REGION_RES.items():
+        for m in regex.finditer(lowered):
+            term = m.group(0)
+            if term in _CASE_SENSITIVE and not _CASE_SENSITIVE[term].search(query):
+                continue
+            found.add(region)
+            break
+    return found
+
+
+def route(query: str, shards: List[Shard], enabled: bool = True) -> List[Shard]:
+    """Shards to query, in configured order.
+
+    Region shards matching the query's regions plus every non-region shard;
+    all shards when routing is off or no region shard matches.
+    """
+    if not enabled or len(shards) <= 1:
+        return list(shards)
+    regions = detect_regions(query)
+    picked = [s for s in shards if s.name not in REGION_TERMS or s.name in regions]
+    if not any(s.name in regions for s in picked):
+        return list(shards)
+    return picked
+
+
+def _page_key(ctx: Dict) -> object:
+    return ctx.get("page_range") or ctx.get("page_number")
+
+
+def merge_contexts(results: Iterable[List[Dict]], top_k: int, higher_is_better: bool = False) -> List[Dict]:
+    """Global top_k over per-shard context lists, deduplicated by source_uri + page span.
+
+    Vertex reports a distance (lower is better) by default; pass
+    higher_is_better for similarity scores. Contexts without a score rank
+    last; among equal scores, earlier shards and ranks win.
+    """
+    best: Dict[tuple, tuple] = {}
+    order = 0
+    for contexts in results:
+        for ctx in contexts or []:
+            score = ctx.get("score")
+            if score is None:
+                rank = float("inf")
+            else:
+                rank = -score if higher_is_better else score
+            uri = ctx.get("source_uri")
+            key = (uri, _page_key(ctx)) if uri else ("", order)
+            current = best.get(key)
+            if current is None or rank < current[0]:
+                best[key] = (rank, order, ctx)
+            order += 1
+    ranked = sorted(best.values(), key=lambda item: (item[0], item[1]))
+    return [ctx for _, _, ctx in ranked[:top_k]]
@@ -0,0 +1,147 @@
+"""Coalesce concurrent identical upstream calls (single-flight).
+
+The first caller for a key starts the call on an executor; callers arriving
+while it runs join the same Flight and get its result or its exception.
+Every join returns a Waiter whose leave() must be called (it is idempotent,
+so finally blocks are fine). When the last waiter leaves before the call
+finishes (client gone, deadline missed) the flight is abandoned: it is
+cancelled if it has not started, a running call can poll `flight.abandoned`
+to stop early, and new callers start afresh.
+"""
+import threading
+from concurrent.futures import TimeoutError as FuturesTimeout
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+class Flight:
+    __slots__ = ("key", "future", "waiters", "abandoned", "data")
+
+    def __init__(self, key: Hashable, data: Any = None):
+        self.key = key
+        self.future = None
+        self.waiters = 1
+        self.abandoned = False
+        self.data = data
+
+
+class Waiter:
+    """One caller's share of a Flight."""
+
+    __slots__ = ("flight", "leader", "_group", "_left")
+
+    def __init__(self, group: "SingleFlight", flight: Flight, leader: bool):
+        self.flight = flight
+        self.leader = leader
+        self._group = group
+        self._left = False
+
+    @property
+    def data(self) -> Any:
+        return self.flight.data
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.flight.future.result(timeout=timeout)
+
+    def leave(self) -> None:
+        if not self._left:
+            self._left = True
+            self._group._leave(self.flight)
+
+
+class SingleFlight:
+    """Per-key call sharing on top of an executor. Thread-safe."""
+
+    def __init__(self, executor, submit: Optional[Callable] = None, enabled: bool = True):
+        self.executor = executor
+        # submit(executor, fn, *args); lets callers carry context into the pool
+        self._submit = submit or (lambda ex, fn, *args: ex.submit(fn, *args))
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def join(self, key: Hashable, fn: Callable, *args: Any, init: Optional[Callable[[], Any]] = None) -> Waiter:
+        """Join the flight for key, starting fn(flight, *args) if there is none.
+
+        init() builds flight.data for a new flight, before fn starts, so
+        joiners can use it while the call is still running (e.g. a stream).
+        """
+        with self._lock:
+            flight = self._flights.get(key) if self.enabled else None
+            if flight is not None:
+                flight.waiters += 1
+                self.coalesced += 1
+                return Waiter(self, flight, leader=False)
+            flight = Flight(key, init() if init else None)
+            if self.enabled:
+                self._flights[key] = flight
+            self.leaders += 1
+            flight.future = self._submit(self.executor, self._run, flight, fn, args)
+        return Waiter(self, flight, leader=True)
+
+    def _leave(self, flight: Flight) -> None:
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters > 0 or flight.future.done():
+                return
+            flight.abandoned = True
+            flight.future.cancel()
+            self.abandoned += 1
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def _run(self, flight: Flight, fn: Callable, args: tuple) -> Any:
+        try:
+            return fn(flight, *args)
+        finally:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "abandoned": self.abandoned,
+                    "in_flight": len(self._flights)}
+
+
+_END = object()
+
+
+class SharedStream:
+    """Chunks of one upstream stream, replayed to every waiter from the start."""
+
+    END = _END
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._items: List[Any] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+
+    def append(self, item: Any) -> None:
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+    def get(self, index: int, timeout: Optional[float]) -> Any:
+        """Item number `index`, SharedStream.END after the last one.
+
+        Raises the upstream error once the items before it are consumed, and
+        concurrent.futures.TimeoutError when nothing arrives within timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: index < len(self._items) or self._done, timeout):
+                raise FuturesTimeout()
+            if index < len(self._items):
+                return self._items[index]
+            if self._error is not None:
+                raise self._error
+            return _END
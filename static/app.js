@@ -28,22 +28,42 @@ form.addEventListener('submit', async (e) => {
   addMessage('assistant', 'Analyzing legal documents...', true);
 
   try {
-    const res = await fetch('/chat', {
+    const res = await fetch('/chat/stream', {
       method: 'POST',
       headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify({ message, top_k })
+      // Compact (v2) payload: the annotated answer, sources and their previews only
+      body: JSON.stringify({ message, top_k, v: 2, fields: ['answer', 'sources', 'contexts'] })
     });
-    const data = await res.json();
 
-    // Remove loading message
-    removeLastMessage();
-
-    if (!res.ok) {
+    if (!res.ok || !res.body) {
+      const data = await res.json().catch(() => ({}));
       throw new Error(data.error || 'Server error');
     }
 
-    // Add assistant response
-    addMessage('assistant', data.annotated_text || data.response || '', false, data.sources || []);
+    // Replace the loading message with the answer as it streams in
+    let answerDiv = null;
+    let streamed = '';
+    await readEventStream(res, (event, data) => {
+      if (event === 'token') {
+        streamed += data.text || '';
+        if (!answerDiv) {
+          removeLastMessage();
+          answerDiv = addMessage('assistant', streamed);
+        } else {
+          setMessageContent(answerDiv, streamed);
+        }
+      } else if (event === 'final') {
+        if (!answerDiv) {
+          removeLastMessage();
+          answerDiv = addMessage('assistant', '');
+        }
+        const contexts = data.contexts || [];
+        const sources = (data.sources || []).map((s) => ({ ...s, text: s.ctx != null ? contexts[s.ctx] : s.text }));
+        setMessageContent(answerDiv, data.answer || '', sources);
+      } else if (event === 'error') {
+        throw new Error(data.error || 'Server error');
+      }
+    });
 
   } catch (err) {
     removeLastMessage();
@@ -54,6 +74,35 @@ form.addEventListener('submit', async (e) => {
   }
 });
 
+// Parse a text/event-stream response body, calling onEvent(event, data) per message
+async function readEventStream(res, onEvent) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+
+      let event = 'message';
+      const dataLines = [];
+      frame.split('\n').forEach((line) => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+      });
+      if (dataLines.length) {
+        onEvent(event, JSON.parse(dataLines.join('\n')));
+      }
+    }
+  }
+}
+
 function addMessage(sender, text, isLoading = false, sources = []) {
   const messageDiv = document.createElement('div');
   messageDiv.className = `message ${sender}-message`;
@@ -62,6 +111,16 @@ function addMessage(sender, text, isLoading = false, sources = []) {
     messageDiv.classList.add('loading');
   }
 
+  setMessageContent(messageDiv, text, sources);
+
+  conversation.appendChild(messageDiv);
+  conversation.scrollTop = conversation.scrollHeight;
+  return messageDiv;
+}
+
+function setMessageContent(messageDiv, text, sources = []) {
+  messageDiv.innerHTML = '';
+
   const contentDiv = document.createElement('div');
   contentDiv.className = 'message-content';
   
@@ -121,7 +180,6 @@ function addMessage(sender, text, isLoading = false, sources = []) {
     messageDiv.appendChild(sourcesDiv);
   }
 
-  conversation.appendChild(messageDiv);
   conversation.scrollTop = conversation.scrollHeight;
 }
 
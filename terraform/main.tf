@@ -27,15 +27,26 @@ resource "google_cloud_run_v2_service" "default" {
 
   template {
     timeout = "300s"
+    # Matches GUNICORN_THREADS in the Dockerfile; the app's own admission
+    # control (MAX_IN_FLIGHT_CHATS / MAX_QUEUED_CHATS) sheds load beyond that.
+    max_instance_request_concurrency = 40
+    # Conversation history lives in the instance's memory (CONVERSATION_STORE),
+    # so a browser's follow-up questions should reach the same instance.
+    # Affinity is best effort: history is still lost when the instance is
+    # recycled or scaled in, and the next answer starts without context.
+    session_affinity = true
     containers {
       image = "us-central1-docker.pkg.dev/${var.project_id}/maf-policy-bot/app:latest"
       
+      # The app binds at once and warms up the Vertex SDK in the background;
+      # /readyz turns 200 when that is done, so traffic waits for a warm instance
       startup_probe {
         initial_delay_seconds = 0
         timeout_seconds = 1
-        period_seconds = 3
-        failure_threshold = 1
-        tcp_socket {
+        period_seconds = 1
+        failure_threshold = 30
+        http_get {
+          path = "/readyz"
           port = 8080
         }
       }
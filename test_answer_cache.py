@@ -0,0 +1,25 @@
+"""Offline check that a repeated /chat question is answered from the answer cache.
+
+Runs on the fake Vertex SDK (see conftest.py); no credentials needed:
+
+    python -m pytest -q test_answer_cache.py
+"""
+
+
+def test_second_identical_chat_is_served_from_cache(main, fake, signed_in_client):
+    assert main.answer_cache is not None
+    question = {"message": "What are the plain packaging rules in Ireland?"}
+
+    first = signed_in_client("cache-test").post("/chat", json=question)
+    assert first.status_code == 200
+    assert not first.get_json().get("cached")
+    first.close()  # frees its admission slot
+    generations = fake.calls["generation"]
+
+    # A new conversation: the cache key includes the conversation history
+    second = signed_in_client("cache-test").post("/chat", json=question)
+    assert second.status_code == 200
+    assert second.get_json().get("cached") is True
+    assert second.get_json()["response"] == first.get_json()["response"]
+    assert fake.calls["generation"] == generations
+    second.close()
@@ -0,0 +1,48 @@
+"""/chat/batch: every question takes its own admission slot.
+
+Runs on the fake Vertex SDK (see conftest.py):
+
+    python -m pytest -q test_chat_batch.py
+"""
+import json
+
+
+def test_each_question_holds_an_admission_slot(main, signed_in_client, monkeypatch):
+    in_flight = []
+    run_chat_turn = main.run_chat_turn
+
+    def spy(*args, **kwargs):
+        in_flight.append(main.chat_admission.stats()["in_flight"])
+        return run_chat_turn(*args, **kwargs)
+
+    monkeypatch.setattr(main, "run_chat_turn", spy)
+    before = main.chat_admission.stats()
+    countries = ["Poland", "Germany", "France", "Spain", "Italy", "Ireland"]
+    resp = signed_in_client("batch-user").post("/chat/batch", json={
+        "template": "minimum age to buy cigarettes in {country}", "countries": countries})
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+    assert resp.status_code == 200
+    assert lines[-1]["done"] and lines[-1]["ok"] == len(countries)
+    resp.close()
+    assert main.chat_admission.stats()["admitted"] - before["admitted"] == len(countries)
+    assert 1 <= max(in_flight) - before["in_flight"] <= main.batch_width()
+    assert main.chat_admission.stats()["in_flight"] == before["in_flight"]
+
+
+def test_batch_leaves_the_user_a_slot_for_chats(main, monkeypatch):
+    monkeypatch.setattr(main.chat_admission, "max_per_user", 4)
+    assert main.batch_width() == 3
+
+
+def test_batch_is_refused_when_the_user_has_one_slot(main, signed_in_client, monkeypatch):
+    monkeypatch.setattr(main.chat_admission, "max_per_user", 1)
+    client = signed_in_client("single-slot-user")
+    resp = client.post("/chat/batch", json={"queries": ["minimum age to buy cigarettes in Malta"]})
+    assert resp.status_code == 429
+    assert "one chat at a time" in resp.get_json()["error"]
+    resp.close()
+
+    chat = client.post("/chat", json={"message": "minimum age to buy cigarettes in Malta"})
+    assert chat.status_code == 200
+    chat.close()
@@ -0,0 +1,200 @@
+"""The citation engine gives exactly the output of the previous implementation.
+
+The previous build_citation_catalog and annotate_with_citations are kept
+below (verbatim apart from names) and compared on randomized inputs with a
+fixed seed: same catalog, same numbering, same annotated text. Non-ASCII
+answers are checked both with str offsets and with the UTF-8 byte offsets
+Vertex actually reports. bench_citations.py times the two against each other.
+
+Runs on the fake Vertex SDK (see conftest.py); helpers import main lazily,
+once the `main` fixture has loaded it:
+
+    python -m pytest -q test_citations.py
+"""
+import random
+
+import pytest
+
+
+# -- Previous implementations ------------------------------------------------
+
+def legacy_build_citation_catalog(gen_chunks, retrieved):
+    import main
+
+    by_uri = {r.get("source_uri"): r for r in retrieved if r.get("source_uri")}
+    by_title = {}
+    for r in retrieved:
+        t = r.get("title")
+        if t and t not in by_title:
+            by_title[t] = r
+
+    catalog = []
+    index_to_cite_num = {}
+
+    def ensure_entry(chunk):
+        uri = chunk.get("uri")
+        title = chunk.get("title")
+        text = chunk.get("text")
+        key = main._mk_source_key(uri, title, text)
+        for i, e in enumerate(catalog):
+            if e["_key"] == key:
+                return i + 1
+        merged = {
+            "uri": main.convert_gs_to_authenticated_url(uri or (by_title.get(title) or {}).get("source_uri")),
+            "title": title or (by_uri.get(uri) or {}).get("title"),
+            "text": text,
+            "score": None,
+            "page_number": chunk.get("page_number"),
+            "page_range": chunk.get("page_range"),
+            "_key": key,
+        }
+        if merged["uri"] and merged["uri"] in by_uri:
+            retrieved_item = by_uri[merged["uri"]]
+            merged["title"] = merged["title"] or retrieved_item.get("title")
+            merged["score"] = retrieved_item.get("score")
+            merged["page_number"] = merged["page_number"] or retrieved_item.get("page_number")
+            merged["page_range"] = merged["page_range"] or retrieved_item.get("page_range")
+        elif merged["title"] and merged["title"] in by_title:
+            retrieved_item = by_title[merged["title"]]
+            merged["uri"] = merged["uri"] or retrieved_item.get("source_uri")
+            merged["score"] = retrieved_item.get("score")
+            merged["page_number"] = merged["page_number"] or retrieved_item.get("page_number")
+            merged["page_range"] = merged["page_range"] or retrieved_item.get("page_range")
+        catalog.append(merged)
+        return len(catalog)
+
+    for idx, ch in enumerate(gen_chunks or []):
+        cite_num = ensure_entry(ch)
+        index_to_cite_num[idx] = cite_num
+
+    for e in catalog:
+        e.pop("_key", None)
+
+    return index_to_cite_num, catalog
+
+
+def legacy_annotate_with_citations(text, supports, idx_to_num):
+    if not text or not supports:
+        return text or ""
+
+    def end_idx(s):
+        seg = s.get("segment") or {}
+        return seg.get("end_index", 0)
+    supports_sorted = sorted(supports, key=end_idx, reverse=True)
+    out = text
+    for s in supports_sorted:
+        seg = s.get("segment") or {}
+        end_i = seg.get("end_index")
+        if end_i is None or end_i > len(out) or end_i < 0:
+            continue
+        idxs = s.get("grounding_chunk_indices") or []
+        ids = [idx_to_num[i] for i in idxs if i in idx_to_num]
+        if not ids:
+            continue
+        marker = "".join(f"[{n}]" for n in sorted(set(ids)))
+        out = out[:end_i] + marker + out[end_i:]
+    return out
+
+
+# -- Random inputs -----------------------------------------------------------
+
+ASCII_WORDS = "tobacco advertising ban packaging warning retail display sale minors".split()
+# Polish and German legal vocabulary, plus a few astral-plane characters
+UNICODE_WORDS = ASCII_WORDS + "zakaz reklamy wyrobów tytoniowych Gesundheitswarnung Verkaufsverbot für Jugendliche § ✓ 𝔄".split()
+
+
+def random_text(rng, words, n_words):
+    return " ".join(rng.choice(words) for _ in range(n_words))
+
+
+def random_chunks(rng, n, n_sources):
+    """Grounding chunks that repeat sources, some without uri or title."""
+    chunks = []
+    for _ in range(n):
+        doc = rng.randrange(n_sources)
+        kind = rng.random()
+        chunks.append({
+            "uri": f"gs://bucket/doc-{doc}.pdf" if kind < 0.8 else None,
+            "title": f"Doc {doc}" if kind < 0.9 else None,
+            "text": f"excerpt {doc}" if kind > 0.1 else None,
+        })
+    return chunks
+
+
+def random_retrieved(rng, n_sources):
+    import main
+
+    return [{
+        "source_uri": main.convert_gs_to_authenticated_url(f"gs://bucket/doc-{doc}.pdf") if rng.random() < 0.5
+        else f"gs://bucket/doc-{doc}.pdf",
+        "title": f"Doc {doc}",
+        "score": round(rng.random(), 3),
+        "page_number": rng.randint(1, 50),
+        "page_range": None,
+    } for doc in rng.sample(range(n_sources), max(1, n_sources // 2))]
+
+
+def random_supports(rng, n, text_len, n_chunks):
+    supports = []
+    for _ in range(n):
+        end = rng.randint(0, text_len)
+        if rng.random() < 0.05:
+            end = text_len + rng.randint(1, 10)  # out of range, skipped by both
+        seg = {"end_index": end} if rng.random() < 0.97 else {}
+        idxs = [rng.randrange(n_chunks + 2) for _ in range(rng.randint(0, 3))]
+        supports.append({"segment": seg, "grounding_chunk_indices": idxs})
+    # Ties at the same position
+    for _ in range(n // 10):
+        supports.append(dict(rng.choice(supports)))
+    rng.shuffle(supports)
+    return supports
+
+
+def to_byte_offsets(text, supports):
+    """The same supports with str offsets rewritten as UTF-8 byte offsets."""
+    out = []
+    for s in supports:
+        end = (s.get("segment") or {}).get("end_index")
+        if end is not None and 0 <= end <= len(text):
+            s = {**s, "segment": {"end_index": len(text[:end].encode("utf-8"))}}
+        elif end is not None:
+            s = {**s, "segment": {"end_index": -1}}
+        out.append(s)
+    return out
+
+
+def chunk_records(chunks):
+    import main
+
+    return [main.GroundingChunk(uri=c.get("uri"), title=c.get("title"), text=c.get("text")) for c in chunks]
+
+
+def support_records(supports):
+    import main
+
+    return [main.GroundingSupport((s.get("segment") or {}).get("end_index"), s.get("grounding_chunk_indices") or [])
+            for s in supports]
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3, 4])
+def test_matches_previous_implementation(main, seed):
+    rng = random.Random(seed)
+    for trial in range(100):
+        words = UNICODE_WORDS if trial % 2 else ASCII_WORDS
+        text = random_text(rng, words, rng.randint(0, 300))
+        n_sources = rng.randint(1, 20)
+        chunks = random_chunks(rng, rng.randint(0, 30), n_sources)
+        retrieved = random_retrieved(rng, n_sources)
+        supports = random_supports(rng, rng.randint(0, 60), len(text), len(chunks))
+
+        old_map, old_catalog = legacy_build_citation_catalog(chunks, retrieved)
+        new_map, new_catalog = main.build_citation_catalog(chunk_records(chunks), retrieved)
+        assert (old_map, old_catalog) == (new_map, new_catalog), f"catalog differs (trial {trial})"
+
+        expected = legacy_annotate_with_citations(text, supports, old_map)
+        got = main.annotate_with_citations(text, support_records(supports), new_map, byte_offsets=False)
+        assert got == expected, f"annotation differs with str offsets (trial {trial})"
+        got = main.annotate_with_citations(text, support_records(to_byte_offsets(text, supports)), new_map)
+        assert got == expected, f"annotation differs with byte offsets (trial {trial})"
+        if text.isascii():
+            assert main.annotate_with_citations(text, support_records(supports), new_map) == expected
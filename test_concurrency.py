@@ -0,0 +1,67 @@
+"""Admission control: waiting requests get slots in arrival order.
+
+    python -m pytest -q test_concurrency.py
+"""
+import threading
+import time
+
+import pytest
+
+from concurrency import AdmissionController, Overloaded
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    admission = AdmissionController(max_in_flight=1, max_queue=10, queue_timeout_s=5, max_per_user=0)
+    holder = admission.acquire()
+    order, tickets = [], {}
+
+    def request(n):
+        tickets[n] = admission.acquire()
+        order.append(n)
+
+    threads = []
+    for n in range(5):
+        threads.append(threading.Thread(target=request, args=(n,)))
+        threads[-1].start()
+        wait_until(lambda: admission.stats()["waiting"] == n + 1)
+
+    admission.queue_timeout_s = 0.01
+    holder.release()
+    # Arriving right as the slot frees up, before the first waiter has woken:
+    # the slot is already the waiter's, so the newcomer has to queue
+    with pytest.raises(Overloaded):
+        admission.acquire()
+    for n in range(5):
+        wait_until(lambda: len(order) == n + 1)
+        tickets[n].release()
+    for t in threads:
+        t.join()
+    assert order == [0, 1, 2, 3, 4]
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_queue_full_and_queue_timeout():
+    admission = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout_s=0.05, max_per_user=0)
+    holder = admission.acquire()
+    with pytest.raises(Overloaded) as timed_out:
+        admission.acquire()
+    assert timed_out.value.status == 503
+    assert admission.stats()["waiting"] == 0
+
+    admission.queue_timeout_s = 5
+    waiter = threading.Thread(target=lambda: admission.acquire().release())
+    waiter.start()
+    wait_until(lambda: admission.stats()["waiting"] == 1)
+    with pytest.raises(Overloaded):
+        admission.acquire()
+    holder.release()
+    waiter.join()
+    assert admission.stats()["rejected"] == {"queue_timeout": 1, "queue_full": 1}
+    assert admission.stats()["in_flight"] == 0
@@ -0,0 +1,129 @@
+"""Retries, circuit breaker transitions and hedging, driven by fake_vertex fault injection.
+
+    python -m pytest -q test_resilience.py
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import fake_vertex
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCall
+
+
+@pytest.fixture
+def fake():
+    previous = fake_vertex.config
+    cfg = fake_vertex.install(fake_vertex.FakeVertexConfig(retrieval_ms=1, generation_ms=1, dist="fixed",
+                                                           faults="retrieval"))
+    yield cfg
+    fake_vertex.install(previous)
+
+
+def retrieve():
+    return fake_vertex._retrieval_query(text="advertising restrictions")
+
+
+def resilient(breaker=None, attempts=1, **kwargs):
+    breaker = breaker or CircuitBreaker(failure_ratio=0.5, min_calls=4, reset_timeout=0.05, window=4)
+    return ResilientCall("retrieval", breaker, attempts=attempts, base_delay=0.001, max_delay=0.002, **kwargs)
+
+
+def open_circuit(call, fake):
+    fake.outage = True
+    for _ in range(call.breaker.min_calls):
+        with pytest.raises(Exception):
+            call.call(retrieve, budget=1)
+    assert call.breaker.state == CircuitBreaker.OPEN
+
+
+def test_transient_fault_is_retried(fake):
+    fake.outage = True
+
+    def recovering():
+        try:
+            return retrieve()
+        finally:
+            fake.outage = False  # only the first attempt fails
+
+    call = resilient(attempts=3)
+    assert call.call(recovering, budget=1).contexts.contexts
+    assert call.retries == 1
+    assert fake.calls["retrieval"] == 2
+    assert call.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_opens_rejects_then_probe_closes_it(fake):
+    call = resilient()
+    open_circuit(call, fake)
+    calls = fake.calls["retrieval"]
+    with pytest.raises(CircuitOpenError):
+        call.call(retrieve, budget=1)
+    assert fake.calls["retrieval"] == calls
+
+    time.sleep(0.06)
+    assert call.breaker.state == CircuitBreaker.HALF_OPEN
+    fake.outage = False
+    call.call(retrieve, budget=1)
+    assert call.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens(fake):
+    call = resilient()
+    open_circuit(call, fake)
+    time.sleep(0.06)
+    with pytest.raises(Exception):
+        call.call(retrieve, budget=1)
+    assert call.breaker.state == CircuitBreaker.OPEN
+    assert call.breaker.opened == 2
+
+
+def test_bad_request_probe_does_not_close_the_circuit(fake):
+    call = resilient()
+    open_circuit(call, fake)
+    time.sleep(0.06)
+    fake.error_code = 400
+    with pytest.raises(Exception) as bad_request:
+        call.call(retrieve, budget=1)
+    assert getattr(bad_request.value, "code", None) == 400
+    assert call.breaker.state == CircuitBreaker.HALF_OPEN
+    # The probe slot was freed: the next call probes and closes the circuit
+    fake.outage = False
+    call.call(retrieve, budget=1)
+    assert call.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_bad_requests_do_not_dilute_the_failure_window(fake):
+    breaker = CircuitBreaker(failure_ratio=0.6, min_calls=2, reset_timeout=30, window=4)
+    call = resilient(breaker)
+    fake.outage = True
+    fake.error_code = 400
+    for _ in range(3):
+        with pytest.raises(Exception):
+            call.call(retrieve, budget=1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    fake.error_code = 503
+    for _ in range(2):
+        with pytest.raises(Exception):
+            call.call(retrieve, budget=1)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_slow_call_is_hedged(fake):
+    executor = ThreadPoolExecutor(max_workers=4)
+    call = resilient(executor=executor, hedge_quantile=0.9, hedge_min_delay=0.02)
+    for _ in range(20):
+        call.latency.add(0.01)
+    fake.slow_factor = 200  # 1 ms -> 200 ms
+    started = []
+
+    def first_slow():
+        fake.slow_rate = 0.0 if started else 1.0
+        started.append(True)
+        return retrieve()
+
+    t0 = time.monotonic()
+    call.call(first_slow, budget=1)
+    assert time.monotonic() - t0 < 0.15
+    assert (call.hedges, call.hedge_wins) == (1, 1)
+    executor.shutdown(wait=True)
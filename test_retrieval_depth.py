@@ -0,0 +1,38 @@
+"""Adaptive retrieval depth: inline mode tops up unsure results, tool mode keeps top_k.
+
+Runs on the fake Vertex SDK (see conftest.py); no credentials needed:
+
+    python -m pytest -q test_retrieval_depth.py
+"""
+import pytest
+
+
+@pytest.fixture
+def policy(main, monkeypatch):
+    monkeypatch.setattr(main.depth_policy, "enabled", True)
+    monkeypatch.setattr(main.depth_policy, "initial_k", 3)
+    monkeypatch.setattr(main, "retrieval_cache", None)
+    return main.depth_policy
+
+
+def test_unsure_results_are_topped_up_without_repeats(main, fake, policy, monkeypatch):
+    monkeypatch.setattr(main, "GROUNDING_MODE", "inline")
+    # Fake distances start at 0.1: every first result looks unsure
+    monkeypatch.setattr(policy, "low_confidence", 0.05)
+    calls = fake.calls["retrieval"]
+    first = main.retrieve_contexts("smoke-free law in Spain", 3)
+
+    contexts = main.retrieve_adaptive("smoke-free law in Spain", 6)
+    assert contexts[:3] == first
+    assert len(contexts) == 6
+    assert len({(c["source_uri"], c["page_range"], c["text"]) for c in contexts}) == 6
+    assert fake.calls["retrieval"] - calls == 3
+
+
+def test_tool_mode_retrieves_top_k_once(main, fake, policy, monkeypatch):
+    monkeypatch.setattr(main, "GROUNDING_MODE", "tool")
+    monkeypatch.setattr(policy, "low_confidence", 0.05)
+    calls = fake.calls["retrieval"]
+    contexts = main.retrieve_adaptive("smoke-free law in Spain", 6)
+    assert len(contexts) == 6
+    assert fake.calls["retrieval"] - calls == 1
@@ -0,0 +1,37 @@
+"""Semantic cache: paraphrases hit, questions about another place or article don't.
+
+    python -m pytest -q test_semantic_cache.py
+"""
+from semantic_cache import SemanticCache
+
+
+def test_paraphrase_hits_at_default_threshold():
+    cache = SemanticCache(capacity=16)
+    cache.add("tobacco ad rules Poland", 0, "poland-ads")
+    assert cache.lookup("what are Poland's tobacco advertising restrictions", 0) == "poland-ads"
+
+
+def test_country_swap_never_hits():
+    cache = SemanticCache(capacity=16, threshold=0.5)
+    question = "What are the rules on tobacco advertising on billboards and in print media in {}?"
+    cache.add(question.format("Poland"), 0, "poland")
+    assert cache.lookup(question.format("Germany"), 0) is None
+    assert cache.lookup(question.format("Poland"), 0) == "poland"
+    assert cache.stats()["entity_rejects"] == 1
+
+
+def test_article_number_is_part_of_the_match():
+    cache = SemanticCache(capacity=16, threshold=0.5)
+    cache.add("what does article 8 of the directive require", 0, "article-8")
+    assert cache.lookup("what does article 9 of the directive require", 0) is None
+
+
+def test_other_namespaces_and_expired_entries_never_hit():
+    cache = SemanticCache(capacity=16, threshold=0.5, ttl_seconds=0)
+    cache.add("tobacco ad rules Poland", 0, "expired")
+    assert cache.lookup("tobacco ad rules Poland", 0) is None
+    cache.ttl_seconds = 3600
+    cache.add("tobacco ad rules Poland", 1, "other-namespace")
+    assert cache.lookup("tobacco ad rules Poland", 0) is None
+    assert cache.lookup("tobacco ad rules Poland", 1) == "other-namespace"
+    assert cache.stats()["entity_rejects"] == 0
@@ -0,0 +1,49 @@
+"""Sharded corpora: a /chat fans retrieval out over the routed shards and merges one top-k.
+
+Runs on the fake Vertex SDK (see conftest.py); no credentials needed:
+
+    python -m pytest -q test_sharding.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from resilience import CircuitBreaker, ResilientCall
+from sharding import parse_shards
+
+
+@pytest.fixture
+def two_shards(main, monkeypatch):
+    shards = parse_shards("eu=projects/test-project/locations/europe-west3/ragCorpora/2,"
+                          "global=projects/test-project/locations/us-central1/ragCorpora/3")
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="test-shard")
+    monkeypatch.setattr(main, "RAG_SHARDS", shards)
+    monkeypatch.setattr(main, "RAG_CORPUS", ",".join(f"{s.name}={s.corpus}" for s in shards))
+    monkeypatch.setattr(main, "retrieval_calls", {
+        s.name: ResilientCall(f"retrieval:{s.name}", CircuitBreaker(failure_ratio=0)) for s in shards})
+    monkeypatch.setattr(main, "_shard_executor", executor)
+    monkeypatch.setattr(main, "retrieval_cache", None)
+    yield shards
+    executor.shutdown()
+
+
+def test_chat_merges_the_routed_shards(main, fake, two_shards, signed_in_client):
+    calls = fake.calls["retrieval"]
+    resp = signed_in_client("shard-test").post(
+        "/chat", json={"message": "Which tobacco advertising bans apply in Poland?", "top_k": 4})
+    payload = resp.get_json()
+    resp.close()
+
+    assert resp.status_code == 200, payload
+    assert fake.calls["retrieval"] - calls == 2
+    assert not payload["degraded"]
+    assert len(payload["retrieved_contexts"]) == 4
+
+
+def test_query_shards_keeps_the_best_chunks_of_all_shards(main, two_shards):
+    query = "Which tobacco advertising bans apply in Poland?"
+    per_shard = [main.query_rag_contexts(query, 4, s) for s in two_shards]
+    merged = main.query_shards(query, 4)
+
+    best = sorted((c["score"] for contexts in per_shard for c in contexts))[:4]
+    assert [c["score"] for c in merged] == best
@@ -0,0 +1,44 @@
+"""Warm-up is best effort: a hanging or failing step never keeps /readyz at 503.
+
+Runs on the fake Vertex SDK (see conftest.py); no credentials needed:
+
+    python -m pytest -q test_warmup.py
+"""
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def warmup(main, monkeypatch):
+    monkeypatch.setattr(main, "WARMUP_ENABLED", True)
+    monkeypatch.setattr(main, "WARMUP_STEP_TIMEOUT_S", 0.05)
+    return main.Warmup()
+
+
+def test_hanging_retrieval_times_out_and_turns_ready(main, warmup, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(main, "_retrieval_query", lambda *args: release.wait(5))
+    try:
+        warmup.start()
+        assert warmup.ready.wait(1)
+        assert not warmup.retrieval_primed
+        assert warmup.steps["retrieval"] < 1000
+        monkeypatch.setattr(main, "warmup", warmup)
+        assert main.app.test_client().get("/readyz").status_code == 200
+    finally:
+        release.set()
+
+
+def test_failed_sdk_import_still_turns_ready(main, warmup, monkeypatch):
+    def broken():
+        raise ImportError("no module named vertexai")
+
+    monkeypatch.setattr(main, "vertex_sdk", broken)
+    started = time.monotonic()
+    warmup.start()
+    assert warmup.ready.wait(1)
+    assert time.monotonic() - started < 1
+    assert warmup.status()["status"] == "ready"
+    assert "ImportError" in warmup.status()["error"]